@@ -1,33 +1,89 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
+import hashlib
+import json
 import os
 import pandas as pd
 from expanalysis.experiments import processing
 
-def get_exp_DVs(use_group_fun=True, group_kwargs=None, out_dir=None):
+# group_kwargs that don't change the DVs, left out of the cache key
+UNCACHED_KWARGS = ('outfile', 'parallel', 'num_cores')
+
+def get_cache_file(task_data, use_group_fun, group_kwargs, cache_dir):
+    """ returns the cache file of a task's DVs, keyed by the hash of its group
+    csv and the parameters of calc_exp_DVs (e.g. HDDM samples) """
+    hasher = hashlib.sha1()
+    with open(task_data, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            hasher.update(chunk)
+    params = {k: v for k, v in group_kwargs.items() if k not in UNCACHED_KWARGS}
+    hasher.update(json.dumps([use_group_fun, params], sort_keys=True).encode())
+    name = os.path.basename(task_data).split('.')[0]
+    return os.path.join(cache_dir, '%s_%s.pkl' % (name, hasher.hexdigest()[:16]))
+
+def calc_task_DVs(task_data, use_group_fun=True, group_kwargs=None, out_dir=None,
+                  cache_dir=None):
+    """ calculates the DVs of one group csv. Returns the exp_id and DVs """
+    group_kwargs = dict(group_kwargs or {})
+    if cache_dir is not None:
+        cache_file = get_cache_file(task_data, use_group_fun, group_kwargs, cache_dir)
+        if os.path.exists(cache_file):
+            exp_id, DVs = pd.read_pickle(cache_file)
+            print('%s (cached)' % exp_id)
+            if out_dir and DVs is not None:
+                DVs.to_pickle(os.path.join(out_dir, exp_id+'_DVs.pkl'))
+            return exp_id, DVs
+    df = pd.read_csv(task_data)
+    exp_id = df.experiment_exp_id.unique()[0]
+    print(exp_id)
+    if out_dir:
+        group_kwargs['outfile'] = os.path.join(out_dir, exp_id)
+    DVs, valence, description = processing.calc_exp_DVs(df, 
+                                            use_group_fun=use_group_fun,
+                                            group_kwargs=group_kwargs)
+    if out_dir and DVs is not None:
+        DVs.to_pickle(os.path.join(out_dir, exp_id+'_DVs.pkl'))
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '%s.%s.tmp' % (cache_file, os.getpid())
+        pd.to_pickle((exp_id, DVs), tmp_file)
+        os.replace(tmp_file, cache_file)
+    return exp_id, DVs
+
+def get_exp_DVs(use_group_fun=True, group_kwargs=None, out_dir=None, cache_dir=None):
+    """
+    calculates the DVs of every group csv. Tasks run concurrently, splitting
+    group_kwargs['num_cores'] (default: all cores) between them, and the DVs
+    of tasks whose csv and parameters are unchanged are read from cache_dir
+    """
     file_dir = os.path.dirname(__file__)
     # calculate DVs
     if group_kwargs is None:
         group_kwargs = {}
-    exp_DVs = {}
-    for task_data in glob(os.path.join(file_dir, '../behavioral_data/processed/group_data/*.csv')):
-        df = pd.read_csv(task_data)
-        exp_id = df.experiment_exp_id.unique()[0]
-        print(exp_id)
-        if out_dir:
-            group_kwargs['outfile'] = os.path.join(out_dir, exp_id)
-        DVs, valence, description = processing.calc_exp_DVs(df, 
-                                                use_group_fun=use_group_fun,
-                                                group_kwargs=group_kwargs)
-        exp_DVs[exp_id] = DVs
-        if out_dir:
-            DVs.to_pickle(os.path.join(out_dir, exp_id+'_DVs.pkl'))
-    DV_df = pd.DataFrame()
+    task_files = sorted(glob(os.path.join(file_dir, '../behavioral_data/processed/group_data/*.csv')))
+    if len(task_files) == 0:
+        return pd.DataFrame()
+    num_cores = group_kwargs.get('num_cores') or os.cpu_count()
+    n_workers = max(1, min(len(task_files), num_cores))
+    # the cores left over are given to each task's own (HDDM) parallelism
+    task_kwargs = dict(group_kwargs, num_cores=max(1, num_cores // n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(calc_task_DVs, task_files,
+                               [use_group_fun]*len(task_files),
+                               [task_kwargs]*len(task_files),
+                               [out_dir]*len(task_files),
+                               [cache_dir]*len(task_files))
+        exp_DVs = dict(results)
+    DV_dfs = []
     for name, DV in exp_DVs.items():
         if DV is not None:
+            DV = DV.copy()
             DV.columns = [name+'_%s' % i for i in DV.columns]
-            DV_df = pd.concat([DV_df, DV], axis=1) 
-    return DV_df
+            DV_dfs.append(DV)
+    if len(DV_dfs) == 0:
+        return pd.DataFrame()
+    return pd.concat(DV_dfs, axis=1)
 
 if __name__ =='__main__':
     # parse arguments
@@ -41,6 +97,9 @@ if __name__ =='__main__':
     parser.add_argument('--no_parallel', action='store_false')
     parser.add_argument('--num_cores', default=None, type=int)
     parser.add_argument('--mode', default=None, type=str)
+    parser.add_argument('--cache_dir', default=None,
+                        help='directory of cached task DVs. Defaults to behavioral_data/processed/DV_cache')
+    parser.add_argument('--no_cache', action='store_true')
     
     args = parser.parse_args()
     out_dir = args.out_dir
@@ -61,7 +120,12 @@ if __name__ =='__main__':
                     'burn': hddm_burn,
                     'thin': hddm_thin}
     
-    DV_df = get_exp_DVs(use_group, group_kwargs, out_dir)
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(__file__), '../behavioral_data/processed/DV_cache')
+    if args.no_cache:
+        cache_dir = None
+    DV_df = get_exp_DVs(use_group, group_kwargs, out_dir, cache_dir)
     if out_dir is not None:
         DV_df.to_pickle(os.path.join(out_dir, 'fmri_DVs.pkl'))
     
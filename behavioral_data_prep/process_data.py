@@ -1,7 +1,10 @@
 import argparse
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from expanalysis.experiments.processing import clean_data
 from glob import glob
+import hashlib
+import json
 import os
 import pandas as pd
 from create_event_utils import create_events
@@ -9,121 +12,194 @@ from create_event_utils import create_events
 from utils import get_name_map, get_timing_correction, get_median_rts
 #for working in jupyter lab 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--clear', action='store_true')
-parser.add_argument('--quiet', action='store_false')
-args = parser.parse_args()
-clear = args.clear
-verbose = args.quiet
+# raw file -> hash and exp_id of the files already cleaned
+MANIFEST_FILE = '../behavioral_data/processed/raw_manifest.json'
 
-# if clear delete files first
-if clear:
-    if verbose: print("Clearing Data")
-    file_dir = os.path.dirname(__file__)
-    for f in glob(os.path.join(file_dir, '../behavioral_data/processed/*csv')):
-        os.remove(f)
-    for f in glob(os.path.join(file_dir, '../behavioral_data/event_files/*tsv')):
-        os.remove(f)
-    for f in glob(os.path.join(file_dir, '../behavioral_data/processed/group_data/*csv')):
-        os.remove(f)
+def get_file_hash(filename):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
+def get_cleaned_file_path(subj_file):
+    filey = os.path.basename(subj_file)
+    cleaned_file_name = '_cleaned.'.join(filey.split('.'))
+    return os.path.join('../behavioral_data/processed', cleaned_file_name)
+
+def get_events_file_path(subj_file):
+    filey = os.path.basename(subj_file)
+    event_file_name = '_events.'.join(filey.split('.')).replace('csv','tsv')
+    return os.path.join('../behavioral_data/event_files', event_file_name)
 
-# set up map between file names and names of tasks
-name_map = get_name_map()
+def load_manifest():
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
 
-task_dfs = defaultdict(pd.DataFrame)
+def save_manifest(manifest):
+    tmp_file = '%s.%s.tmp' % (MANIFEST_FILE, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, MANIFEST_FILE)
 
-#make directories
+def read_raw_file(subj_file):
+    """ reads a raw file with the C parser, falling back to the python 
+    parser for the files it can't parse. As with the python parser, the 
+    type of each column is inferred from the whole file (low_memory=False),
+    so mixed columns (e.g. key_press) don't hold a mix of ints and strs """
+    try:
+        return pd.read_csv(subj_file, low_memory=False)
+    except pd.errors.ParserError:
+        return pd.read_csv(subj_file, engine='python')
 
-# clean data
-if verbose: print("Processing Tasks")
-for subj_file in glob('../behavioral_data/raw/*/*'):
+def clean_file(subj_file):
+    """ cleans a raw file and saves it to its cleaned file. Returns the 
+    exp_id and cleaned data """
+    name_map = get_name_map()
     filey = os.path.basename(subj_file)
-    cleaned_file_name = '_cleaned.'.join(filey.split('.'))
-    event_file_name = '_events.'.join(filey.split('.')).replace('csv','tsv')
-    cleaned_file_path = os.path.join('../behavioral_data/processed', cleaned_file_name)
-    events_file_path = os.path.join('../behavioral_data/event_files', event_file_name)
-    # if this file has already been cleaned, continue
-    if os.path.exists(cleaned_file_path):
-        df = pd.read_csv(cleaned_file_path)
-        exp_id = df.experiment_exp_id.unique()[0] #gets the value of experiment_exp_id, and assigns it to exp_id
+    cleaned_file_path = get_cleaned_file_path(subj_file)
+    df = read_raw_file(subj_file)
+    
+    # get exp_id
+    if 'exp_id' in df.columns:
+        exp_id = df.iloc[-2].exp_id 
     else:
-        # else proceed
-        df = pd.read_csv(subj_file, engine='python')
+        exp_id = '_'.join(os.path.basename(subj_file).split('_')[1:]).rstrip('.csv')
+    if (exp_id == 'manipulationTask') | (exp_id == 'cue_control_food'): #fixes formatting for manip 
+        exp_id = 'manipulation_task'
         
-         # get exp_id
-        if 'exp_id' in df.columns:
-            exp_id = df.iloc[-2].exp_id 
-        else:
-            exp_id = '_'.join(os.path.basename(subj_file).split('_')[1:]).rstrip('.csv')
-        if (exp_id == 'manipulationTask') | (exp_id == 'cue_control_food'): #fixes formatting for manip 
-            exp_id = 'manipulation_task'
-            
-        #fixes difference in rest scanner input 
-        if (exp_id == 'rest') | (exp_id == 'uh2_video') | (exp_id == 'manipulation_task'): 
-            df = df.replace(to_replace='scanner_wait', value = 'fmri_trigger_wait', regex=True)
-            
-        # set time_elapsed in reference to the last trigger of internal calibration
-        print(filey, exp_id)
-        start_time = df.query('trial_id == "fmri_trigger_wait"').iloc[-1]['time_elapsed'] 
-        df.time_elapsed-=start_time 
+    #fixes difference in rest scanner input 
+    if (exp_id == 'rest') | (exp_id == 'uh2_video') | (exp_id == 'manipulation_task'): 
+        df = df.replace(to_replace='scanner_wait', value = 'fmri_trigger_wait', regex=True)
         
-        # correct start time for problematic scans
-        df.time_elapsed-=get_timing_correction(filey)
-       
-        # make sure the file name matches the actual experiment
-        assert name_map[exp_id] in subj_file, \
-          print('file %s does not match exp_id: %s' % (subj_file, exp_id))
-        if exp_id == 'columbia_card_task_hot':
-            exp_id = 'columbia_card_task_fmri'
-        df.loc[:,'experiment_exp_id'] = exp_id
-        # make sure there is a subject column
-        if 'subject' not in df.columns:
-            print('Added subject column for file: %s' % filey)
-            df.loc[:,'subject'] = filey.split('_')[0]
-        # change column from subject to worker_id
-        df.rename(columns={'subject':'worker_id'}, inplace=True)
-        # post process data, drop rows, etc.....
-        drop_columns = ['view_history', 'stimulus', 'trial_index',
-                        'internal_node_id', 'test_start_block','exp_id',
-                        'trigger_times']
-        df = clean_data(df, exp_id=exp_id, drop_columns=drop_columns)
-        # drop unnecessary rows
-        drop_dict = {'trial_type': ['text'],
-                     'trial_id': ['fmri_response_test', 'fmri_scanner_wait',
-                                  'fmri_trigger_wait', 'fmri_buffer', 'scanner_wait', 'scanner_rest', 
-                                  'end']}
-        for row, vals in drop_dict.items():
-            df = df.query('%s not in  %s' % (row, vals))
-        df.to_csv(cleaned_file_path, index=False)
-    task_dfs[exp_id] = pd.concat([task_dfs[exp_id], df], axis=0)
-if verbose: print("Saving Group Data")
-
-# save group behavior
-for task,df in task_dfs.items():
-    df.to_csv('../behavioral_data/processed/group_data/%s.csv' % task, index=False)
-# get 50th percentile reaction time for events files:
-task_50th_rts = get_median_rts(task_dfs)
-
-if verbose: print("Creating Event Files")
-# calculate event files
-for subj_file in glob('../behavioral_data/raw/*/*.csv'):
-    filey = os.path.basename(subj_file)
-    cleaned_file_name = '_cleaned.'.join(filey.split('.'))
-    event_file_name = '_events.'.join(filey.split('.')).replace('csv','tsv')
-    cleaned_file_path = os.path.join('../behavioral_data/processed', cleaned_file_name)
-    events_file_path = os.path.join('../behavioral_data/event_files', event_file_name)
-
-  # get & save cleaned file
-    df = pd.read_csv(cleaned_file_path)
-    exp_id = df.experiment_exp_id.unique()[0]
-    task_rt = task_50th_rts[exp_id]
-    if not os.path.exists(events_file_path):
-        # create event file for task contrasts
-        events_df = create_events(df, exp_id, duration=task_rt)
-        if events_df is not None:
-            events_df.to_csv(events_file_path, sep='\t', index=False)
+    # set time_elapsed in reference to the last trigger of internal calibration
+    print(filey, exp_id)
+    start_time = df.query('trial_id == "fmri_trigger_wait"').iloc[-1]['time_elapsed'] 
+    df.time_elapsed-=start_time 
+    
+    # correct start time for problematic scans
+    df.time_elapsed-=get_timing_correction(filey)
+   
+    # make sure the file name matches the actual experiment
+    assert name_map[exp_id] in subj_file, \
+      print('file %s does not match exp_id: %s' % (subj_file, exp_id))
+    if exp_id == 'columbia_card_task_hot':
+        exp_id = 'columbia_card_task_fmri'
+    df.loc[:,'experiment_exp_id'] = exp_id
+    # make sure there is a subject column
+    if 'subject' not in df.columns:
+        print('Added subject column for file: %s' % filey)
+        df.loc[:,'subject'] = filey.split('_')[0]
+    # change column from subject to worker_id
+    df.rename(columns={'subject':'worker_id'}, inplace=True)
+    # post process data, drop rows, etc.....
+    drop_columns = ['view_history', 'stimulus', 'trial_index',
+                    'internal_node_id', 'test_start_block','exp_id',
+                    'trigger_times']
+    df = clean_data(df, exp_id=exp_id, drop_columns=drop_columns)
+    # drop unnecessary rows
+    drop_dict = {'trial_type': ['text'],
+                 'trial_id': ['fmri_response_test', 'fmri_scanner_wait',
+                              'fmri_trigger_wait', 'fmri_buffer', 'scanner_wait', 'scanner_rest', 
+                              'end']}
+    for row, vals in drop_dict.items():
+        df = df.query('%s not in  %s' % (row, vals))
+    # written under a temporary name so an interrupted run leaves no partial file
+    tmp_file = '%s.%s.tmp' % (cleaned_file_path, os.getpid())
+    df.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, cleaned_file_path)
+    return exp_id, df
+
+def read_cleaned_file(subj_file):
+    df = pd.read_csv(get_cleaned_file_path(subj_file))
+    exp_id = df.experiment_exp_id.unique()[0] #gets the value of experiment_exp_id, and assigns it to exp_id
+    return exp_id, df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clear', action='store_true')
+    parser.add_argument('--quiet', action='store_false')
+    parser.add_argument('--num_cores', default=None, type=int)
+    args = parser.parse_args()
+    clear = args.clear
+    verbose = args.quiet
+
+    # if clear delete files first
+    if clear:
+        if verbose: print("Clearing Data")
+        file_dir = os.path.dirname(__file__)
+        for f in glob(os.path.join(file_dir, '../behavioral_data/processed/*csv')):
+            os.remove(f)
+        for f in glob(os.path.join(file_dir, '../behavioral_data/event_files/*tsv')):
+            os.remove(f)
+        for f in glob(os.path.join(file_dir, '../behavioral_data/processed/group_data/*csv')):
+            os.remove(f)
+        if os.path.exists(MANIFEST_FILE):
+            os.remove(MANIFEST_FILE)
+
+    # clean data
+    # files whose raw hash is in the manifest (or, for files cleaned before the
+    # manifest existed, that have a cleaned file) are read from their cleaned file
+    if verbose: print("Processing Tasks")
+    manifest = load_manifest()
+    subj_files = sorted(glob('../behavioral_data/raw/*/*'))
+    raw_hashes = {subj_file: get_file_hash(subj_file) for subj_file in subj_files}
+    to_clean, cleaned = [], []
+    for subj_file in subj_files:
+        entry = manifest.get(subj_file)
+        if entry is None:
+            up_to_date = os.path.exists(get_cleaned_file_path(subj_file))
         else:
-            print("Events file wasn't created for %s" % subj_file)
+            up_to_date = (entry['hash'] == raw_hashes[subj_file] and 
+                          os.path.exists(get_cleaned_file_path(subj_file)))
+            # events of a changed raw file are recreated from its new cleaned file
+            if entry['hash'] != raw_hashes[subj_file] and os.path.exists(get_events_file_path(subj_file)):
+                os.remove(get_events_file_path(subj_file))
+        (cleaned if up_to_date else to_clean).append(subj_file)
+
+    cleaned_dfs = {}
+    with ProcessPoolExecutor(max_workers=args.num_cores) as executor:
+        for subj_file, result in zip(to_clean, executor.map(clean_file, to_clean, chunksize=4)):
+            cleaned_dfs[subj_file] = result
+            manifest[subj_file] = {'hash': raw_hashes[subj_file], 'exp_id': result[0]}
+        for subj_file, result in zip(cleaned, executor.map(read_cleaned_file, cleaned, chunksize=16)):
+            cleaned_dfs[subj_file] = result
+            manifest[subj_file] = {'hash': raw_hashes[subj_file], 'exp_id': result[0]}
+    save_manifest(manifest)
+
+    # collect each task's frames and concatenate them once
+    task_frames = defaultdict(list)
+    for subj_file in subj_files:
+        exp_id, df = cleaned_dfs[subj_file]
+        task_frames[exp_id].append(df)
+    task_dfs = defaultdict(pd.DataFrame)
+    for exp_id, frames in task_frames.items():
+        task_dfs[exp_id] = pd.concat(frames, axis=0)
+    if verbose: print("Saving Group Data")
+
+    # save group behavior
+    for task,df in task_dfs.items():
+        df.to_csv('../behavioral_data/processed/group_data/%s.csv' % task, index=False)
+    # get 50th percentile reaction time for events files:
+    task_50th_rts = get_median_rts(task_dfs)
+
+    if verbose: print("Creating Event Files")
+    # calculate event files
+    for subj_file in glob('../behavioral_data/raw/*/*.csv'):
+        events_file_path = get_events_file_path(subj_file)
+
+        exp_id = cleaned_dfs[subj_file][0]
+        task_rt = task_50th_rts[exp_id]
+        if not os.path.exists(events_file_path):
+            # get cleaned file
+            df = pd.read_csv(get_cleaned_file_path(subj_file))
+            # create event file for task contrasts
+            events_df = create_events(df, exp_id, duration=task_rt)
+            if events_df is not None:
+                events_df.to_csv(events_file_path, sep='\t', index=False)
+            else:
+                print("Events file wasn't created for %s" % subj_file)
 
-if verbose: print("Finished Processing")
+    if verbose: print("Finished Processing")
@@ -17,10 +17,15 @@ from pathlib import Path
 import pickle
 import sys
 import nibabel as nib
-from nistats.first_level_model import FirstLevelModel
 import warnings
 from utils.firstlevel_plot_utils import plot_design
-from utils.firstlevel_utils import get_first_level_objs, make_first_level_obj, save_first_level_obj
+from utils.catalog_utils import get_catalog
+from utils.firstlevel_utils import (get_first_level_objs, get_func_file, get_input_manifest,
+                                    get_lss_file, get_manifest_file, get_model_settings, 
+                                    is_up_to_date, run_first_level, run_first_level_models, 
+                                    set_manifest_settings, write_manifest)
+from utils.scheduler_utils import estimate_bold_memory, get_memory_limit, run_jobs
+from utils.utils import get_flags, get_model_flags, parse_model_flags
 
 
 # ### Parse Arguments
@@ -38,13 +43,38 @@ parser.add_argument('-derivatives_dir', default=None)
 parser.add_argument('-fmriprep_dir', default=None)
 parser.add_argument('-working_dir', default=None)
 parser.add_argument('--subject_ids', nargs="+")
-parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix,                                     DPX, motorSelectiveStop, stopSignal,                                     stroop, surveyMedley, twoByTwo, WATT3")
+parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix, \
+                                    DPX, motorSelectiveStop, stopSignal, \
+                                    stroop, surveyMedley, twoByTwo, WATT3")
 parser.add_argument('--rt', action='store_true')
 parser.add_argument('--beta', action='store_true')
+parser.add_argument('--lss', action='store_true', 
+                    help="With --beta, estimate a least squares separate beta series instead of one model")
+parser.add_argument('--models', nargs="+", 
+                    help="Fit several model variants from one read of the data, e.g. RT-True_beta-False RT-False_beta-True_aCompCor-False. Overrides --rt, --beta and --lss")
 parser.add_argument('--n_procs', default=16, type=int)
-parser.add_argument('--overwrite', action='store_true')
+parser.add_argument('--mem_limit', default=None, type=float, 
+                    help="Memory (GB) available to all jobs. Defaults to the SLURM allocation or 90%% of node memory")
+parser.add_argument('--mem_per_job', default=None, type=float, 
+                    help="Expected memory (GB) of each fit. Defaults to an estimate from the bold header")
+parser.add_argument('--overwrite', action='store_true', 
+                    help="Refit every model, even if its inputs and settings are unchanged")
+parser.add_argument('--adopt_outputs', action='store_true', 
+                    help="Record manifests for existing outputs that have none instead of refitting them")
+parser.add_argument('--solver', default='nistats', choices=['nistats', 'native'],
+                    help="GLM solver. 'native' fits voxels in chunks and only keeps compact results")
+parser.add_argument('--chunk_size', default=10000, type=int, 
+                    help="Number of voxels fit at once by the native solver")
+parser.add_argument('--memmap_bold', action='store_true', 
+                    help="Convert each bold file to a masked, uncompressed array when it is first fit, and read it by memory mapping")
+parser.add_argument('--design_engine', default='nistats', choices=['nistats', 'fast'],
+                    help="Design matrix builder. 'fast' convolves all conditions at once")
+parser.add_argument('--no_catalog', action='store_true', 
+                    help="Glob for files instead of using the cached file catalog")
 parser.add_argument('--quiet', '-q', action='store_true')
-parser.add_argument('--a_comp_cor', action='store_true')
+parser.add_argument('--a_comp_cor', action='store_true', default=True)
+parser.add_argument('--no_a_comp_cor', action='store_false', dest='a_comp_cor',
+                    help="Leave the aCompCor components out of the confounds")
 
 if '-derivatives_dir' in sys.argv or '-h' in sys.argv:
     args = parser.parse_args()
@@ -69,7 +99,7 @@ else:
 
 # In[ ]:
 
-a_comp_cor = False
+
 if not args.quiet:
     def verboseprint(*args, **kwargs):
         print(*args, **kwargs)
@@ -109,16 +139,42 @@ else:
                   'stroop', 'twoByTwo', 'WATT3']
     '''
 
+# index of data, fmriprep and 1stlevel files, revalidated against directory mtimes
+if args.no_catalog:
+    catalog = None
+else:
+    catalog = get_catalog(bids_dirs=[data_dir, fmriprep_dir], other_dirs=[first_level_dir],
+                          cache_file=join(working_dir, 'file_catalog.json'), 
+                          verbose=not args.quiet)
+
 # list of subject identifiers
 if not args.subject_ids:
-    subjects = sorted([i.split("-")[-1] for i in glob(os.path.join(args.data_dir, '*')) if 'sub-' in i])
+    if catalog is not None:
+        subjects = catalog.subjects(root=data_dir)
+    else:
+        subjects = sorted([i.split("-")[-1] for i in glob(os.path.join(args.data_dir, '*')) if 'sub-' in i])
 else:
     subjects = args.subject_ids
     
 # other arguments
 regress_rt = args.rt
 beta_series = args.beta
+a_comp_cor = args.a_comp_cor
+lss = args.lss and beta_series
+# (regress_rt, beta, a_comp_cor) of each variant in multi-model mode
+if args.models:
+    models = [parse_model_flags(flags) for flags in args.models]
+else:
+    models = None
 n_procs = args.n_procs
+if args.memmap_bold:
+    bold_cache_dir = join(working_dir, 'cache', 'bold')
+else:
+    bold_cache_dir = None
+if args.mem_limit is None:
+    mem_limit = get_memory_limit()
+else:
+    mem_limit = int(args.mem_limit * 1024**3)
 # TR of functional images
 TR = .68
 
@@ -137,55 +193,119 @@ verboseprint('*'*79)
 
 # ### Run analysis
 # 
-# gather the files for each task within each subject
+# gather the files for each task within each subject. Jobs are generated lazily, so the first fit starts as soon as its files are found and each model is released once it is saved
+# 
+# each output has a manifest of the fingerprints of its bold, mask, events and confounds files and of its model settings. A model is only refit if its output is missing or its manifest differs
 # 
 
 # In[ ]:
 
 
-to_run = []
-for subject_id in subjects:
-    for task in tasks:
-        verboseprint('Setting up %s, %s' % (subject_id, task))
-        files = get_first_level_objs(subject_id, task, first_level_dir, regress_rt=regress_rt)
-        if len(files) == 0 or args.overwrite:
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore",category=DeprecationWarning)
-                warnings.filterwarnings("ignore",category=UserWarning)
-                subjinfo = make_first_level_obj(subject_id, task, fmriprep_dir, 
-                                                data_dir, TR, regress_rt=regress_rt, a_comp_cor=a_comp_cor)
-            if subjinfo is not None:
-                to_run.append(subjinfo)
+def needs_fit(subject_id, task, output_files, flags, manifest):
+    """ whether a model must be fit, given its existing output files and its
+    current manifest. With adopt_outputs, outputs without a manifest are
+    taken as current and their manifest is written """
+    if args.overwrite or len(output_files) == 0:
+        return True
+    manifest_file = get_manifest_file(subject_id, task, first_level_dir, flags)
+    if args.adopt_outputs and not os.path.exists(manifest_file):
+        write_manifest(manifest, manifest_file)
+        return False
+    return not is_up_to_date(manifest_file, manifest)
+
+
+def iter_run_jobs(get_run_job):
+    """ yields the (args, kwargs, memory) job of each run whose files exist. 
+    get_run_job(subject_id, task, run_manifest) returns the run's own job 
+    args and kwargs, or None if its outputs are up to date. run_manifest has 
+    the run's input fingerprints, without model settings """
+    for subject_id in subjects:
+        for task in tasks:
+            verboseprint('Setting up %s, %s' % (subject_id, task))
+            run_manifest = get_input_manifest(subject_id, task, fmriprep_dir, data_dir, {},
+                                              catalog=catalog)
+            if run_manifest is None:
+                print("Missing files for %s: %s" % (subject_id, task))
+                continue
+            run_job = get_run_job(subject_id, task, run_manifest)
+            if run_job is None:
+                continue
+            func_file = run_manifest['inputs']['func']['file']
+            if args.mem_per_job is None:
+                mem = estimate_bold_memory(func_file)
+            else:
+                mem = int(args.mem_per_job * 1024**3)
+            run_args, run_kwargs = run_job
+            job_args = (subject_id, task, fmriprep_dir, data_dir, first_level_dir, TR) + run_args
+            job_kwargs = dict(run_kwargs,
+                              catalog=catalog,
+                              cache_dir=join(working_dir, 'cache'),
+                              design_engine=args.design_engine,
+                              chunk_size=args.chunk_size,
+                              bold_cache_dir=bold_cache_dir,
+                              verbose=not args.quiet)
+            yield job_args, job_kwargs, mem
+
+
+def get_model_job(subject_id, task, run_manifest):
+    manifest = set_manifest_settings(run_manifest, 
+                                     get_model_settings(task, TR, regress_rt=regress_rt, 
+                                                        beta=beta_series, 
+                                                        a_comp_cor=a_comp_cor, lss=lss))
+    if lss:
+        files = glob(get_lss_file(subject_id, task, first_level_dir, regress_rt))
+        flags = 'LSS_%s' % get_flags(regress_rt)[0]
+    else:
+        files = get_first_level_objs(subject_id, task, first_level_dir, 
+                                     regress_rt=regress_rt, beta=beta_series,
+                                     a_comp_cor=a_comp_cor, catalog=catalog)
+        flags = get_model_flags(regress_rt, beta_series, a_comp_cor)
+    if not needs_fit(subject_id, task, files, flags, manifest):
+        return None
+    return (), {'regress_rt': regress_rt, 
+                'beta': beta_series, 
+                'a_comp_cor': a_comp_cor,
+                'lss': lss,
+                'solver': args.solver,
+                'manifest': manifest}
+
+
+def get_models_job(subject_id, task, run_manifest):
+    # the variants whose outputs are missing or stale
+    missing, manifests = [], []
+    for model in models:
+        manifest = set_manifest_settings(run_manifest, get_model_settings(task, TR, *model))
+        files = get_first_level_objs(subject_id, task, first_level_dir, 
+                                     regress_rt=model[0], beta=model[1],
+                                     a_comp_cor=model[2], catalog=catalog)
+        if needs_fit(subject_id, task, files, get_model_flags(*model), manifest):
+            missing.append(model)
+            manifests.append(manifest)
+    if len(missing) == 0:
+        return None
+    return (missing,), {'manifests': manifests}
 
 
 # ### Run model fit
 # 
-# generate the glm and fit the timeseries data to it
+# generate the glm and fit the timeseries data to it. Each job builds the design, fits the model and saves the contrast maps in a worker process. Jobs are only started while their expected memory fits in mem_limit, and only one job per free worker is set up ahead of time
 
 # In[ ]:
 
 
-for subjinfo in to_run:
-    verboseprint(subjinfo.ID)
-    verboseprint('** fitting model')
-    fmri_glm = FirstLevelModel(TR, 
-                           subject_label = subjinfo.ID,
-                           mask=subjinfo.mask,
-                           noise_model='ar1',
-                           standardize=False, 
-                           hrf_model='spm',
-                           drift_model='cosine',
-                           period_cut=80,
-                           n_jobs=1
-                          )
-    out = fmri_glm.fit(subjinfo.func, design_matrices=subjinfo.design)
-    
-    subjinfo.fit_model = out
+verboseprint('Running jobs on %s processes' % n_procs)
+n_finished = 0
+if models is None:
+    finished = run_jobs(run_first_level, iter_run_jobs(get_model_job), n_procs=n_procs, mem_limit=mem_limit)
+else:
+    # each job fits every missing variant of one subject and task
+    finished = run_jobs(run_first_level_models, iter_run_jobs(get_models_job), n_procs=n_procs, mem_limit=mem_limit)
+for ID in finished:
+    if ID:
+        n_finished += 1
+        verboseprint('** finished %s (%s done)' % (ID, n_finished))
+
 
-    verboseprint('** saving')
-    save_first_level_obj(subjinfo, first_level_dir, True)
-    subjinfo.export_design(first_level_dir)
-    subjinfo.export_events(first_level_dir)
 # In[ ]:
 
 
@@ -3,20 +3,33 @@
 
 # In[ ]:
 
+
 import argparse
 from glob import glob
-from os import path
+from os import makedirs, path
+import matplotlib.pyplot as plt
 import sys
 
+from nilearn import masking
 from nilearn.decomposition import CanICA
+from utils.bold_utils import get_bold_img, load_masked_bold
+from utils.firstlevel_plot_utils import plot_carpet
+from utils.firstlevel_utils import get_func_file
 
 
 # In[ ]:
 
+
 parser = argparse.ArgumentParser(description='First Level Inspection Entrypoint script')
 parser.add_argument('-derivatives_dir', default=None)
-parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix,                                     DPX, motorSelectiveStop, stopSignal,                                     stroop, surveyMedley, twoByTwo, WATT3")
+parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix, \
+                                    DPX, motorSelectiveStop, stopSignal, \
+                                    stroop, surveyMedley, twoByTwo, WATT3")
+parser.add_argument('-working_dir', default=None)
 parser.add_argument('-n_procs', default=1, type=int)
+parser.add_argument('--memmap_bold', action='store_true', 
+                    help="Read bold data from the masked arrays converted by 1stlevel_analysis")
+parser.add_argument('--carpet', action='store_true', help="Save a carpet plot of each bold file")
 if '-derivatives_dir' in sys.argv or '-h' in sys.argv:
     args = parser.parse_args()
 else:
@@ -28,8 +41,14 @@ else:
 
 # In[ ]:
 
+
 fmriprep_dir = path.join(args.derivatives_dir, 'fmriprep', 'fmriprep')
 first_level_dir = path.join(args.derivatives_dir,'1stlevel')
+if args.working_dir is None:
+    working_dir = path.join(args.derivatives_dir, '1stlevel_workingdir')
+else:
+    working_dir = path.join(args.working_dir, '1stlevel_workingdir')
+bold_cache_dir = path.join(working_dir, 'cache', 'bold')
 # set tasks
 if args.tasks is not None:
     tasks = args.tasks
@@ -39,18 +58,58 @@ else:
             'stopSignal', 'stroop',
             'twoByTwo', 'WATT3']
 n_comps = 20
+TR = .68
+
+
+# In[ ]:
+
+
+def get_task_files(task):
+    """ returns the (func, mask) files of every subject with the task """
+    subjects = sorted(path.basename(d)[4:] for d in glob(path.join(fmriprep_dir, 'sub-*'))
+                      if path.isdir(d))
+    files = [get_func_file(fmriprep_dir, subject_id, task) for subject_id in subjects]
+    return [(func_file, mask_file) for func_file, mask_file in files 
+            if func_file is not None and mask_file is not None]
 
 
 # # Run Canonical ICA
 
 # In[ ]:
 
+
 for task in tasks:
-    func_filenames = glob(path.join(fmriprep_dir, '*', '*', 'func', '*%s*MNI*preproc.nii.gz' % task))
+    task_files = get_task_files(task)
+    if args.memmap_bold:
+        # images backed by the memory mapped arrays, which avoids decompressing each file
+        func_filenames = [get_bold_img(func_file, mask_file, bold_cache_dir) 
+                          for func_file, mask_file in task_files]
+    else:
+        func_filenames = [func_file for func_file, mask_file in task_files]
     canica = CanICA(n_components=n_comps, smoothing_fwhm=6.,
                     threshold=3., verbose=10, random_state=0,
                     n_jobs=args.n_procs)
     canica.fit(func_filenames)
     components_img = canica.components_img_
-    components_img.to_filename(path.join(first_level_dir, '%s_canica_NComp-%s.nii.gz' % (task, str(n_comps)))
+    components_img.to_filename(path.join(first_level_dir, '%s_canica_NComp-%s.nii.gz' % (task, str(n_comps))))
+
+
+# # QC carpet plots
+
+# In[ ]:
+
+
+if args.carpet:
+    for task in tasks:
+        for func_file, mask_file in get_task_files(task):
+            subject_id = path.basename(func_file).split('_')[0][4:]
+            if args.memmap_bold:
+                bold_data = load_masked_bold(func_file, mask_file, bold_cache_dir)
+            else:
+                bold_data = masking.apply_mask(func_file, mask_file)
+            f = plot_carpet(bold_data, TR=TR, title='%s_%s' % (subject_id, task))
+            qc_dir = path.join(first_level_dir, subject_id, task, 'qc')
+            makedirs(qc_dir, exist_ok=True)
+            f.savefig(path.join(qc_dir, 'carpet.png'))
+            plt.close(f)
 
@@ -7,18 +7,24 @@
 import argparse
 from glob import glob
 from os import makedirs, path
+import numpy as np
 import pandas as pd
 import pickle
 import sys
 
 from nistats.second_level_model import SecondLevelModel
 from nistats.thresholding import map_threshold
-from nilearn import plotting
+from nilearn import image, masking, plotting
 from utils.firstlevel_utils import (get_first_level_objs, 
                                     get_first_level_maps, 
                                     load_first_level_objs, 
                                     FirstLevel)
-from utils.secondlevel_utils import create_group_mask, randomise
+from utils.catalog_utils import get_catalog
+from utils.scheduler_utils import run_jobs
+from utils.stack_utils import get_contrast_stack_dir
+from utils.secondlevel_utils import (collect_job_metadata, create_group_masks, 
+                                     estimate_contrast_job_memory, estimate_task_job_memory, 
+                                     run_contrast_job, run_task_job)
 from utils.utils import get_contrasts, get_flags
 
 
@@ -33,11 +39,22 @@ from utils.utils import get_contrasts, get_flags
 
 parser = argparse.ArgumentParser(description='2nd level Entrypoint Script.')
 parser.add_argument('-derivatives_dir', default=None)
-parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix,                                     DPX, motorSelectiveStop, stopSignal,                                     stroop, surveyMedley, twoByTwo, WATT3")
+parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix, \
+                                    DPX, motorSelectiveStop, stopSignal, \
+                                    stroop, surveyMedley, twoByTwo, WATT3")
 parser.add_argument('--rerun', action='store_true')
 parser.add_argument('--rt', action='store_true')
 parser.add_argument('--beta', action='store_true')
 parser.add_argument('--n_perms', default=1000, type=int)
+parser.add_argument('--group_engine', default='nistats', choices=['nistats', 'fast'],
+                    help="'fast' loads and smooths each subject's maps once and tests all contrasts of a task together")
+parser.add_argument('--randomise_engine', default='fsl', choices=['fsl', 'native'],
+                    help="'native' runs sign-flipping permutations with TFCE in numpy instead of FSL randomise")
+parser.add_argument('--n_procs', default=1, type=int)
+parser.add_argument('--covariates', default=None,
+                    help="tab separated table of subject covariates (e.g. DVs, age, mean FD) with a subject_id column matching the 1stlevel directories")
+parser.add_argument('--group_contrasts', nargs="+", default=None,
+                    help="contrasts of the covariate design, e.g. intercept age age-FD. Defaults to every column")
 parser.add_argument('--quiet', '-q', action='store_true')
 
 if '-derivatives_dir' in sys.argv or '-h' in sys.argv:
@@ -85,6 +102,14 @@ else:
 regress_rt = args.rt
 beta_series = args.beta
 n_perms = args.n_perms
+if args.covariates is not None:
+    covariates = pd.read_csv(args.covariates, sep='\t', index_col='subject_id')
+    covariates.index = covariates.index.astype(str)
+    group_contrasts = None
+    if args.group_contrasts is not None:
+        group_contrasts = [(contrast, contrast) for contrast in args.group_contrasts]
+else:
+    covariates = group_contrasts = None
 
 
 # ### Create Mask
@@ -93,12 +118,19 @@ n_perms = args.n_perms
 
 
 mask_threshold = .95
+mask_thresholds = (.8, .95)
 mask_loc = path.join(second_level_dir, 'group_mask_thresh-%s.nii.gz' % str(mask_threshold))
+# voxel counts over all brain masks so far. Only new subjects' masks are read on reruns
+mask_counts_loc = path.join(args.derivatives_dir, '2ndlevel_workingdir', 'group_mask_counts.nii.gz')
 if path.exists(mask_loc) == False or args.rerun:
     verboseprint('Making group mask')
-    group_mask = create_group_mask(fmriprep_dir, mask_threshold)
+    catalog = get_catalog(bids_dirs=[fmriprep_dir],
+                          cache_file=path.join(args.derivatives_dir, '2ndlevel_workingdir', 'file_catalog.json'))
+    group_masks = create_group_masks(fmriprep_dir, mask_counts_loc, mask_thresholds,
+                                     verbose=not args.quiet, catalog=catalog)
     makedirs(path.dirname(mask_loc), exist_ok=True)
-    group_mask.to_filename(mask_loc)
+    for threshold, group_mask in group_masks.items():
+        group_mask.to_filename(path.join(second_level_dir, 'group_mask_thresh-%s.nii.gz' % str(threshold)))
 
 
 # ### Create second level objects
@@ -107,40 +139,68 @@ if path.exists(mask_loc) == False or args.rerun:
 # In[ ]:
 
 
+# Every task and contrast is a job: the tasks compute the fast group maps and 
+# native randomise of all their contrasts at once, the contrasts compute nistats
+# maps and FSL randomise. The task jobs run first, then the contrast jobs. Each job
+# writes its own files, so the jobs of each stage finish in any order.
+# Task jobs read subject maps from the task's contrast stack, which only adds new maps,
+# and fit the covariate design, if any, to all contrasts at once
 rt_flag, beta_flag = get_flags(regress_rt, beta_series)
-for task in tasks:
-    verboseprint('Running 2nd level for %s' % task)
-    # load first level models
-    # create contrast maps
-    verboseprint('*** Creating maps')
-    task_contrasts = get_contrasts(task, regress_rt)
-    maps_dir = path.join(second_level_dir, task, 'secondlevel-%s_%s_maps' % (rt_flag, beta_flag))
+native_randomise = n_perms > 0 and args.randomise_engine == 'native'
+task_contrasts = {task: get_contrasts(task, regress_rt) for task in tasks}
+maps_dirs = {task: path.join(second_level_dir, task, 'secondlevel-%s_%s_maps' % (rt_flag, beta_flag))
+             for task in tasks}
+for maps_dir in maps_dirs.values():
     makedirs(maps_dir, exist_ok=True)
-    # run through each contrast
-    for name, contrast in task_contrasts:
-        second_level_model = SecondLevelModel(mask=mask_loc, smoothing_fwhm=6)
-        maps = get_first_level_maps('*', task, first_level_dir, name, regress_rt, beta_series)
-        N = str(len(maps)).zfill(2)
-        verboseprint('****** %s, %s files found' % (name, N))
-        if len(maps) <= 1:
-            verboseprint('****** No Maps')
-            continue
-        design_matrix = pd.DataFrame([1] * len(maps), columns=['intercept'])
-        second_level_model.fit(maps, design_matrix=design_matrix)
-        contrast_map = second_level_model.compute_contrast()
-        # save
-        contrast_file = path.join(maps_dir, 'contrast-%s.nii.gz' % name)
-        contrast_map.to_filename(contrast_file)
-         # write metadata
-        with open(path.join(maps_dir, 'metadata.txt'), 'a') as f:
-            f.write('Contrast-%s: %s maps\n' % (contrast, N))
-        # save corrected map
-        if n_perms > 0:
-            verboseprint('*** Running Randomise')
-            randomise(maps, maps_dir, mask_loc, n_perms=n_perms)
-            # write metadata
-            with open(path.join(maps_dir, 'metadata.txt'), 'a') as f:
-                f.write('Contrast-%s: Randomise run with %s permutations\n' % (contrast, str(n_perms)))
+
+# the task jobs run on their own share of n_procs, and native randomise splits the
+# permutations of a task job over its share, counting the job's own process, so at
+# most n_procs processes run
+n_task_procs = min(len(tasks), args.n_procs)
+n_jobs = args.n_procs // n_task_procs
+if covariates is None:
+    n_group_contrasts = 0
+elif group_contrasts is None:
+    # every covariate and the intercept
+    n_group_contrasts = covariates.shape[1] + 1
+else:
+    n_group_contrasts = len(group_contrasts)
+
+def iter_task_jobs():
+    if args.group_engine == 'fast' or native_randomise or covariates is not None:
+        for task in tasks:
+            task_n_perms = n_perms if native_randomise else 0
+            mem = estimate_task_job_memory(task, task_contrasts[task], first_level_dir, 
+                                           mask_loc, regress_rt, beta_series, 
+                                           n_perms=task_n_perms, n_jobs=n_jobs,
+                                           n_group_contrasts=n_group_contrasts)
+            yield ((task, task_contrasts[task], first_level_dir, 
+                    maps_dirs[task], mask_loc),
+                   {'regress_rt': regress_rt, 'beta': beta_series, 
+                    'group_engine': args.group_engine, 
+                    'n_perms': task_n_perms, 'n_jobs': n_jobs,
+                    'stack_dir': get_contrast_stack_dir(second_level_dir, task, 
+                                                        '%s_%s' % (rt_flag, beta_flag)),
+                    'covariates': covariates, 'group_contrasts': group_contrasts}, mem)
+
+def iter_contrast_jobs():
+    for task in tasks:
+        for name, contrast in task_contrasts[task]:
+            mem = estimate_contrast_job_memory(task, name, first_level_dir, mask_loc, 
+                                               regress_rt, beta_series)
+            yield ((task, name, contrast, first_level_dir, 
+                    maps_dirs[task], mask_loc),
+                   {'regress_rt': regress_rt, 'beta': beta_series, 
+                    'group_engine': args.group_engine, 
+                    'randomise_engine': args.randomise_engine, 'n_perms': n_perms}, mem)
+
+verboseprint('Running 2nd level for %s on %s processes' % (', '.join(tasks), args.n_procs))
+for task in run_jobs(run_task_job, iter_task_jobs(), n_procs=n_task_procs):
+    verboseprint('*** Finished group maps of %s' % task)
+for task, name, n_maps in run_jobs(run_contrast_job, iter_contrast_jobs(), n_procs=args.n_procs):
+    verboseprint('****** %s %s, %s files found' % (task, name, str(n_maps).zfill(2)))
+for task in tasks:
+    collect_job_metadata(maps_dirs[task], ['contrast-%s' % name for name, contrast in task_contrasts[task]])
     verboseprint('Done with %s' % task)
 
 
@@ -0,0 +1,140 @@
+"""
+uncompressed, masked copies of preprocessed bold files that can be memory mapped
+"""
+import json
+import os
+from os import makedirs, path
+import nibabel as nib
+import numpy as np
+from utils.glm_utils import load_masked_data
+from utils.utils import get_file_hash
+
+# ********************************************************
+# helper functions
+# ********************************************************
+def get_masked_bold_file(func_file, cache_dir):
+    """ returns the .npy file a bold file is converted to in cache_dir """
+    name = path.basename(func_file).split('.')[0]
+    return path.join(cache_dir, '%s_masked.npy' % name)
+
+def _get_source_info(func_file, mask_file):
+    """ describes the inputs of a conversion, to tell when it is stale """
+    stat = os.stat(func_file)
+    return {'func': path.abspath(func_file),
+            'func_size': stat.st_size,
+            'func_mtime': stat.st_mtime,
+            'mask': path.abspath(mask_file),
+            'mask_hash': get_file_hash(mask_file)}
+
+def _read_sidecar(bold_file):
+    sidecar = bold_file.replace('.npy', '.json')
+    if not path.exists(bold_file) or not path.exists(sidecar):
+        return None
+    with open(sidecar) as f:
+        return json.load(f)
+
+def is_current(bold_file, func_file, mask_file):
+    """ whether bold_file was converted from the current func and mask files """
+    sidecar = _read_sidecar(bold_file)
+    if sidecar is None:
+        return False
+    return sidecar['source'] == _get_source_info(func_file, mask_file)
+
+# ********************************************************
+# Conversion
+# ********************************************************
+def convert_bold(func_file, mask_file, cache_dir, n_volumes=50, overwrite=False):
+    """
+    writes the in-mask voxels of func_file to an uncompressed (n_frames x
+    n_voxels) float32 .npy file in cache_dir, with a json sidecar describing
+    the source files, the 4D shape and the affine.
+
+    The array is written by glm_utils.load_masked_data, in Fortran order, so 
+    the time series of a block of voxels is contiguous on disk. The gzipped 
+    image is only decompressed once, n_volumes at a time, and never held in 
+    memory as a whole. The conversion is skipped if the existing file is 
+    current, unless overwrite is set. Returns the .npy file
+    """
+    bold_file = get_masked_bold_file(func_file, cache_dir)
+    if not overwrite and is_current(bold_file, func_file, mask_file):
+        return bold_file
+    makedirs(cache_dir, exist_ok=True)
+    img = nib.load(func_file)
+    tmp_file = '%s.%s.tmp.npy' % (bold_file[:-4], os.getpid())
+    load_masked_data(func_file, nib.load(mask_file), n_volumes=n_volumes, out_file=tmp_file)
+    sidecar = {'source': _get_source_info(func_file, mask_file),
+               'shape': list(img.shape),
+               'affine': img.affine.tolist()}
+    tmp_sidecar = tmp_file.replace('.npy', '.json')
+    with open(tmp_sidecar, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(tmp_file, bold_file)
+    os.replace(tmp_sidecar, bold_file.replace('.npy', '.json'))
+    return bold_file
+
+def load_masked_bold(func_file, mask_file, cache_dir):
+    """
+    returns the memory mapped (n_frames x n_voxels) in-mask data of func_file,
+    converting it first if needed (see convert_bold)
+    """
+    bold_file = convert_bold(func_file, mask_file, cache_dir)
+    return np.load(bold_file, mmap_mode='r')
+
+# ********************************************************
+# Nifti access
+# ********************************************************
+class MaskedBOLDProxy():
+    """
+    array proxy that unmasks a memory mapped bold file on access
+
+    Wrapped in a nifti image (see get_bold_img), it can be passed to nilearn
+    (e.g. CanICA) or nistats in place of the gzipped file. Nothing is read
+    until the data are requested, and slicing volumes only reads those frames
+    """
+    is_proxy = True
+    # unscaled float data, as nibabel's ArrayProxy describes it
+    slope = 1.
+    inter = 0.
+
+    def __init__(self, bold_file, mask_file):
+        self.bold_file = bold_file
+        self.mask_file = mask_file
+        self.shape = tuple(_read_sidecar(bold_file)['shape'])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+
+    def _unmask(self, frames=slice(None)):
+        Y = np.load(self.bold_file, mmap_mode='r')[frames]
+        mask = np.asanyarray(nib.load(self.mask_file).dataobj).astype(bool)
+        data = np.zeros(mask.shape + (Y.shape[0],), dtype=self.dtype)
+        data[mask] = Y.T
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        data = self._unmask()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def __getitem__(self, slicer):
+        if not isinstance(slicer, tuple):
+            slicer = (slicer,)
+        if len(slicer) == 2 and slicer[0] is Ellipsis:
+            slicer = (slice(None),)*3 + slicer[1:]
+        if len(slicer) == 4 and isinstance(slicer[3], (slice, int, np.integer)):
+            # only read the requested frames
+            frames = slicer[3]
+            if isinstance(frames, (int, np.integer)):
+                return self._unmask(slice(frames, frames+1))[slicer[:3] + (0,)]
+            return self._unmask(frames)[slicer[:3]]
+        return self._unmask()[slicer]
+
+def get_bold_img(func_file, mask_file, cache_dir):
+    """
+    returns a nifti image of func_file backed by its memory mapped, masked
+    copy, converting it first if needed. Voxels outside the mask are 0
+    """
+    bold_file = convert_bold(func_file, mask_file, cache_dir)
+    proxy = MaskedBOLDProxy(bold_file, path.abspath(mask_file))
+    affine = np.array(_read_sidecar(bold_file)['affine'])
+    return nib.Nifti1Image(proxy, affine)
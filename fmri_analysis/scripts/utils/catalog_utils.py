@@ -0,0 +1,255 @@
+"""
+one-pass, persistent index of the files in BIDS / fmriprep directories
+"""
+from collections import defaultdict
+from fnmatch import fnmatchcase
+import json
+import os
+from os import makedirs, path
+
+# ********************************************************
+# helper functions
+# ********************************************************
+def parse_bids_filename(filename):
+    """ parses a BIDS filename into a dictionary of entities
+
+    e.g. 'sub-s130_ses-1_task-stroop_run-1_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'
+    becomes {'subject': 's130', 'session': '1', 'task': 'stroop', 'run': '1',
+    'space': 'MNI152NLin2009cAsym', 'desc': 'preproc', 'suffix': 'bold',
+    'extension': '.nii.gz'}. Returns None if the file has no subject entity
+    """
+    entity_names = {'sub': 'subject', 'ses': 'session', 'run': 'run', 'task': 'task'}
+    stem, dot, extension = filename.partition('.')
+    parts = stem.split('_')
+    entities = {'extension': dot + extension}
+    for i, part in enumerate(parts):
+        key, dash, value = part.partition('-')
+        if dash:
+            entities[entity_names.get(key, key)] = value
+        elif i == len(parts)-1:
+            entities['suffix'] = part
+    if 'subject' not in entities:
+        return None
+    return entities
+
+def _match_path(pattern, filepath):
+    """ glob-style match of a path, where wildcards don't cross separators """
+    pattern_parts = pattern.split(os.sep)
+    path_parts = filepath.split(os.sep)
+    if len(pattern_parts) != len(path_parts):
+        return False
+    return all(fnmatchcase(p, pat) for p, pat in zip(path_parts, pattern_parts))
+
+# ********************************************************
+# helper classes
+# ********************************************************
+class FileCatalog():
+    """
+    index of the files in a set of directories, built from one directory walk
+
+    BIDS directories (raw data, fmriprep output) are only walked through
+    sub-*/[ses-*/]func, and their files are indexed by BIDS entities so they
+    can be queried without globbing. Other directories (e.g. 1stlevel output)
+    are walked up to max_depth and can be searched with glob patterns.
+
+    The listing and mtime of every directory is kept, so a saved catalog can
+    be revalidated with refresh(), which only relists directories whose
+    mtime changed.
+    """
+    def __init__(self, bids_dirs=(), other_dirs=(), max_depth=3):
+        self.roots = {}
+        for root in bids_dirs:
+            self.roots[path.abspath(root)] = 'bids'
+        for root in other_dirs:
+            self.roots[path.abspath(root)] = 'other'
+        self.max_depth = max_depth
+        self.dirs = {}
+        self._index = None
+
+    def _descend(self, root, depth, name):
+        """ whether to walk into the subdirectory name at depth below root """
+        if self.roots[root] != 'bids':
+            return depth < self.max_depth
+        if depth == 0:
+            return name.startswith('sub-')
+        if depth == 1:
+            return name.startswith('ses-') or name == 'func'
+        return depth == 2 and name == 'func'
+
+    def _list_dir(self, directory, root, depth):
+        try:
+            mtime = os.stat(directory).st_mtime
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        files, subdirs = [], []
+        for entry in entries:
+            if entry.is_dir():
+                if self._descend(root, depth, entry.name):
+                    subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        self.dirs[directory] = {'mtime': mtime, 'root': root, 'depth': depth,
+                                'files': sorted(files), 'subdirs': sorted(subdirs)}
+        return self.dirs[directory]
+
+    def _scan_dir(self, directory, root, depth=0):
+        listing = self._list_dir(directory, root, depth)
+        if listing is None:
+            return
+        for subdir in listing['subdirs']:
+            self._scan_dir(path.join(directory, subdir), root, depth+1)
+
+    def _drop_dir(self, directory):
+        listing = self.dirs.pop(directory, None)
+        if listing is not None:
+            for subdir in listing['subdirs']:
+                self._drop_dir(path.join(directory, subdir))
+
+    def scan(self):
+        """ walks every root directory from scratch """
+        self.dirs = {}
+        for root in self.roots:
+            self._scan_dir(root, root)
+        self._index = None
+
+    def refresh(self):
+        """ revalidates the catalog against directory mtimes
+
+        Only directories whose mtime changed are relisted. New subdirectories
+        are walked and removed ones are dropped. Returns the number of
+        directories that were relisted
+        """
+        n_changed = 0
+        for root in self.roots:
+            if root not in self.dirs:
+                self._scan_dir(root, root)
+                n_changed += 1
+        for directory in sorted(self.dirs):
+            listing = self.dirs.get(directory)
+            if listing is None:
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime
+            except FileNotFoundError:
+                self._drop_dir(directory)
+                n_changed += 1
+                continue
+            if mtime == listing['mtime']:
+                continue
+            n_changed += 1
+            old_subdirs = set(listing['subdirs'])
+            listing = self._list_dir(directory, listing['root'], listing['depth'])
+            for subdir in old_subdirs - set(listing['subdirs']):
+                self._drop_dir(path.join(directory, subdir))
+            for subdir in set(listing['subdirs']) - old_subdirs:
+                self._scan_dir(path.join(directory, subdir), listing['root'],
+                               listing['depth']+1)
+        if n_changed:
+            self._index = None
+        return n_changed
+
+    def _build_index(self):
+        index = defaultdict(list)
+        for directory, listing in self.dirs.items():
+            if self.roots.get(listing['root']) != 'bids':
+                continue
+            for filename in listing['files']:
+                entities = parse_bids_filename(filename)
+                if entities is not None:
+                    entities['root'] = listing['root']
+                    entities['path'] = path.join(directory, filename)
+                    index[entities['subject']].append(entities)
+        self._index = index
+
+    def query(self, subject=None, root=None, **entities):
+        """ returns the sorted paths of indexed BIDS files matching entities
+
+        Entity values may be glob patterns (e.g. space='MNI*'). A subject
+        given with its 'sub-' prefix is accepted. root restricts the search
+        to one of the catalog's BIDS directories
+
+        e.g. query(subject='s130', task='stroop', desc='preproc', suffix='bold')
+        """
+        if self._index is None:
+            self._build_index()
+        if subject is not None:
+            candidates = self._index.get(subject.replace('sub-', ''), [])
+        else:
+            candidates = [f for files in self._index.values() for f in files]
+        if root is not None:
+            root = path.abspath(root)
+        matches = []
+        for f in candidates:
+            if root is not None and f['root'] != root:
+                continue
+            if all(key in f and fnmatchcase(f[key], str(value))
+                   for key, value in entities.items()):
+                matches.append(f['path'])
+        return sorted(matches)
+
+    def subjects(self, root=None):
+        """ returns the sorted subject labels found in the BIDS directories """
+        if self._index is None:
+            self._build_index()
+        if root is None:
+            return sorted(self._index.keys())
+        root = path.abspath(root)
+        return sorted(subj for subj, files in self._index.items()
+                      if any(f['root'] == root for f in files))
+
+    def glob(self, pattern):
+        """ glob over the catalog's listings instead of the filesystem """
+        dir_pattern, file_pattern = path.split(path.abspath(pattern))
+        matches = []
+        for directory, listing in self.dirs.items():
+            if _match_path(dir_pattern, directory):
+                matches += [path.join(directory, f) for f in listing['files']
+                            if fnmatchcase(f, file_pattern)]
+        return sorted(matches)
+
+    def save(self, filename):
+        makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'roots': self.roots, 'max_depth': self.max_depth,
+                       'dirs': self.dirs}, f)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            saved = json.load(f)
+        catalog = cls(max_depth=saved['max_depth'])
+        catalog.roots = saved['roots']
+        catalog.dirs = saved['dirs']
+        return catalog
+
+    def __getstate__(self):
+        # the index is rebuilt on demand, so don't ship it to worker processes
+        state = self.__dict__.copy()
+        state['_index'] = None
+        return state
+
+def get_catalog(bids_dirs=(), other_dirs=(), cache_file=None, verbose=False):
+    """
+    loads and refreshes the catalog saved in cache_file if it covers the same
+    directories, otherwise walks the directories. The catalog is then saved
+    back to cache_file
+    """
+    catalog = FileCatalog(bids_dirs, other_dirs)
+    if cache_file is not None and path.exists(cache_file):
+        saved = FileCatalog.load(cache_file)
+        if saved.roots == catalog.roots:
+            n_changed = saved.refresh()
+            if verbose:
+                print('Loaded file catalog, %s directories changed' % n_changed)
+            if n_changed:
+                saved.save(cache_file)
+            return saved
+    if verbose:
+        print('Building file catalog')
+    catalog.scan()
+    if cache_file is not None:
+        catalog.save(cache_file)
+    return catalog
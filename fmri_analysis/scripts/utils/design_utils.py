@@ -0,0 +1,170 @@
+"""
+fast construction of first level design matrices
+"""
+import numpy as np
+import pandas as pd
+import warnings
+from nistats.design_matrix import _make_drift
+from nistats.hemodynamic_models import glover_hrf, spm_hrf
+from nistats.utils import full_rank
+
+HRF_KERNELS = {'spm': spm_hrf, 'glover': glover_hrf}
+
+# ********************************************************
+# helper functions
+# ********************************************************
+def get_hr_frame_times(frame_times, oversampling=50, min_onset=-24):
+    """ returns the oversampled time grid nistats convolves events on """
+    n = frame_times.size
+    min_onset = float(min_onset)
+    n_hr = ((n - 1) * 1. / (frame_times.max() - frame_times.min()) *
+            (frame_times.max() * (1 + 1. / (n - 1)) - frame_times.min() -
+             min_onset) * oversampling) + 1
+    return np.linspace(frame_times.min() + min_onset,
+                       frame_times.max() * (1 + 1. / (n - 1)), int(n_hr))
+
+def _last_occurrences(keys):
+    """ index of the last occurrence of every unique key """
+    _, reverse_index = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - reverse_index
+
+def get_event_pulses(condition_index, onsets, durations, values, hr_frame_times):
+    """
+    places the boxcar of every event on the oversampled grid, as nistats does
+
+    Each boxcar is a step up at its onset and a step down at its offset.
+    Like nistats, zero-duration events are one grid step long and, where
+    two events of a condition start (or end) at the same grid point, only
+    the last one is kept.
+
+    Returns:
+        (condition_index, grid_index, value) arrays of the steps
+    """
+    tmax = len(hr_frame_times)
+    t_onset = np.minimum(np.searchsorted(hr_frame_times, onsets), tmax - 1)
+    t_offset = np.minimum(np.searchsorted(hr_frame_times, onsets + durations), tmax - 1)
+    t_offset[(t_offset < tmax - 1) & (t_offset == t_onset)] += 1
+    keep_onset = _last_occurrences(condition_index * tmax + t_onset)
+    keep_offset = _last_occurrences(condition_index * tmax + t_offset)
+    pulse_condition = np.concatenate([condition_index[keep_onset],
+                                      condition_index[keep_offset]])
+    pulse_index = np.concatenate([t_onset[keep_onset], t_offset[keep_offset]])
+    pulse_value = np.concatenate([values[keep_onset], -values[keep_offset]])
+    return pulse_condition, pulse_index, pulse_value
+
+def convolve_events(events, frame_times, hrf_model='spm', oversampling=50,
+                    min_onset=-24):
+    """
+    convolves every condition of events with the hrf at once
+
+    The convolution of a step with the hrf is the cumulative hrf shifted to
+    the step, so each regressor is a sum of shifted cumulative hrfs. It is
+    only evaluated at the two grid points around each frame time, which are
+    then linearly interpolated as in nistats' resampling. Cost is linear
+    in the number of events and frames.
+
+    Returns:
+        regressors: (n_frames x n_conditions) array
+        conditions: sorted condition names
+    """
+    if hrf_model not in HRF_KERNELS:
+        raise ValueError('hrf_model must be one of %s' % list(HRF_KERNELS))
+    if 'trial_type' in events.columns:
+        trial_type = np.asarray(events['trial_type'])
+    else:
+        trial_type = np.repeat('dummy', len(events))
+    onsets = np.asarray(events['onset'], dtype=float)
+    durations = np.asarray(events['duration'], dtype=float)
+    if 'modulation' in events.columns:
+        values = np.asarray(events['modulation'], dtype=float)
+    else:
+        values = np.ones(len(events))
+    conditions, condition_index = np.unique(trial_type, return_inverse=True)
+
+    hr_frame_times = get_hr_frame_times(frame_times, oversampling, min_onset)
+    if (onsets < frame_times[0] + min_onset).any():
+        warnings.warn(('Some stimulus onsets are earlier than %s in the'
+                       ' experiment and are thus not considered in the model'
+                       % (frame_times[0] + min_onset)), UserWarning)
+    tr = float(frame_times.max()) / (np.size(frame_times) - 1)
+    hrf = HRF_KERNELS[hrf_model](tr, oversampling)
+    # cumulative hrf, padded so index 0 is "before the step"
+    cumulative_hrf = np.concatenate([[0], np.cumsum(hrf)])
+
+    # grid points bracketing each frame time, as scipy's interp1d
+    tmax = len(hr_frame_times)
+    hi = np.clip(np.searchsorted(hr_frame_times, frame_times), 1, tmax - 1)
+    lo = hi - 1
+    grid = np.concatenate([lo, hi])
+
+    pulse_condition, pulse_index, pulse_value = get_event_pulses(
+        condition_index, onsets, durations, values, hr_frame_times)
+    lag = np.clip(grid[None, :] - pulse_index[:, None] + 1, 0, len(hrf))
+    responses = pulse_value[:, None] * cumulative_hrf[lag]
+    regressors = np.zeros((len(conditions), len(grid)))
+    np.add.at(regressors, pulse_condition, responses)
+
+    # linear interpolation to the frame times
+    y_lo, y_hi = regressors[:, :len(frame_times)], regressors[:, len(frame_times):]
+    slope = (y_hi - y_lo) / (hr_frame_times[hi] - hr_frame_times[lo])
+    regressors = y_lo + slope * (frame_times - hr_frame_times[lo])
+    return regressors.T, list(conditions)
+
+def temporal_derivatives(regressors):
+    """ temporal derivatives of each column, with the first row set to 0 """
+    derivatives = np.gradient(regressors, axis=0)
+    derivatives[0] = 0
+    return derivatives
+
+# ********************************************************
+# Design matrix
+# ********************************************************
+def make_design_matrix(frame_times, events, add_regs=None, add_reg_names=None,
+                       hrf_model='spm', drift_model='cosine', period_cut=128,
+                       drift_order=1, oversampling=50, min_onset=-24,
+                       derivative_exclude=('junk',)):
+    """
+    builds a first level design matrix in one vectorized pass
+
+    Matches nistats' make_first_level_design_matrix for the 'spm' and
+    'glover' hrf models, followed by temp_deriv: every condition not in
+    derivative_exclude is followed by its temporal derivative ('_TD').
+    Set derivative_exclude to None to leave out derivatives
+
+    Args:
+        frame_times: (n_frames,) acquisition times
+        events: dataframe with onset, duration and optionally trial_type and
+            modulation columns, as returned by CompiledEVSpec.get_paradigm
+        add_regs: (n_frames x n_regs) additional regressors (e.g. confounds)
+        add_reg_names: names of add_regs
+    """
+    frame_times = np.asarray(frame_times, dtype=float)
+    regressors, conditions = convolve_events(events, frame_times, hrf_model,
+                                             oversampling, min_onset)
+    matrix = [regressors]
+    names = list(conditions)
+    if add_regs is not None:
+        add_regs = np.asarray(add_regs).reshape(len(frame_times), -1)
+        if add_reg_names is None:
+            add_reg_names = ['reg%d' % k for k in range(add_regs.shape[1])]
+        matrix.append(add_regs)
+        names += list(add_reg_names)
+    drift, drift_names = _make_drift(drift_model, frame_times, drift_order,
+                                     period_cut)
+    matrix.append(drift)
+    names += drift_names
+    if len(np.unique(names)) != len(names):
+        raise ValueError('Design matrix columns do not have unique names')
+    matrix, _ = full_rank(np.hstack(matrix))
+
+    if derivative_exclude is not None:
+        # insert each derivative right after its condition
+        derived = [i for i, name in enumerate(conditions)
+                   if name not in derivative_exclude]
+        derivatives = temporal_derivatives(matrix[:, derived])
+        order = np.concatenate([np.arange(matrix.shape[1]), np.array(derived) + .5])
+        order = np.argsort(order, kind='stable')
+        matrix = np.hstack([matrix, derivatives])[:, order]
+        names = list(np.array(names + [conditions[i] + '_TD' for i in derived],
+                              dtype=object)[order])
+    return pd.DataFrame(matrix, columns=names, index=frame_times)
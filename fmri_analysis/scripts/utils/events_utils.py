@@ -1,6 +1,10 @@
 """
 some util functions
 """
+import ast
+from collections import namedtuple
+from functools import lru_cache
+import hashlib
 import numpy as np
 import pandas as pd
 import pdb
@@ -22,651 +26,442 @@ def normalize_rt(events_df, groupby=None):
 # 1st level analysis utility functions
 # ********************************************************        
 # functions to extract fmri events        
-def get_ev_vars(output_dict, events_df, condition_spec, col=None, 
-                amplitude=1, duration=0, subset=None, onset_column='onset'):
-    """ adds amplitudes, conditions, durations and onsets to an output_dict
-    
-    Args:
-        events_df: events file to parse
-        condition_spec: string specfying condition name, or list of tuples of the form (subset_key, name) where subset_key are one or more groups in col. If a list, col must be specified. 
-        col: the column to be subset by the keys in conditions
-        amplitude: either an int or string. If int, sets a constant amplitude. If string, ... 
-        duration: either an int or string. If int, sets a constant duration. If
-            string, duration is set to that column
-        subset: pandas query string to subset the data before use
-        onset_column: the column of timing to be used for onsets
-    
-    """
-    
-    required_keys =  set(['amplitudes','conditions','durations','onsets'])
-    assert set(output_dict.keys()) == required_keys
-    amplitudes = output_dict['amplitudes']
-    conditions = output_dict['conditions']
-    durations = output_dict['durations']
-    onsets = output_dict['onsets']
-    
-    # if subset is specified as a string, use to query
-    if subset is not None:
-        events_df = events_df.query(subset)
-    # if amplitudes or durations were passed as a series, subset and convert to list
-    if type(duration) == pd.core.series.Series:
-        duration = duration[events_df.index].tolist()
-    if type(amplitude) == pd.core.series.Series:
-        amplitude = amplitude[events_df.index].tolist()
-        
-    # if a column is specified, group by the values in that column
-    if type(condition_spec) == list:
-        assert (col is not None), "Must specify column when condition_spec is a list"
-        group_df = events_df.groupby(col)
-        for condition, condition_name in condition_spec:
-            if type(condition) is not list:
-                condition = [condition]
-            # get members of group identified by the condition list
-            c_dfs = [group_df.get_group(c) for c in condition 
-                     if c in group_df.groups.keys()]
-            if len(c_dfs)!=0:
-                c_df = pd.concat(c_dfs)
-                conditions.append(condition_name)
-                onsets.append(c_df.loc[:,onset_column].tolist())
-                if type(amplitude) in (int,float):
-                    amplitudes.append([amplitude]*len(onsets[-1]))
-                elif type(amplitude) == str:
-                    amplitudes.append(c_df.loc[:,amplitude].tolist())
-                if type(duration) in (int,float):
-                    durations.append([duration]*len(onsets[-1]))
-                elif type(duration) == str:
-                    durations.append(c_df.loc[:,duration].tolist())
-    elif type(condition_spec) == str:
-        group_df = events_df
-        conditions.append(condition_spec)
-        onsets.append(group_df.loc[:,onset_column].tolist())
-        if type(amplitude) in (int,float):
-            amplitudes.append([amplitude]*len(onsets[-1]))
-        elif type(amplitude) == str:
-            amplitudes.append(group_df.loc[:,amplitude].tolist())
-        elif type(amplitude) == list:
-            amplitudes.append(amplitude)
-        if type(duration) in (int,float):
-            durations.append([duration]*len(onsets[-1]))
-        elif type(duration) == str:
-            durations.append(group_df.loc[:,duration].tolist())
-        elif type(duration) == list:
-            durations.append(duration)
-    # ensure that each column added is all numeric
-    for attr in [durations, amplitudes, onsets]:
-        assert np.issubdtype(np.array(attr[-1]).dtype, np.number) 
-        assert pd.isnull(attr[-1]).sum() == 0
+def _as_numeric_array(values):
+    """ converts values to an array, inferring the dtype of object arrays
+    from their elements as np.array(list) would """
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = np.array(values.tolist())
+    return values
 
-# specific task functions
-def get_ANT_EVs(events_df, regress_rt=True):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-    events_df.trial_type = [c+'_'+f for c,f in 
-                            zip(events_df.cue, events_df.flanker_type)]
-    # cue type
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('spatial_congruent', 'spatial_congruent'),
-                                ('spatial_incongruent', 'spatial_incongruent'),
-                                ('double_congruent', 'double_congruent'),
-                                ('double_incongruent', 'double_incongruent')],
-                col='trial_type',
-                duration='duration',
-                subset='junk==False')
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                condition_spec='response_time', 
-                duration='duration', 
-                amplitude='response_time',
-                subset='junk==False')
-    else:
-        normalize_rt(events_df, 'trial_type')
-        get_ev_vars(output_dict, events_df, 
-                condition_spec=[('spatial_congruent', 'spatial_congruent_RT'),
-                                ('spatial_incongruent', 'spatial_incongruent_RT'),
-                                ('double_congruent', 'double_congruent_RT'),
-                                ('double_incongruent', 'double_incongruent_RT')],
-                col='trial_type',
-                amplitude='response_time',
-                duration='duration',
-                subset='junk==False')
-    return output_dict
+def _get_ev_values(events_df, value, mask):
+    """ returns the amplitudes or durations of the rows in mask """
+    if type(value) == str:
+        return _as_numeric_array(events_df[value].values[mask])
+    elif type(value) == pd.core.series.Series:
+        return _as_numeric_array(value.loc[events_df.index[mask]].values)
+    elif type(value) in (list, np.ndarray):
+        return _as_numeric_array(value)
+    return np.repeat(value, mask.sum())
 
+# ********************************************************
+# EV specifications
+# ********************************************************
+# Each task's regressors are declared as a sequence of steps, run in order:
+#   EV: a regressor group. conditions is a condition name or a tuple of 
+#       (key(s) in col, name) tuples, whose rows are subset by the subset 
+#       query. amplitude and duration are constants or columns of events_df
+#   NormalizeRT: demeans response_time, optionally within groups
+#   Prepare: a function that derives or recodes columns of events_df in place
+#   TrialEVs: one condition per trial, for beta series
+# Steps with regress_rt set are only used when regress_rt matches it
+EV = namedtuple('EV', ['conditions', 'col', 'amplitude', 'duration', 'subset', 
+                       'onset_column', 'regress_rt'])
+EV.__new__.__defaults__ = (None, 1, 0, None, 'onset', None)
+NormalizeRT = namedtuple('NormalizeRT', ['groupby', 'regress_rt'])
+NormalizeRT.__new__.__defaults__ = (None, None)
+Prepare = namedtuple('Prepare', ['function', 'regress_rt'])
+Prepare.__new__.__defaults__ = (None,)
+TrialEVs = namedtuple('TrialEVs', ['subset'])
+TrialEVs.__new__.__defaults__ = ('junk==False',)
 
-def get_CCTHot_EVs(events_df, regress_rt):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-    # task
-    get_ev_vars(output_dict, events_df,
-                condition_spec='task',
-                duration='block_duration',
-                subset='junk==False and trial_id=="stim"')
-    # ITI
-    get_ev_vars(output_dict, events_df,
-                condition_spec='ITI',
-                duration='block_duration',
-                subset='junk==False and trial_id=="ITI"')
-    # add main parametric regressors: EV and risk
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='EV', 
-                duration='block_duration', 
-                amplitude='EV',
-                subset='junk==False and trial_id=="stim"')
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='risk',
-                duration='block_duration', 
-                amplitude='risk',
-                subset='junk==False and trial_id=="stim"')
-    # other regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='num_click_in_round', 
-                duration='block_duration', 
-                amplitude='num_click_in_round',
-                subset='junk==False and trial_id=="stim"')
-    
-    # set the onset of the feedback at the time of the response - not the time of the trial beginning
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(1,'reward'), (0,'punishment')], 
-                duration=0,
-                onset_column='movement_onset',
-                col='feedback',
-                subset='junk==False and trial_id=="stim"')
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec='response_time', 
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset='junk==False')
-    return output_dict
+# steps shared by most tasks
+JUNK = EV(((True, 'junk'),), col='junk', duration='duration')
+RT = EV('response_time', duration='duration', amplitude='response_time',
+        subset='junk==False', regress_rt=True)
 
-def get_discountFix_EVs(events_df, regress_rt=True):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-    # regressors of interest
-    """
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('larger_later', 'larger_later'),
-                                ('smaller_sooner', 'smaller_sooner')],
-                col='trial_type',
-                duration='duration',
-                subset='junk == False')
-    """
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='subjective_choice_value', 
-                duration='duration', 
-                amplitude='subjective_choice_value',
-                subset='junk==False')
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')],
-                col='junk', 
-                duration='duration')
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec='response_time', 
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset='junk==False')
-    return output_dict
+def _set_ANT_trial_type(events_df):
+    events_df.trial_type = [c+'_'+f for c,f in 
+                            zip(events_df.cue, events_df.flanker_type)]
 
-def get_DPX_EVs(events_df, regress_rt=True):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('AX','AX'), ('AY','AY'), ('BX', 'BX'), ('BY','BY')],
-                col='condition', 
-                duration='duration',
-                subset='junk==False')
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')  
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                condition_spec='response_time', 
-                duration='duration', 
-                amplitude='response_time',
-                subset='junk==False')
-    else:
-        normalize_rt(events_df, 'condition')
-        get_ev_vars(output_dict, events_df, 
-                condition_spec=[('AX', 'AX_RT'),
-                                ('AY', 'AY_RT'),
-                                ('BX', 'BX_RT'),
-                                ('BY', 'BY_RT')],
-                col='condition',
-                amplitude='response_time',
-                duration='duration',
-                subset='junk==False')
-    return output_dict
+def _set_twoByTwo_trial_type(events_df):
+    events_df.trial_type = ['cue_'+c if c is not np.nan else 'task_'+t \
+                            for c,t in zip(events_df.cue_switch, events_df.task_switch)]
+    events_df.trial_type.replace('cue_switch', 'task_stay_cue_switch', inplace=True)
 
-def get_manipulation_EVs(events_df, regress_rt=True): 
-    output_dict = { 'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-                  }
-    #"demean" cue regressor 
-    
-    get_ev_vars(output_dict, events_df, 
-               condition_spec = [('cue', 'np_cue')],
-               col = 'trial_id',
-               duration = 'duration',
-               subset='trial_type!="no_stim" and junk==False')
-        
+def _code_manipulation_modulators(events_df):
     cue_count = events_df['which_cue'].value_counts()    
     #replace strings with parametric regressors adusted for frequency of trial type 
     events_df.which_cue = events_df.which_cue.replace('LATER', (cue_count['NOW'])/(cue_count['LATER'])) 
     events_df.which_cue = events_df.which_cue.replace('NOW', -1) 
-    
-    # cue regressor 
-    get_ev_vars(output_dict, events_df, 
-               condition_spec = [('cue', 'cue')],
-               col = 'trial_id',
-               duration = 'duration',
-               amplitude = 'which_cue',
-               subset='trial_type!="no_stim" and junk==False')
-    #demean probe regressor 
-
-    get_ev_vars(output_dict, events_df, 
-                condition_spec = [('probe', 'np_probe')],
-                col = 'trial_id',
-               duration = 'duration',
-               subset='trial_type!="no_stim" and junk==False')
-    
     probe_ratio = events_df['stim_type'].value_counts()
     events_df.stim_type = events_df.stim_type.replace('neutral', -(probe_ratio['valence'])/(probe_ratio['neutral']))
     events_df.stim_type = events_df.stim_type.replace('valence', 1)
-    
-    get_ev_vars(output_dict, events_df, 
-                condition_spec = [('probe', 'probe')],
-                col = 'trial_id',
-               duration = 'duration',
-               amplitude = 'stim_type', 
-               subset='trial_type!="no_stim" and junk==False')
-    
-    #calculate the mean response for this participant
-    response_mean = np.nanmean(events_df['response'])
-    #demean and replace 
-    events_df.response = events_df.response - response_mean 
-    #rename column 
-    events_df = events_df.replace({'current_rating': 'rating'})
-    get_ev_vars(output_dict, events_df, 
-              condition_spec = [('rating', 'rating')], 
-               col = 'trial_id',
-               duration = 'response_time',
-               amplitude = 'response', 
-               subset='junk==False and trial_type!="no_stim" and trial_id=="rating"')
+    #demean response
+    events_df.response = events_df.response - np.nanmean(events_df['response'])
 
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')
+def _set_mean_rt(events_df):
+    events_df["mean_rt"] = np.mean(events_df.response_time)
 
-    if regress_rt == True:
-        events_df["mean_rt"] = np.mean(events_df.response_time)
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                condition_spec='response_time', 
-                duration= "mean_rt", 
-                amplitude='response_time', #demeaned rt after running normalize_rt
-                subset='junk==False and trial_type!="no_stim" and trial_id=="rating"') #the only trials that will have responses 
-        
-    return output_dict
-   
+# rating trials are labeled "current_rating" in some events files
+RATING_SUBSET = 'junk==False and trial_type!="no_stim" and trial_id in ["rating", "current_rating"]'
 
-def get_motorSelectiveStop_EVs(events_df, regress_rt=True):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('crit_go','crit_go'), 
-                            ('crit_stop_success', 'crit_stop_success'), 
-                            ('crit_stop_failure', 'crit_stop_failure'),
-                            ('noncrit_signal', 'noncrit_signal'),
-                            ('noncrit_nosignal', 'noncrit_nosignal')],
-                col='trial_type', 
-                duration='duration')
-    
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')    
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                condition_spec='response_time', 
-                duration='duration', 
-                amplitude='response_time',
-                subset='junk==False and trial_type!="crit_stop_success"')
-    else:
-        normalize_rt(events_df, 'trial_type')
-        get_ev_vars(output_dict, events_df, 
-                condition_spec=[('crit_go','crit_go_RT'), 
-                            ('crit_stop_failure', 'crit_stop_failure_RT'),
-                            ('noncrit_signal', 'noncrit_signal_RT'),
-                            ('noncrit_nosignal', 'noncrit_nosignal_RT')],
-                col='trial_type',
-                amplitude='response_time',
-                duration='duration',
-                subset='junk==False')
-    return output_dict
-    
-def get_stopSignal_EVs(events_df, regress_rt=True):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-     # task regressor
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('go','go'), 
-                            ('stop_success', 'stop_success'), 
-                            ('stop_failure', 'stop_failure')],
-                col='trial_type', 
-                duration='duration',
-                subset='junk==False')
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                condition_spec='response_time', 
-                duration='duration', 
-                amplitude='response_time',
-                subset='junk==False and trial_type!="stop_success"')
-    else:
-        normalize_rt(events_df, 'trial_type')
-        get_ev_vars(output_dict, events_df, 
-                condition_spec=[('go','go_RT'), 
-                            ('stop_failure', 'stop_failure_RT')],
-                col='trial_type',
-                amplitude='response_time',
-                duration='duration',
-                subset='junk==False')
-    return output_dict
+# How to model RT
+# For each condition model responses with constant duration 
+# (average RT across subjects or block duration)
+# RT as a separate regressor for each onset, constant duration, 
+# amplitude as parameteric regressor (function of RT)
+EV_SPECS = {
+    'ANT': (
+        Prepare(_set_ANT_trial_type),
+        EV((('spatial_congruent', 'spatial_congruent'),
+            ('spatial_incongruent', 'spatial_incongruent'),
+            ('double_congruent', 'double_congruent'),
+            ('double_incongruent', 'double_incongruent')),
+           col='trial_type', duration='duration', subset='junk==False'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT,
+        NormalizeRT('trial_type', regress_rt=False),
+        EV((('spatial_congruent', 'spatial_congruent_RT'),
+            ('spatial_incongruent', 'spatial_incongruent_RT'),
+            ('double_congruent', 'double_congruent_RT'),
+            ('double_incongruent', 'double_incongruent_RT')),
+           col='trial_type', amplitude='response_time', duration='duration',
+           subset='junk==False', regress_rt=False)),
+    'CCTHot': (
+        EV('task', duration='block_duration', subset='junk==False and trial_id=="stim"'),
+        EV('ITI', duration='block_duration', subset='junk==False and trial_id=="ITI"'),
+        # add main parametric regressors: EV and risk
+        EV('EV', duration='block_duration', amplitude='EV',
+           subset='junk==False and trial_id=="stim"'),
+        EV('risk', duration='block_duration', amplitude='risk',
+           subset='junk==False and trial_id=="stim"'),
+        EV('num_click_in_round', duration='block_duration', amplitude='num_click_in_round',
+           subset='junk==False and trial_id=="stim"'),
+        # set the onset of the feedback at the time of the response - not the time of the trial beginning
+        EV(((1, 'reward'), (0, 'punishment')), col='feedback', duration=0,
+           onset_column='movement_onset', subset='junk==False and trial_id=="stim"'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT),
+    'discountFix': (
+        EV('subjective_choice_value', duration='duration',
+           amplitude='subjective_choice_value', subset='junk==False'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT),
+    'DPX': (
+        EV((('AX', 'AX'), ('AY', 'AY'), ('BX', 'BX'), ('BY', 'BY')),
+           col='condition', duration='duration', subset='junk==False'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT,
+        NormalizeRT('condition', regress_rt=False),
+        EV((('AX', 'AX_RT'), ('AY', 'AY_RT'), ('BX', 'BX_RT'), ('BY', 'BY_RT')),
+           col='condition', amplitude='response_time', duration='duration',
+           subset='junk==False', regress_rt=False)),
+    'manipulationTask': (
+        Prepare(_code_manipulation_modulators),
+        #"demean" cue regressor 
+        EV((('cue', 'np_cue'),), col='trial_id', duration='duration',
+           subset='trial_type!="no_stim" and junk==False'),
+        EV((('cue', 'cue'),), col='trial_id', duration='duration', amplitude='which_cue',
+           subset='trial_type!="no_stim" and junk==False'),
+        #demean probe regressor 
+        EV((('probe', 'np_probe'),), col='trial_id', duration='duration',
+           subset='trial_type!="no_stim" and junk==False'),
+        EV((('probe', 'probe'),), col='trial_id', duration='duration', amplitude='stim_type',
+           subset='trial_type!="no_stim" and junk==False'),
+        EV(((('rating', 'current_rating'), 'rating'),), col='trial_id',
+           duration='response_time', amplitude='response', subset=RATING_SUBSET),
+        JUNK,
+        Prepare(_set_mean_rt, regress_rt=True),
+        NormalizeRT(regress_rt=True),
+        #the only trials that will have responses 
+        EV('response_time', duration='mean_rt', amplitude='response_time',
+           subset=RATING_SUBSET, regress_rt=True)),
+    'motorSelectiveStop': (
+        EV((('crit_go', 'crit_go'),
+            ('crit_stop_success', 'crit_stop_success'),
+            ('crit_stop_failure', 'crit_stop_failure'),
+            ('noncrit_signal', 'noncrit_signal'),
+            ('noncrit_nosignal', 'noncrit_nosignal')),
+           col='trial_type', duration='duration'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT._replace(subset='junk==False and trial_type!="crit_stop_success"'),
+        NormalizeRT('trial_type', regress_rt=False),
+        EV((('crit_go', 'crit_go_RT'),
+            ('crit_stop_failure', 'crit_stop_failure_RT'),
+            ('noncrit_signal', 'noncrit_signal_RT'),
+            ('noncrit_nosignal', 'noncrit_nosignal_RT')),
+           col='trial_type', amplitude='response_time', duration='duration',
+           subset='junk==False', regress_rt=False)),
+    'stopSignal': (
+        EV((('go', 'go'), ('stop_success', 'stop_success'), ('stop_failure', 'stop_failure')),
+           col='trial_type', duration='duration', subset='junk==False'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT._replace(subset='junk==False and trial_type!="stop_success"'),
+        NormalizeRT('trial_type', regress_rt=False),
+        EV((('go', 'go_RT'), ('stop_failure', 'stop_failure_RT')),
+           col='trial_type', amplitude='response_time', duration='duration',
+           subset='junk==False', regress_rt=False)),
+    'stroop': (
+        EV((('incongruent', 'incongruent'), ('congruent', 'congruent')),
+           col='condition', duration='duration', subset='junk==False'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT,
+        NormalizeRT('condition', regress_rt=False),
+        EV((('incongruent', 'incongruent_RT'), ('congruent', 'congruent_RT')),
+           col='condition', amplitude='response_time', duration='duration',
+           subset='junk==False', regress_rt=False)),
+    'surveyMedley': (
+        EV('stim_duration', duration='stim_duration'),
+        EV('movement', onset_column='movement_onset'),
+        JUNK,
+        RT),
+    'twoByTwo': (
+        Prepare(_set_twoByTwo_trial_type),
+        # trial type contrasts
+        EV((('task_switch', 'task_switch_900'),
+            ('task_stay_cue_switch', 'task_stay_cue_switch_900'),
+            ('cue_stay', 'cue_stay_900')),
+           col='trial_type', duration='duration', subset='CTI==900 and junk==False'),
+        EV((('task_switch', 'task_switch_100'),
+            ('task_stay_cue_switch', 'task_stay_cue_switch_100'),
+            ('cue_stay', 'cue_stay_100')),
+           col='trial_type', duration='duration', subset='CTI==100 and junk==False'),
+        JUNK,
+        NormalizeRT(regress_rt=True),
+        RT,
+        # normalize RT separately for each condition and CTI
+        NormalizeRT(('CTI', 'trial_type'), regress_rt=False),
+        EV((('task_switch', 'task_switch_100_RT'),
+            ('task_stay_cue_switch', 'task_stay_cue_switch_100_RT'),
+            ('cue_stay', 'cue_stay_100_RT')),
+           col='trial_type', duration='duration', amplitude='response_time',
+           subset='CTI==100 and junk==False', regress_rt=False),
+        EV((('task_switch', 'task_switch_900_RT'),
+            ('task_stay_cue_switch', 'task_stay_cue_switch_900_RT'),
+            ('cue_stay', 'cue_stay_900_RT')),
+           col='trial_type', duration='duration', amplitude='response_time',
+           subset='CTI==900 and junk==False', regress_rt=False)),
+    'WATT3': (
+        # planning conditions
+        EV((('PA_with_intermediate', 'plan_PA_with'),
+            ('PA_without_intermediate', 'plan_PA_without')),
+           col='condition', duration='duration', subset='planning==1'),
+        # nuisance regressors
+        EV('movement', onset_column='movement_onset'),
+        EV('feedback', duration='duration', subset="trial_id=='feedback'"),
+        NormalizeRT(regress_rt=True),
+        NormalizeRT('planning', regress_rt=False),
+        EV('response_time', duration='duration', amplitude='response_time',
+           subset="trial_id != 'feedback'")),
+    'base': (
+        EV('trial', duration='duration'),
+        JUNK),
+    # covers generic conversion of events_df into trial design file
+    'beta': (
+        TrialEVs(),
+        JUNK,
+        RT),
+    }
 
-def get_stroop_EVs(events_df, regress_rt=True):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-    # task regressor
-    # contrast regressor
-    get_ev_vars(output_dict, events_df,
-                condition_spec=[('incongruent', 'incongruent'),
-                               ('congruent', 'congruent')],
-                col='condition',
-                duration='duration',
-                subset='junk==False')
-    
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration') 
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                condition_spec='response_time', 
-                duration='duration', 
-                amplitude='response_time',
-                subset='junk==False')
-    else:
-        normalize_rt(events_df, 'condition')
-        get_ev_vars(output_dict, events_df, 
-                condition_spec=[('incongruent', 'incongruent_RT'),
-                               ('congruent', 'congruent_RT')],
-                col='condition',
-                amplitude='response_time',
-                duration='duration',
-                subset='junk==False')
-    return output_dict
+# ********************************************************
+# EV spec compilation
+# ********************************************************
+SUBSET_OPERATORS = {ast.Eq: '==', ast.NotEq: '!=', ast.In: 'in', ast.NotIn: 'not in'}
 
-def get_surveyMedley_EVs(events_df, regress_rt=True):
-    output_dict = {
-        'conditions': [],
-        'onsets': [],
-        'durations': [],
-        'amplitudes': []
-        }
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='stim_duration', 
-                duration='stim_duration')
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='movement',  
-                onset_column='movement_onset')
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')   
-    if regress_rt == True:
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec='response_time', 
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset='junk==False')
-    return output_dict
+def compile_subset(subset):
+    """ parses a query string into a tuple of (column, operator, value) terms
 
-    
-def get_twoByTwo_EVs(events_df, regress_rt=True):
-    output_dict = {
-            'conditions': [],
-            'onsets': [],
-            'durations': [],
-            'amplitudes': []
-            }
-    events_df.trial_type = ['cue_'+c if c is not np.nan else 'task_'+t \
-                            for c,t in zip(events_df.cue_switch, events_df.task_switch)]
-    events_df.trial_type.replace('cue_switch', 'task_stay_cue_switch', inplace=True)
-    
-    # trial type contrasts
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('task_switch', 'task_switch_900'),
-                                ('task_stay_cue_switch', 'task_stay_cue_switch_900'),
-                               ('cue_stay', 'cue_stay_900')],
-                col='trial_type',
-                duration='duration',
-                subset="CTI==900 and junk==False")
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('task_switch', 'task_switch_100'),
-                                ('task_stay_cue_switch', 'task_stay_cue_switch_100'),
-                               ('cue_stay', 'cue_stay_100')],
-                col='trial_type',
-                duration='duration',
-                subset="CTI==100 and junk==False")
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')   
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec='response_time', 
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset='junk==False')
+    Only conjunctions ('and') of comparisons of a column to a literal with 
+    ==, !=, in or not in are supported, e.g. 'junk==False and trial_id=="stim"'
+    """
+    if subset is None:
+        return ()
+    tree = ast.parse(subset, mode='eval').body
+    if isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And):
+        clauses = tree.values
     else:
-        # normalize RT separately for each condition and CTI
-        subset_100 = events_df.query('CTI == 100')
-        subset_900 = events_df.query('CTI == 900')
-        normalize_rt(subset_100, 'trial_type')
-        normalize_rt(subset_900, 'trial_type')
-        events_df.loc[subset_100.index, 'response_time'] = subset_100.response_time
-        events_df.loc[subset_900.index, 'response_time'] = subset_900.response_time
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec=[('task_switch', 'task_switch_100_RT'),
-                                    ('task_stay_cue_switch', 'task_stay_cue_switch_100_RT'),
-                                   ('cue_stay', 'cue_stay_100_RT')],
-                    col='trial_type',
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset='CTI==100 and junk==False')
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec=[('task_switch', 'task_switch_900_RT'),
-                                    ('task_stay_cue_switch', 'task_stay_cue_switch_900_RT'),
-                                   ('cue_stay', 'cue_stay_900_RT')],
-                    col='trial_type',
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset='CTI==900 and junk==False')
-    return output_dict
+        clauses = [tree]
+    terms = []
+    for clause in clauses:
+        if not (isinstance(clause, ast.Compare) and len(clause.ops) == 1 
+                and isinstance(clause.left, ast.Name)
+                and type(clause.ops[0]) in SUBSET_OPERATORS):
+            raise ValueError('Unsupported subset: %s' % subset)
+        value = ast.literal_eval(clause.comparators[0])
+        if isinstance(value, list):
+            value = tuple(value)
+        terms.append((clause.left.id, SUBSET_OPERATORS[type(clause.ops[0])], value))
+    return tuple(terms)
+
+def _get_term_mask(events_df, term):
+    column, operator, value = term
+    values = events_df[column]
+    if operator == '==':
+        return np.asarray(values == value)
+    elif operator == '!=':
+        return np.asarray(values != value)
+    elif operator == 'in':
+        return values.isin(value).values
+    return ~values.isin(value).values
+
+def _describe_step(step):
+    """ stable description of a step. Functions are described by their name
+    and bytecode, so changing a Prepare function changes the spec key """
+    if isinstance(step, Prepare):
+        code = step.function.__code__
+        function = '%s.%s:%s' % (step.function.__module__, step.function.__qualname__,
+                                 hashlib.sha1(code.co_code + repr(code.co_consts).encode()).hexdigest())
+        return repr(step._replace(function=function))
+    return repr(step)
+
+class CompiledEVSpec():
+    """
+    EV specification of a task compiled for one regress_rt setting
+
+    Steps that do not apply to regress_rt are dropped and subset strings 
+    are parsed once, so extraction for each subject only evaluates boolean
+    masks, which are shared across the regressors of a task. Specs are 
+    hashable and their key identifies the extraction, e.g. for design caches
+    """
+    def __init__(self, task, regress_rt, steps):
+        self.task = task
+        self.regress_rt = regress_rt
+        self.steps = tuple(step._replace(subset=compile_subset(step.subset))
+                           if isinstance(step, (EV, TrialEVs)) else step
+                           for step in steps
+                           if getattr(step, 'regress_rt', None) in (None, regress_rt))
+        description = [task, regress_rt] + [_describe_step(step) for step in self.steps]
+        self.key = hashlib.sha1(repr(description).encode()).hexdigest()
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, CompiledEVSpec) and self.key == other.key
+
+    def __repr__(self):
+        return 'CompiledEVSpec(%s, regress_rt=%s)' % (self.task, self.regress_rt)
+
+    def _get_mask(self, events_df, terms, masks):
+        mask = np.ones(len(events_df), dtype=bool)
+        for term in terms:
+            if term not in masks:
+                masks[term] = _get_term_mask(events_df, term)
+            mask = mask & masks[term]
+        return mask
+
+    def _extract_EV(self, events_df, step, masks):
+        mask = self._get_mask(events_df, step.subset, masks)
+        if type(step.conditions) == str:
+            condition_masks = [(step.conditions, mask)]
+        else:
+            condition_masks = []
+            for condition, condition_name in step.conditions:
+                if type(condition) is not tuple:
+                    condition = (condition,)
+                condition_mask = mask & events_df[step.col].isin(condition).values
+                # conditions without members are left out
+                if condition_mask.any():
+                    condition_masks.append((condition_name, condition_mask))
+        onset_values = events_df[step.onset_column].values
+        EVs = []
+        for condition_name, condition_mask in condition_masks:
+            EV_values = (_as_numeric_array(onset_values[condition_mask]),
+                         _get_ev_values(events_df, step.duration, condition_mask),
+                         _get_ev_values(events_df, step.amplitude, condition_mask))
+            # ensure that each column added is all numeric
+            for values in EV_values:
+                assert np.issubdtype(values.dtype, np.number) 
+                assert pd.isnull(values).sum() == 0
+            EVs.append(([condition_name], np.repeat(condition_name, condition_mask.sum())) 
+                       + EV_values)
+        return EVs
+
+    def _extract_trials(self, events_df, step, masks):
+        # one condition per trial, named by its (1 indexed) row
+        trials = self._get_mask(events_df, step.subset, masks)
+        trial_names = np.array(['trial_%s' % str(number).zfill(3) 
+                                for number in events_df.index[trials] + 1], dtype=str)
+        return [(trial_names.tolist(), trial_names,
+                 _as_numeric_array(events_df.onset.values[trials]),
+                 _as_numeric_array(events_df.duration.values[trials]),
+                 np.ones(trials.sum()))]
+
+    def apply(self, events_df, extract=True):
+        """ runs the steps over events_df, which is modified in place by
+        Prepare and NormalizeRT steps. If extract is set, returns a list of 
+        (names, conditions, onsets, durations, amplitudes) tuples, one per 
+        condition or, for trial EVs, one for all trials. names lists the 
+        conditions and the arrays hold one row per event """
+        # masks are cached by term and reset whenever columns may change
+        masks = {}
+        EVs = []
+        for step in self.steps:
+            if isinstance(step, Prepare):
+                step.function(events_df)
+                masks = {}
+            elif isinstance(step, NormalizeRT):
+                groupby = step.groupby
+                if type(groupby) == tuple:
+                    groupby = list(groupby)
+                normalize_rt(events_df, groupby)
+                masks = {}
+            elif extract and isinstance(step, EV):
+                EVs += self._extract_EV(events_df, step, masks)
+            elif extract and isinstance(step, TrialEVs):
+                EVs += self._extract_trials(events_df, step, masks)
+        return EVs
 
-def get_WATT3_EVs(events_df, regress_rt=True):
-    output_dict = {
+    def prepare(self, events_df):
+        """ applies the changes to events_df without extracting EVs, 
+        e.g. when the design was found in a cache """
+        self.apply(events_df, extract=False)
+
+    def get_EV_dict(self, events_df):
+        """ returns the EVs as a dict of conditions, onsets, durations and
+        amplitudes lists """
+        output_dict = {
             'conditions': [],
             'onsets': [],
             'durations': [],
             'amplitudes': []
             }
-    # planning conditions
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[('PA_with_intermediate','plan_PA_with'),
-                                ('PA_without_intermediate','plan_PA_without')],
-                col='condition', 
-                duration='duration', 
-                subset="planning==1")
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='movement', 
-                onset_column='movement_onset')
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='feedback', 
-                duration='duration',
-                subset="trial_id=='feedback'")
-    
-    if regress_rt == True:
-        normalize_rt(events_df)
-        get_ev_vars(output_dict, events_df, 
-                condition_spec='response_time', 
-                duration='duration', 
-                amplitude='response_time',
-                subset="trial_id != 'feedback'")
-    else:
-        normalize_rt(events_df, 'planning')
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec='response_time', 
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset="trial_id != 'feedback'")
-    return output_dict
+        for names, _, onsets, durations, amplitudes in self.apply(events_df):
+            if len(names) == 0:
+                # trial EVs without trials add no conditions
+                continue
+            if len(names) > 1:
+                # trial EVs: one condition per row
+                output_dict['conditions'] += names
+                output_dict['onsets'] += list(onsets[:, None])
+                output_dict['durations'] += list(durations[:, None])
+                output_dict['amplitudes'] += list(amplitudes[:, None])
+            else:
+                output_dict['conditions'] += names
+                output_dict['onsets'].append(onsets)
+                output_dict['durations'].append(durations)
+                output_dict['amplitudes'].append(amplitudes)
+        return output_dict
+
+    def get_paradigm(self, events_df):
+        """ returns the EVs directly as a long format, onset sorted paradigm """
+        EVs = self.apply(events_df)
+        columns = list(zip(*EVs)) if EVs else [[], [[]], [[]], [[]], [[]]]
+        paradigm = {'trial_type': np.concatenate(columns[1]).astype(object),
+                    'onset': np.concatenate(columns[2]),
+                    'modulation': np.concatenate(columns[4]),
+                    'duration': np.concatenate(columns[3])}
+        paradigm = pd.DataFrame(paradigm).sort_values(by='onset', kind='mergesort')
+        return paradigm.reset_index(drop=True)
 
-def get_base_EVs(events_df):
-    output_dict = {
-        'conditions': [],
-        'onsets': [],
-        'durations': [],
-        'amplitudes': []
-        }
-    get_ev_vars(output_dict, events_df, 
-                condition_spec='trial',
-                duration='duration')
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')   
-    return output_dict
+@lru_cache(maxsize=None)
+def get_EV_spec(task, regress_rt=True):
+    """ returns the compiled EV spec of a task. Specs are compiled once per
+    process and reused for every subject """
+    if task not in EV_SPECS:
+        raise ValueError('No EV specification for task %s' % task)
+    return CompiledEVSpec(task, bool(regress_rt), EV_SPECS[task])
 
 def get_beta_series(events_df, regress_rt=True):
-    output_dict = {
-        'conditions': [],
-        'onsets': [],
-        'durations': [],
-        'amplitudes': []
-        }
-    for i, row in events_df.iterrows():
-        if row.junk == False:
-            output_dict['conditions'].append('trial_%s' % str(i+1).zfill(3))
-            output_dict['onsets'].append([row.onset])
-            output_dict['durations'].append([row.duration])
-            output_dict['amplitudes'].append([1])
-    # nuisance regressors
-    get_ev_vars(output_dict, events_df, 
-                condition_spec=[(True, 'junk')], 
-                col='junk', 
-                duration='duration')   
-    if regress_rt == True:
-        get_ev_vars(output_dict, events_df, 
-                    condition_spec='response_time', 
-                    duration='duration', 
-                    amplitude='response_time',
-                    subset='junk==False')
-    return output_dict
-    
-# How to model RT
-# For each condition model responses with constant duration 
-# (average RT across subjects or block duration)
-# RT as a separate regressor for each onset, constant duration, 
-# amplitude as parameteric regressor (function of RT)
-def parse_EVs(events_df, task, regress_rt=True):
-    if task == "ANT":
-        EV_dict = get_ANT_EVs(events_df, regress_rt)
-    elif task == "CCTHot": 
-        EV_dict = get_CCTHot_EVs(events_df, regress_rt)
-    elif task == "discountFix": 
-        EV_dict = get_discountFix_EVs(events_df, regress_rt)
-    elif task == "DPX":
-        EV_dict = get_DPX_EVs(events_df, regress_rt)
-    elif task == 'manipulationTask': 
-        EV_dict = get_manipulation_EVs(events_df, regress_rt)
-    elif task == "motorSelectiveStop": 
-        EV_dict = get_motorSelectiveStop_EVs(events_df)
-    elif task == 'surveyMedley':
-        EV_dict = get_surveyMedley_EVs(events_df, regress_rt)
-    elif task == "stopSignal":
-        EV_dict = get_stopSignal_EVs(events_df)
-    elif task == "stroop":
-        EV_dict = get_stroop_EVs(events_df, regress_rt)
-    elif task == "twoByTwo":
-        EV_dict = get_twoByTwo_EVs(events_df, regress_rt)
-    elif task == "WATT3":
-        EV_dict = get_WATT3_EVs(events_df, regress_rt)
-    # covers generic conversion of events_df into trial design file
-    elif task == 'beta':
-        EV_dict = get_beta_series(events_df, regress_rt)
-    return EV_dict
+    return get_EV_spec('beta', regress_rt).get_EV_dict(events_df)
 
-    
+def parse_EVs(events_df, task, regress_rt=True):
+    return get_EV_spec(task, regress_rt).get_EV_dict(events_df)
@@ -1,6 +1,7 @@
 from matplotlib.colors import ListedColormap
 import matplotlib.patheffects as PathEffects
 import matplotlib.pyplot as plt
+import numpy as np
 from scipy.stats import norm
 import seaborn as sns
 from nilearn import image, plotting
@@ -14,14 +15,21 @@ def plot_design(subjinfo, plot_contrasts=False):
             ax=plot_contrast_matrix(contrast, design_matrix=subjinfo.design)
             ax.set_xlabel(name)
 
+def compute_contrast(subjinfo, contrast):
+    """ computes a contrast from the fit model, or the compact results if the
+    fit model wasn't saved """
+    if subjinfo.fit_model is not None:
+        return subjinfo.fit_model.compute_contrast(contrast)
+    return subjinfo.results.compute_contrast(contrast)
+
 def plot_contrast(subjinfo, contrast, simple_plot=True, **kwargs):
     if type(contrast) == int:
         contrast = subjinfo.contrasts[contrast]
         contrast_title = contrast[0]
-        z_map = subjinfo.fit_model.compute_contrast(contrast[1])
+        z_map = compute_contrast(subjinfo, contrast[1])
     else:
         contrast_title = contrast
-        z_map = subjinfo.fit_model.compute_contrast(contrast)
+        z_map = compute_contrast(subjinfo, contrast)
     plot_map(z_map, title=contrast_title, **kwargs)
 
 def plot_map(contrast_map, title=None, glass_kwargs=None, stat_kwargs=None):
@@ -81,7 +89,7 @@ def plot_average_maps(subjects, contrast_keys=None, **kwargs):
         try:
             maps = [i.maps[key] for i in subjects]
         except KeyError:
-            maps = [i.fit_model.compute_contrast(key) for i in subjects]
+            maps = [compute_contrast(i, key) for i in subjects]
         averages[key] = image.mean_img(maps)
     # plot
     for name, average in averages.items():
@@ -90,4 +98,29 @@ def plot_average_maps(subjects, contrast_keys=None, **kwargs):
         default_args.update(**kwargs)
         plotting.plot_glass_brain(average, colorbar=True, 
                               title=name,
-                              plot_abs=False, **default_args)
\ No newline at end of file
+                              plot_abs=False, **default_args)
+
+def plot_carpet(bold_data, TR=None, n_voxels=2000, title=None, random_state=0):
+    """ plots the z-scored time series of a random subset of voxels (a carpet
+    plot) from (n_frames x n_voxels) masked data. With memory mapped data
+    (see bold_utils.load_masked_bold) only the sampled voxels are read """
+    rng = np.random.RandomState(random_state)
+    n_voxels = min(n_voxels, bold_data.shape[1])
+    voxels = np.sort(rng.choice(bold_data.shape[1], n_voxels, replace=False))
+    carpet = np.asarray(bold_data[:, voxels], dtype=np.float64)
+    std = carpet.std(axis=0)
+    std[std == 0] = 1
+    carpet = (carpet - carpet.mean(axis=0)) / std
+    f, ax = plt.subplots(figsize=(12,6))
+    extent = None
+    if TR is not None:
+        extent = (0, carpet.shape[0]*TR, n_voxels, 0)
+        ax.set_xlabel('Time (s)')
+    else:
+        ax.set_xlabel('Frame')
+    ax.imshow(carpet.T, aspect='auto', cmap='gray', vmin=-2, vmax=2, 
+              interpolation='none', extent=extent)
+    ax.set_ylabel('Voxels')
+    if title is not None:
+        ax.set_title(title)
+    return f
@@ -1,6 +1,10 @@
 from collections import namedtuple
 from glob import glob
+import hashlib
+import json
 from nistats.design_matrix import make_first_level_design_matrix
+from nistats.first_level_model import FirstLevelModel
+from nilearn import image, masking
 import numpy as np
 import os
 from os import makedirs, path
@@ -10,10 +14,18 @@ import pickle
 import random
 from sklearn.preprocessing import scale
 import warnings
-from utils.events_utils import get_beta_series, parse_EVs
-from utils.utils import get_contrasts, get_flags
+from utils.bold_utils import get_bold_img, load_masked_bold
+from utils.design_utils import make_design_matrix
+from utils.events_utils import get_EV_spec
+from utils.glm_utils import (estimate_ar1, fit_ar1_glms, fit_lss, get_contrast_matrix, 
+                             load_masked_data, mean_scaling, FirstLevelResults)
+from utils.utils import (get_contrasts, get_file_fingerprint, get_file_hash, get_flags, 
+                         get_hash, get_model_flags)
 import pdb
 
+# hrf and drift settings of the first level design matrices
+DESIGN_SETTINGS = {'hrf_model': 'spm', 'drift_model': 'cosine', 'period_cut': 80}
+
 # ********************************************************
 # helper functions 
 # ******************************************************** 
@@ -27,102 +39,473 @@ def temp_deriv(dataframe, columns=None):
         insert_loc = dataframe.columns.get_loc(i)
         dataframe.insert(insert_loc+1, i+'_TD', col)   
 
-def create_design(events, confounds, task, TR, beta=True, regress_rt=False):
+def create_design(events, confounds, task, TR, beta=True, regress_rt=False, cache=None,
+                  engine='nistats'):
     """
-    takes event file and confounds, and creates EV_dict, which is passed to make_first_level_design to create a the design matrix. 
+    takes event file and confounds, and extracts the task's EVs with its compiled EV spec into a paradigm, which is passed to make_first_level_design to create a the design matrix. 
+    If cache (a DesignCache) is passed, a design already built from the same
+    inputs is reused instead of being convolved again. Either way, events is
+    updated in place by the EV spec (e.g. normalized RTs).
+    engine is either 'nistats' or 'fast', which builds the same design
+    (within floating point error) with all conditions convolved at once. 
+    'fast' is much quicker for beta series designs
     """
-    if beta:
-        EV_dict = get_beta_series(events, regress_rt=regress_rt)
-    else:
-        EV_dict = parse_EVs(events, task, regress_rt=regress_rt)
-    paradigm = get_paradigm(EV_dict)
+    if engine not in ['nistats', 'fast']:
+        raise ValueError("engine must be 'nistats' or 'fast'")
+    EV_spec = get_EV_spec('beta' if beta else task, regress_rt)
+    if cache is not None:
+        key = cache.get_key(events, confounds, EV_spec=EV_spec.key, TR=TR, 
+                            engine=engine, **DESIGN_SETTINGS)
+        design = cache.get(key)
+        if design is not None:
+            EV_spec.prepare(events)
+            return design
+    paradigm = EV_spec.get_paradigm(events)
     # make design
     n_scans = int(confounds.shape[0])
-    design = make_first_level_design_matrix(np.arange(n_scans)*TR,
-                               paradigm,
-                               hrf_model='spm',
-                               period_cut=80,
-                               drift_model='cosine',
-                               add_regs=confounds.values,
-                               add_reg_names=list(confounds.columns))
-    # add temporal derivative to task columns
-    task_cols = [i for i in paradigm.trial_type.unique() if i != 'junk']
-    temp_deriv(design, task_cols)
+    if engine == 'fast':
+        # temporal derivatives of the task columns are added by the builder
+        design = make_design_matrix(np.arange(n_scans)*TR,
+                                    paradigm,
+                                    add_regs=confounds.values,
+                                    add_reg_names=list(confounds.columns),
+                                    derivative_exclude=['junk'],
+                                    **DESIGN_SETTINGS)
+    else:
+        design = make_first_level_design_matrix(np.arange(n_scans)*TR,
+                                   paradigm,
+                                   add_regs=confounds.values,
+                                   add_reg_names=list(confounds.columns),
+                                   **DESIGN_SETTINGS)
+        # add temporal derivative to task columns
+        task_cols = [i for i in paradigm.trial_type.unique() if i != 'junk']
+        temp_deriv(design, task_cols)
+    if cache is not None:
+        cache.set(key, design)
     return design
 
 def make_first_level_obj(subject_id, task, fmriprep_dir, data_dir, TR, 
-                        regress_rt=False, beta=False, a_comp_cor=True):
+                        regress_rt=False, beta=False, a_comp_cor=True, catalog=None,
+                        cache_dir=None, design_cache=None, design_engine='nistats'):
     """
     retrieves and passes func_file, mask_file, events, confounds, design, and contrasts to FirstLevel 
-    class and returns subjinfo object, prints error if no func or mask file
+    class and returns subjinfo object, prints error if no func or mask file.
+    Files are looked up in catalog (a FileCatalog) if passed, rather than globbed.
+    Processed confounds are cached in cache_dir and designs in design_cache 
+    (a DesignCache) if passed. design_engine is passed to create_design
     """
-    func_file, mask_file = get_func_file(fmriprep_dir, subject_id, task)
+    func_file, mask_file = get_func_file(fmriprep_dir, subject_id, task, catalog=catalog)
     if func_file is None or mask_file is None:
         print("Missing MRI files for %s: %s" % (subject_id, task))
         return None
-    events = get_events(data_dir, subject_id, task)
+    events = get_events(data_dir, subject_id, task, catalog=catalog)
     if events is None:
         print("Missing event files for %s: %s" % (subject_id, task))
         return None
-    confounds = get_confounds(fmriprep_dir, subject_id, task)
-    design = create_design(events, confounds, task, TR, beta=beta, regress_rt=regress_rt)
+    confounds = get_confounds(fmriprep_dir, subject_id, task, a_comp_cor=a_comp_cor,
+                              catalog=catalog, cache_dir=cache_dir)
+    design = create_design(events, confounds, task, TR, beta=beta, regress_rt=regress_rt,
+                           cache=design_cache, engine=design_engine)
     contrasts = get_contrasts(task, regress_rt)
     subjinfo = FirstLevel(func_file, mask_file, events, design, contrasts, '%s_%s' % (subject_id, task))
 
     subjinfo.model_settings['beta'] = beta
     subjinfo.model_settings['regress_rt'] = regress_rt
+    subjinfo.model_settings['a_comp_cor'] = a_comp_cor
+    return subjinfo
+
+def fit_first_level_obj(subjinfo, TR, n_jobs=1, bold_cache_dir=None):
+    """
+    fits an AR(1) FirstLevelModel to the subjinfo's func file and design,
+    storing the fit model on subjinfo.fit_model
+    """
+    fmri_glm = FirstLevelModel(TR, 
+                               subject_label = subjinfo.ID,
+                               mask=subjinfo.mask,
+                               noise_model='ar1',
+                               standardize=False, 
+                               hrf_model='spm',
+                               drift_model='cosine',
+                               period_cut=80,
+                               n_jobs=n_jobs)
+    func = subjinfo.func
+    if bold_cache_dir is not None:
+        func = get_bold_img(subjinfo.func, subjinfo.mask, bold_cache_dir)
+    subjinfo.fit_model = fmri_glm.fit(func, design_matrices=subjinfo.design)
+    return subjinfo
+
+def load_bold_data(subjinfo, bold_cache_dir=None):
+    """ returns the bold file of subjinfo, or its memory mapped masked data 
+    if bold_cache_dir is set (see bold_utils.convert_bold) """
+    if bold_cache_dir is None:
+        return subjinfo.func
+    return load_masked_bold(subjinfo.func, subjinfo.mask, bold_cache_dir)
+
+def fit_first_level_results(subjinfo, chunk_size=10000, bold_cache_dir=None):
+    """
+    fits the AR(1) GLM with the native, chunked solver (see 
+    glm_utils.fit_ar1_glm) instead of nistats, storing compact results on 
+    subjinfo.results. No fit model is kept
+    """
+    subjinfo.results = FirstLevelResults.from_data(load_bold_data(subjinfo, bold_cache_dir), 
+                                                   image.load_img(subjinfo.mask),
+                                                   subjinfo.design, 
+                                                   get_results_metadata(subjinfo),
+                                                   chunk_size=chunk_size)
     return subjinfo
 
-def save_first_level_obj(subjinfo, output_dir, save_maps=False):
+def get_results_metadata(subjinfo):
+    return {'ID': subjinfo.ID, 
+            'model_settings': subjinfo.model_settings,
+            'func': subjinfo.func,
+            'contrasts': subjinfo.contrasts}
+
+def run_first_level(subject_id, task, fmriprep_dir, data_dir, first_level_dir, TR,
+                    regress_rt=False, beta=False, a_comp_cor=True, catalog=None, 
+                    cache_dir=None, design_engine='nistats', lss=False, 
+                    solver='nistats', chunk_size=10000, bold_cache_dir=None, 
+                    manifest=None, verbose=False):
+    """
+    builds, fits and saves the first level model for one subject and task, 
+    including contrast maps, design and events. Meant to be run as a single
+    job in a worker process. Returns the ID of the saved model, or None if 
+    the subject's files were missing
+
+    If lss is set (beta series models only), the single trial betas are 
+    estimated with least squares separate and saved as a 4D beta series 
+    image instead of fitting the one regressor per trial model.
+    solver is either 'nistats' (FirstLevelModel) or 'native', which fits 
+    chunk_size voxels at a time and only keeps the compact results.
+    If bold_cache_dir is set, the bold data are read from an uncompressed,
+    memory mapped copy in that directory, which is made on first use.
+    manifest (see get_input_manifest) is written next to the outputs once
+    they are saved
+    """
+    if lss and not beta:
+        raise ValueError('lss is only used for beta series models')
+    design_cache = None
+    if cache_dir is not None:
+        design_cache = DesignCache(path.join(cache_dir, 'designs'))
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore",category=DeprecationWarning)
+        warnings.filterwarnings("ignore",category=UserWarning)
+        subjinfo = make_first_level_obj(subject_id, task, fmriprep_dir, data_dir, TR, 
+                                        regress_rt=regress_rt, beta=beta, 
+                                        a_comp_cor=a_comp_cor, catalog=catalog,
+                                        cache_dir=cache_dir, design_cache=design_cache,
+                                        design_engine=design_engine)
+    if subjinfo is None:
+        return None
+    if verbose and design_cache is not None:
+        print('** %s design cache: %s' % (subjinfo.ID, design_cache.report()))
+    if lss:
+        if verbose:
+            print('** fitting LSS beta series: %s' % subjinfo.ID)
+        beta_series_img, trial_names = fit_lss_beta_series(subjinfo, bold_cache_dir)
+        save_lss_beta_series(subjinfo, beta_series_img, trial_names, first_level_dir)
+        subjinfo.export_design(first_level_dir)
+        subjinfo.export_events(first_level_dir)
+        if manifest is not None:
+            write_manifest(manifest, get_manifest_file(subject_id, task, first_level_dir,
+                                                       'LSS_%s' % get_flags(regress_rt)[0]))
+        return subjinfo.ID
+    if verbose:
+        print('** fitting model: %s' % subjinfo.ID)
+    if solver == 'native':
+        fit_first_level_results(subjinfo, chunk_size=chunk_size, 
+                                bold_cache_dir=bold_cache_dir)
+    else:
+        fit_first_level_obj(subjinfo, TR, bold_cache_dir=bold_cache_dir)
+    if verbose:
+        print('** saving: %s' % subjinfo.ID)
+    save_first_level_obj(subjinfo, first_level_dir, True)
+    subjinfo.export_design(first_level_dir)
+    subjinfo.export_events(first_level_dir)
+    if manifest is not None:
+        write_manifest(manifest, get_manifest_file(subject_id, task, first_level_dir,
+                                                   subjinfo.get_flags()))
+    return subjinfo.ID
+
+def run_first_level_models(subject_id, task, fmriprep_dir, data_dir, first_level_dir, TR,
+                           models, catalog=None, cache_dir=None, design_engine='nistats',
+                           chunk_size=10000, bold_cache_dir=None, manifests=None, 
+                           verbose=False):
+    """
+    builds, fits and saves several variants of the first level model of one
+    subject and task from a single read of the bold data, events and 
+    confounds. Each variant is saved as run_first_level would save it, under
+    its own flags.
+
+    models is a list of (regress_rt, beta, a_comp_cor) tuples. The designs 
+    are fit with the native solver (see glm_utils.fit_ar1_glms): regressors
+    shared by every design (confounds, drifts) are projected out of the data
+    once and each design only fits its own regressors. manifests, if 
+    passed, has the manifest of each model and they are written as the
+    models are saved. Returns the saved IDs
+    """
+    design_cache = None
+    if cache_dir is not None:
+        design_cache = DesignCache(path.join(cache_dir, 'designs'))
+    func_file, mask_file = get_func_file(fmriprep_dir, subject_id, task, catalog=catalog)
+    if func_file is None or mask_file is None:
+        print("Missing MRI files for %s: %s" % (subject_id, task))
+        return []
+    events = get_events(data_dir, subject_id, task, catalog=catalog)
+    if events is None:
+        print("Missing event files for %s: %s" % (subject_id, task))
+        return []
+    confounds = {}
+    subjinfos = []
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore",category=DeprecationWarning)
+        warnings.filterwarnings("ignore",category=UserWarning)
+        for regress_rt, beta, a_comp_cor in models:
+            if a_comp_cor not in confounds:
+                confounds[a_comp_cor] = get_confounds(fmriprep_dir, subject_id, task, 
+                                                      a_comp_cor=a_comp_cor, catalog=catalog,
+                                                      cache_dir=cache_dir)
+            # designs may add columns to events, so each gets its own copy
+            model_events = events.copy()
+            design = create_design(model_events, confounds[a_comp_cor], task, TR, 
+                                   beta=beta, regress_rt=regress_rt,
+                                   cache=design_cache, engine=design_engine)
+            subjinfo = FirstLevel(func_file, mask_file, model_events, design, 
+                                  get_contrasts(task, regress_rt), 
+                                  '%s_%s' % (subject_id, task))
+            subjinfo.model_settings.update({'beta': beta, 'regress_rt': regress_rt,
+                                            'a_comp_cor': a_comp_cor})
+            subjinfos.append(subjinfo)
+    if verbose:
+        print('** fitting %s models: %s' % (len(subjinfos), subjinfos[0].ID))
+    mask_img = image.load_img(mask_file)
+    if bold_cache_dir is None:
+        Y = load_masked_data(func_file, mask_img)
+    else:
+        Y = load_masked_bold(func_file, mask_file, bold_cache_dir)
+    designs = [subjinfo.design for subjinfo in subjinfos]
+    shared = get_shared_regressors(designs)
+    outputs = fit_ar1_glms(Y, [design.drop(columns=shared).values for design in designs],
+                           designs[0].loc[:, shared].values, chunk_size=chunk_size)
+    if manifests is None:
+        manifests = [None] * len(models)
+    for subjinfo, (betas, dispersion, ar1), manifest in zip(subjinfos, outputs, manifests):
+        design = subjinfo.design
+        fit_columns = [c for c in design.columns if c not in shared] + shared
+        order = [fit_columns.index(c) for c in design.columns]
+        subjinfo.results = FirstLevelResults(betas[order], dispersion, ar1, design.values,
+                                             design.columns, mask_img, 
+                                             get_results_metadata(subjinfo))
+        if verbose:
+            print('** saving: %s, %s' % (subjinfo.ID, subjinfo.get_flags()))
+        save_first_level_obj(subjinfo, first_level_dir, True)
+        subjinfo.export_design(first_level_dir)
+        subjinfo.export_events(first_level_dir)
+        if manifest is not None:
+            write_manifest(manifest, get_manifest_file(subject_id, task, first_level_dir,
+                                                       subjinfo.get_flags()))
+    return [subjinfo.ID for subjinfo in subjinfos]
+
+def get_shared_regressors(designs):
+    """ returns the columns, in the order of the first design, that have the 
+    same values in every design """
+    shared = []
+    for column in designs[0].columns:
+        values = designs[0][column].values
+        if all(column in design.columns and np.allclose(design[column].values, values) 
+               for design in designs[1:]):
+            shared.append(column)
+    return shared
+
+def fit_lss_beta_series(subjinfo, bold_cache_dir=None):
+    """
+    estimates single trial betas of a beta series design with least squares
+    separate (see glm_utils.fit_lss). The data are loaded and mean scaled 
+    once, and AR(1) coefficients are estimated from a model with all trials
+    as one regressor. The temporal derivatives of the trials are left out
+    of the models. Returns a 4D image of betas and the trial names
+    """
+    design = subjinfo.design
+    trial_names = [c for c in design.columns 
+                   if c.startswith('trial_') and not c.endswith('_TD')]
+    nuisance_names = [c for c in design.columns if not c.startswith('trial_')]
+    trials = design.loc[:, trial_names].values
+    nuisance = design.loc[:, nuisance_names].values
+    if bold_cache_dir is None:
+        Y = masking.apply_mask(subjinfo.func, subjinfo.mask).astype(np.float64)
+    else:
+        Y = np.array(load_masked_bold(subjinfo.func, subjinfo.mask, bold_cache_dir),
+                     dtype=np.float64)
+    Y, _ = mean_scaling(Y)
+    ar1 = estimate_ar1(np.column_stack([trials.sum(axis=1), nuisance]), Y)
+    betas = fit_lss(Y, trials, nuisance, ar1)
+    return masking.unmask(betas.astype(np.float32), subjinfo.mask), trial_names
+
+def save_lss_beta_series(subjinfo, beta_series_img, trial_names, output_dir):
+    """ saves the 4D beta series image and a tsv of the events of its trials """
+    subj, task = subjinfo.ID.split('_')
+    directory = path.join(output_dir, subj, task)
+    makedirs(directory, exist_ok=True)
+    filename = get_lss_file(subj, task, output_dir, subjinfo.model_settings['regress_rt'])
+    beta_series_img.to_filename(filename)
+    # trial_%03d regressors are numbered by their (1 indexed) row in events
+    trials = subjinfo.events.iloc[[int(name.split('_')[1])-1 for name in trial_names]]
+    trials.insert(0, 'trial', trial_names)
+    trials.to_csv(filename.replace('.nii.gz', '_trials.tsv'), sep='\t', index=False)
+
+def save_first_level_obj(subjinfo, output_dir, save_maps=False, save_fit_model=False):
     """
     Gets or Creates a directory for saving the first level analyses,
     will also save contrast maps if flagged to do so.
+    
+    The fit model is stored in the compact results format (see 
+    FirstLevelResults) and is left out of the pickled object unless 
+    save_fit_model is set. Results are saved next to the pickled object 
+    rather than in it
     """
     subj, task = subjinfo.ID.split('_')
     directory = path.join(output_dir, subj, task)
     flags = subjinfo.get_flags()
     filename = path.join(directory, 'firstlevel_%s.pkl' % flags)
     makedirs(directory, exist_ok=True)
+    fit_model = subjinfo.fit_model
+    if fit_model is not None:
+        subjinfo.results = FirstLevelResults.from_fit_model(fit_model, 
+                                                            get_results_metadata(subjinfo))
+        if not save_fit_model:
+            subjinfo.fit_model = None
+    results = subjinfo.results
+    if results is not None:
+        results.save(path.join(directory, 'results_%s' % flags))
+        subjinfo.results = None
     f = open(filename, 'wb')
     pickle.dump(subjinfo, f)
     f.close()
+    subjinfo.fit_model = fit_model
+    subjinfo.results = results
     if save_maps:
-        maps_dir = path.join(directory, 'maps_%s' % flags)
-        makedirs(maps_dir, exist_ok=True)
-        for name, contrast in subjinfo.contrasts:
-            try:
-                contrast_map = subjinfo.fit_model.compute_contrast(contrast)
-                contrast_file = path.join(maps_dir, 'contrast-%s.nii.gz' % name)
-                contrast_map.to_filename(contrast_file)
-            except patsy.PatsyError:
-                warnings.warn('Contrast: %s failed for %s, %s' % (name, subj, task))
+        save_contrast_maps(subjinfo, path.join(directory, 'maps_%s' % flags))
+
+def save_contrast_maps(subjinfo, maps_dir):
+    """
+    computes every contrast of subjinfo in one batch from its compact results 
+    and saves the z maps to maps_dir
+    """
+    makedirs(maps_dir, exist_ok=True)
+    results = subjinfo.results
+    names, contrast_matrix, failed = get_contrast_matrix(subjinfo.contrasts, 
+                                                         results.design_columns)
+    for name in failed:
+        warnings.warn('Contrast: %s failed for %s' % (name, subjinfo.ID))
+    if len(names) == 0:
+        return
+    z_maps = results.unmask(results.compute_contrasts(contrast_matrix)['z_score'])
+    for i, name in enumerate(names):
+        contrast_file = path.join(maps_dir, 'contrast-%s.nii.gz' % name)
+        image.index_img(z_maps, i).to_filename(contrast_file)
                 
-def get_first_level_objs(subject_id, task, first_level_dir, regress_rt=False, beta=False):
+def get_first_level_objs(subject_id, task, first_level_dir, regress_rt=False, beta=False,
+                         catalog=None, a_comp_cor=True):
     """ gets and returns filepath to first level objects if they exist"""
 
-    rt_flag, beta_flag = get_flags(regress_rt, beta)
-    files = path.join(first_level_dir, subject_id, task, 'firstlevel*%s_%s*pkl' % (rt_flag, beta_flag))
+    flags = get_model_flags(regress_rt, beta, a_comp_cor)
+    files = path.join(first_level_dir, subject_id, task, 'firstlevel*%s.pkl' % flags)
+    if catalog is not None:
+        return catalog.glob(files)
     return glob(files)    
 
+def get_lss_file(subject_id, task, first_level_dir, regress_rt=False):
+    """ returns the filepath of the LSS beta series image of a run """
+    rt_flag, _ = get_flags(regress_rt)
+    return path.join(first_level_dir, subject_id, task, 'betaseries-LSS_%s.nii.gz' % rt_flag)
+
 def load_first_level_objs(task, first_level_dir, regress_rt=False, beta=False):
+    """
+    loads pickled first level objects. Where compact results were saved,
+    they are attached (memory mapped) as subjinfo.results
+    """
     subjinfos = []
     files = get_first_level_objs('*', task, first_level_dir, 
                                  regress_rt=regress_rt, beta=beta)
     for filey in files:
         f = open(filey, 'rb')
-        subjinfos.append(pickle.load(f))
+        subjinfo = pickle.load(f)
         f.close()
+        results_dir = path.join(path.dirname(filey), 'results_%s' % subjinfo.get_flags())
+        if path.exists(results_dir):
+            subjinfo.results = FirstLevelResults.load(results_dir)
+        subjinfos.append(subjinfo)
     return subjinfos
 
-def get_first_level_maps(subject_id, task, first_level_dir, contrast, regress_rt=False, beta=False):
-    rt_flag, beta_flag = get_flags(regress_rt, beta)
-    files = path.join(first_level_dir, subject_id, task, 'maps_%s_%s/contrast-%s.nii.gz' % (rt_flag, beta_flag, contrast))
+def get_first_level_results(subject_id, task, first_level_dir, regress_rt=False, beta=False,
+                            a_comp_cor=True):
+    """ gets and returns directories of compact first level results if they exist"""
+    flags = get_model_flags(regress_rt, beta, a_comp_cor)
+    dirs = path.join(first_level_dir, subject_id, task, 'results_%s' % flags)
+    return sorted(glob(dirs))
+
+def load_first_level_results(task, first_level_dir, regress_rt=False, beta=False):
+    """ loads compact first level results for all subjects, without unpickling"""
+    results_dirs = get_first_level_results('*', task, first_level_dir,
+                                           regress_rt=regress_rt, beta=beta)
+    return [FirstLevelResults.load(d) for d in results_dirs]
+
+def get_first_level_maps(subject_id, task, first_level_dir, contrast, regress_rt=False, beta=False,
+                         a_comp_cor=True):
+    flags = get_model_flags(regress_rt, beta, a_comp_cor)
+    files = path.join(first_level_dir, subject_id, task, 'maps_%s/contrast-%s.nii.gz' % (flags, contrast))
     return sorted(glob(files))  
 
 # ********************************************************
 # helper classes 
 # ******************************************************** 
 
+class DesignCache():
+    """
+    content addressed, on-disk cache of design matrices
+
+    Designs are keyed on a hash of their inputs (events table, confounds,
+    TR, HRF/drift settings and the compiled EV spec, which covers the task
+    and model flags), so a design is only rebuilt if
+    something it depends on changed. Hits and misses are counted
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(events, confounds, **settings):
+        """ returns the hash of the events, confounds and design settings """
+        sha1 = hashlib.sha1()
+        for df in [events, confounds]:
+            sha1.update(json.dumps([str(c) for c in df.columns]).encode())
+            sha1.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        sha1.update(get_hash(settings).encode())
+        return sha1.hexdigest()
+
+    def _get_file(self, key):
+        return path.join(self.cache_dir, 'design_%s.pkl' % key)
+
+    def get(self, key):
+        """ returns the cached design for key, or None """
+        filename = self._get_file(key)
+        if path.exists(filename):
+            self.hits += 1
+            return pd.read_pickle(filename)
+        self.misses += 1
+        return None
+
+    def set(self, key, design):
+        makedirs(self.cache_dir, exist_ok=True)
+        filename = self._get_file(key)
+        # write to a temporary file first so parallel jobs never read a partial file
+        tmp_filename = filename + '.%s.tmp' % os.getpid()
+        design.to_pickle(tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    def report(self):
+        return '%s hits, %s misses' % (self.hits, self.misses)
+
 SubjInfo = namedtuple('subjinfo', ['func','mask','design','contrasts','ID'])
 class FirstLevel():
     def __init__(self, func, mask, events, design, contrasts, ID):
@@ -135,6 +518,7 @@ class FirstLevel():
         # for model
         self.model_settings = {'beta': False, 'regress_rt': False}
         self.fit_model = None
+        self.results = None
     
     def get_subjinfo(self):
         return SubjInfo(self.func, 
@@ -154,9 +538,9 @@ class FirstLevel():
         self.events.to_csv(path.join(directory, 'events_%s.csv' %flags))
     
     def get_flags(self):
-        rt_flag, beta_flag = get_flags(self.model_settings['regress_rt'],
-                                       self.model_settings['beta'])
-        return '%s_%s' % (rt_flag, beta_flag)
+        return get_model_flags(self.model_settings['regress_rt'],
+                               self.model_settings['beta'],
+                               self.model_settings.get('a_comp_cor', True))
 
     
     def _get_export_dir(self, directory):
@@ -177,28 +561,36 @@ class FirstLevel():
 # ********************************************************
 # Process Functions
 # ******************************************************** 
-def process_confounds(confounds_file, a_comp_cor=True):
+def process_confounds(confounds_file, a_comp_cor=True, fd_thresh=.5, dvars_thresh=1.2):
     """
     scrubbing for TASK
     remove TRs where FD>.5, stdDVARS (that relates to DVARS>.5)
     regressors to use
     ['X','Y','Z','RotX','RotY','RotY','<-firsttemporalderivative','stdDVARs','FD','respiratory','physio','aCompCor0-5']
     junk regressor: errors, ommissions, maybe very fast RTs (less than 50 ms)
+
+    Only the needed columns of the confounds file are parsed
     """
-    confounds_df = pd.read_csv(confounds_file, sep = '\t', 
+    movement_regressor_names = ['trans_x','trans_y','trans_z','rot_x','rot_y','rot_z']
+    add_regressor_names = ['framewise_displacement'] 
+    if a_comp_cor: 
+        header = pd.read_csv(confounds_file, sep = '\t', nrows=0).columns
+        add_regressor_names += [i for i in header if 'a_comp_cor' in i]
+    usecols = set(movement_regressor_names + add_regressor_names + ['std_dvars'])
+    confounds_df = pd.read_csv(confounds_file, sep = '\t', usecols=usecols,
                                na_values=['n/a']).fillna(0)
-    excessive_movement = (confounds_df.framewise_displacement>.5) & \
-                            (confounds_df.std_dvars>1.2)
-    excessive_movement_TRs = excessive_movement[excessive_movement].index
+    # one spike regressor per excessive movement TR
+    excessive_movement = (confounds_df.framewise_displacement>fd_thresh) & \
+                            (confounds_df.std_dvars>dvars_thresh)
+    excessive_movement_TRs = np.flatnonzero(excessive_movement.values)
     excessive_movement_regressors = np.zeros([confounds_df.shape[0], 
-                                   np.sum(excessive_movement)])
-    for i,TR in enumerate(excessive_movement_TRs):
-        excessive_movement_regressors[TR,i] = 1
+                                              len(excessive_movement_TRs)])
+    excessive_movement_regressors[excessive_movement_TRs, 
+                                  np.arange(len(excessive_movement_TRs))] = 1
     excessive_movement_regressor_names = ['rejectTR_%d' % TR for TR in 
                                           excessive_movement_TRs]
     # get movement regressors
-    movement_regressor_names = ['trans_x','trans_y','trans_z','rot_x','rot_y','rot_z']
-    movement_regressors = confounds_df.loc[:,movement_regressor_names]
+    movement_regressors = confounds_df.loc[:,movement_regressor_names].values
     movement_regressor_names += [i+'td' for i in movement_regressor_names]
     movement_regressors = np.hstack((movement_regressors, np.gradient(movement_regressors,axis=0)))
     # add square
@@ -206,9 +598,6 @@ def process_confounds(confounds_file, a_comp_cor=True):
     movement_regressors = np.hstack((movement_regressors, movement_regressors**2))
     
     # add additional relevant regressors
-    add_regressor_names = ['framewise_displacement'] 
-    if a_comp_cor: 
-        add_regressor_names += [i for i in confounds_df.columns if 'a_comp_cor' in i]
     additional_regressors = confounds_df.loc[:,add_regressor_names].values
     regressors = np.hstack((movement_regressors,
                             additional_regressors,
@@ -217,6 +606,34 @@ def process_confounds(confounds_file, a_comp_cor=True):
     regressor_names = movement_regressor_names + add_regressor_names + \
                       excessive_movement_regressor_names
     return regressors, regressor_names
+
+def load_confounds(confounds_file, a_comp_cor=True, fd_thresh=.5, dvars_thresh=1.2,
+                   cache_dir=None):
+    """
+    returns the processed confounds of confounds_file as a dataframe. 
+
+    If cache_dir is set, the processed confounds are saved there, keyed by
+    the hash of confounds_file and the processing options, and reused by
+    later calls (e.g. the other model variants of the same run)
+    """
+    options = {'a_comp_cor': a_comp_cor, 'fd_thresh': fd_thresh, 
+               'dvars_thresh': dvars_thresh}
+    if cache_dir is not None:
+        key = get_hash([get_file_hash(confounds_file), options])
+        cache_file = path.join(cache_dir, 'confounds_%s.npz' % key)
+        if path.exists(cache_file):
+            cached = np.load(cache_file)
+            return pd.DataFrame(cached['regressors'], 
+                                columns=list(cached['regressor_names']))
+    regressors, regressor_names = process_confounds(confounds_file, **options)
+    if cache_dir is not None:
+        makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so parallel jobs never read a partial file
+        tmp_file = cache_file.replace('.npz', '_%s.tmp.npz' % os.getpid())
+        np.savez(tmp_file, regressors=regressors, 
+                 regressor_names=np.array(regressor_names))
+        os.replace(tmp_file, cache_file)
+    return pd.DataFrame(regressors, columns=regressor_names)
         
 def process_physio(cardiac_file, resp_file):
     cardiac_file = '/mnt/temp/sub-s130/ses-1/func/sub-s130_ses-1_task-stroop_run-1_recording-cardiac_physio.tsv.gz'
@@ -227,7 +644,7 @@ def process_physio(cardiac_file, resp_file):
 # Getter functions
 # ******************************************************** 
 
-def get_func_file(fmriprep_dir, subject_id, task):
+def get_func_file(fmriprep_dir, subject_id, task, catalog=None):
     
     """ 
     gets the preproc func and mask files files from fmriprep dir, and returns
@@ -235,8 +652,15 @@ def get_func_file(fmriprep_dir, subject_id, task):
     # strip "sub" from beginning of subject_id if provided
     subject_id = subject_id.replace('sub-','')
     
+    if catalog is not None:
+        func_file = catalog.query(subject=subject_id, root=fmriprep_dir, task=task,
+                                  space='MNI*', desc='preproc', suffix='bold',
+                                  extension='.nii.gz')
+        mask_file = catalog.query(subject=subject_id, root=fmriprep_dir, task=task,
+                                  space='MNI*', desc='brain', suffix='mask',
+                                  extension='.nii.gz')
     #check if there's a session folder 
-    if os.path.exists(path.join(fmriprep_dir,
+    elif os.path.exists(path.join(fmriprep_dir,
                           'sub-%s' % subject_id,
                           'func')):  
     
@@ -244,22 +668,16 @@ def get_func_file(fmriprep_dir, subject_id, task):
         func_file = glob(path.join(fmriprep_dir,
                           'sub-%s' % subject_id,
                           'func', '*%s*MNI*preproc_bold.nii.gz' % task))
-    else: 
-        func_file = glob(path.join(fmriprep_dir,
-                          'sub-%s' % subject_id,
-                          '*', 'func', '*%s*MNI*preproc_bold.nii.gz' % task))
-        
-    #check if there's a session folder 
-    if os.path.exists(path.join(fmriprep_dir,
-                          'sub-%s' % subject_id,
-                          'func')): 
     #return mask file             
         mask_file = glob(path.join(fmriprep_dir,
                           'sub-%s' % subject_id,
                           'func',
                           '*%s*MNI*brain_mask.nii.gz' % task))
     else: 
-         mask_file = glob(path.join(fmriprep_dir,
+        func_file = glob(path.join(fmriprep_dir,
+                          'sub-%s' % subject_id,
+                          '*', 'func', '*%s*MNI*preproc_bold.nii.gz' % task))
+        mask_file = glob(path.join(fmriprep_dir,
                           'sub-%s' % subject_id,
                           '*', 'func',
                           '*%s*MNI*brain_mask.nii.gz' % task))
@@ -268,81 +686,129 @@ def get_func_file(fmriprep_dir, subject_id, task):
         return None, None
     return func_file[0], mask_file[0]
 
-def get_confounds(fmriprep_dir, subject_id, task):
+def get_confounds_file(fmriprep_dir, subject_id, task, catalog=None):
+    """ returns the fmriprep confounds file of a run, or None if it is missing """
     # strip "sub" from beginning of subject_id if provided
     subject_id = subject_id.replace('sub-','')
     
-    ## Get the Confounds File (output of fmriprep)
-    # Read the TSV file and convert to pandas dataframe
-    
+    if catalog is not None:
+        confounds_file = catalog.query(subject=subject_id, root=fmriprep_dir, task=task,
+                                       desc='confounds', suffix='regressors',
+                                       extension='.tsv')
     #check if there's a session folder 
-    if os.path.exists(path.join(fmriprep_dir,
+    elif os.path.exists(path.join(fmriprep_dir,
                                'sub-%s' % subject_id,
                                'func')):
     #gets confounds_file       
         confounds_file = glob(path.join(fmriprep_dir,
                                'sub-%s' % subject_id,
                                 'func',
-                               '*%s*confounds_regressors.tsv' % task))[0]
+                               '*%s*confounds_regressors.tsv' % task))
     else: 
         confounds_file = glob(path.join(fmriprep_dir,
                                'sub-%s' % subject_id,
                                 '*', 'func',
-                               '*%s*confounds_regressors.tsv' % task))[0]
-        
-    regressors, regressor_names = process_confounds(confounds_file)
-    confounds = pd.DataFrame(regressors, columns=regressor_names)
+                               '*%s*confounds_regressors.tsv' % task))
+    if not confounds_file:
+        return None
+    return confounds_file[0]
+
+def get_confounds(fmriprep_dir, subject_id, task, a_comp_cor=True, catalog=None,
+                  cache_dir=None):
+    ## Get the Confounds File (output of fmriprep)
+    # Read the TSV file and convert to pandas dataframe
+    confounds_file = get_confounds_file(fmriprep_dir, subject_id, task, catalog=catalog)
+    if confounds_file is None:
+        raise IndexError('No confounds file for %s: %s' % (subject_id, task))
+    confounds = load_confounds(confounds_file, a_comp_cor=a_comp_cor, cache_dir=cache_dir)
     return confounds
+
+def get_events_file(data_dir, subject_id, task, catalog=None):
+    """ returns the events file of a run, or None if it is missing """
+    #check if there's a ses-* folder 
+    if catalog is not None:
+        event_file = catalog.query(subject=subject_id, root=data_dir, task=task,
+                                   suffix='events', extension='.tsv')
+    elif os.path.exists(path.join(data_dir,
+                           'sub-%s' % subject_id,
+                            'func')): 
+   # returns event_file 
+        event_file = glob(path.join(data_dir,
+                           'sub-%s' % subject_id,
+                            'func',
+                           '*%s*events.tsv' % task))
+    else: 
+        event_file = glob(path.join(data_dir,
+                           'sub-%s' % subject_id,
+                            '*', 'func',
+                           '*%s*events.tsv' % task))
+    if not event_file:
+        return None
+    return event_file[0]
     
-def get_events(data_dir, subject_id, task):
+def get_events(data_dir, subject_id, task, catalog=None):
     ## Get the Events File if it exists
     # Read the TSV file and convert to pandas dataframe
-    
-    #check if there's a ses-* folder 
-    try:
-        if os.path.exists(path.join(data_dir,
-                               'sub-%s' % subject_id,
-                                'func')): 
-            
-   # returns event_file 
-            event_file = glob(path.join(data_dir,
-                               'sub-%s' % subject_id,
-                                'func',
-                               '*%s*events.tsv' % task))[0]  
-        else: 
-             event_file = glob(path.join(data_dir,
-                               'sub-%s' % subject_id,
-                                '*', 'func',
-                               '*%s*events.tsv' % task))[0]
-        events_df = pd.read_csv(event_file,sep = '\t')
-        return events_df
-    except IndexError:
+    event_file = get_events_file(data_dir, subject_id, task, catalog=catalog)
+    if event_file is None:
+        return None
+    events_df = pd.read_csv(event_file,sep = '\t')
+    return events_df
+
+# ********************************************************
+# Manifests
+# ********************************************************
+def get_model_settings(task, TR, regress_rt=False, beta=False, a_comp_cor=True, lss=False):
+    """
+    returns the settings that determine a first level model's outputs, for
+    its manifest. Event parsing is included through the key of the task's 
+    EV spec. Solver and design engine are left out, as they give the same 
+    model
+    """
+    EV_spec = get_EV_spec('beta' if beta else task, regress_rt)
+    return {'task': task, 'TR': TR, 'regress_rt': regress_rt, 'beta': beta,
+            'a_comp_cor': a_comp_cor, 'lss': lss, 'design': DESIGN_SETTINGS,
+            'EV_spec': EV_spec.key, 'contrasts': get_contrasts(task, regress_rt)}
+
+def get_input_manifest(subject_id, task, fmriprep_dir, data_dir, settings, catalog=None):
+    """
+    fingerprints the bold, mask, events and confounds files of a run (see
+    utils.get_file_fingerprint) along with the hash of the model settings. 
+    Returns None if any input is missing
+    """
+    func_file, mask_file = get_func_file(fmriprep_dir, subject_id, task, catalog=catalog)
+    inputs = {'func': func_file, 'mask': mask_file,
+              'events': get_events_file(data_dir, subject_id, task, catalog=catalog),
+              'confounds': get_confounds_file(fmriprep_dir, subject_id, task, catalog=catalog)}
+    if any(filename is None for filename in inputs.values()):
         return None
+    manifest = {'inputs': {name: {'file': filename, 'fingerprint': get_file_fingerprint(filename)}
+                           for name, filename in inputs.items()}}
+    return set_manifest_settings(manifest, settings)
+
+def set_manifest_settings(manifest, settings):
+    """ returns a copy of manifest for other model settings, so the inputs of 
+    a run are only fingerprinted once for all of its models """
+    return dict(manifest, settings=settings, settings_hash=get_hash(settings))
+
+def get_manifest_file(subject_id, task, first_level_dir, flags):
+    """ returns the manifest file of the output named by flags """
+    return path.join(first_level_dir, subject_id, task, 'manifest_%s.json' % flags)
+
+def write_manifest(manifest, manifest_file):
+    makedirs(path.dirname(manifest_file), exist_ok=True)
+    tmp_file = '%s.%s.tmp' % (manifest_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, manifest_file)
 
-def get_paradigm(EV_dict):
-    # convert nipype format to nistats paradigm
-    conditions = []
-    onsets = []
-    amplitudes = []
-    durations = []
-    for i in range(len(EV_dict['conditions'])):
-        onset = EV_dict['onsets'][i]
-        onsets += onset
-        # add on conditions
-        conditions += [EV_dict['conditions'][i]]*len(onset)
-        duration = EV_dict['durations'][i]
-        # add on duration, and extend if the array has a length of one
-        if len(duration) == 1 and len(onset) > 1:
-            duration *= len(onset)
-        durations += duration
-        # add on amplitude, and extend if the array has a length of one
-        amplitude = EV_dict['amplitudes'][i]
-        if len(amplitude) == 1 and len(onset) > 1:
-            amplitude *= len(onset)
-        amplitudes += amplitude
-    paradigm = {'trial_type': conditions,
-               'onset': onsets,
-               'modulation': amplitudes,
-               'duration': durations} 
-    paradigm = pd.DataFrame(paradigm).sort_values(by='onset').reset_index(drop=True)
-    return paradigm
+def is_up_to_date(manifest_file, manifest):
+    """ whether manifest_file records the same input fingerprints and 
+    settings as manifest. Input paths are not compared """
+    if not path.exists(manifest_file):
+        return False
+    with open(manifest_file) as f:
+        saved = json.load(f)
+    fingerprints = lambda m: {name: i['fingerprint'] for name, i in m['inputs'].items()}
+    return (saved['settings_hash'] == manifest['settings_hash'] and
+            fingerprints(saved) == fingerprints(manifest))
@@ -0,0 +1,441 @@
+"""
+utilities for storing fitted GLMs and computing contrasts from them
+"""
+import json
+import nibabel as nib
+from nibabel.openers import ImageOpener
+import numpy as np
+from os import makedirs, path
+import patsy
+from scipy import stats
+import tempfile
+import warnings
+
+# ********************************************************
+# helper functions
+# ********************************************************
+def expression_to_contrast_vector(expression, design_columns):
+    """ converts a contrast expression (e.g. 'a - b') into a contrast vector
+    over design_columns. Mirrors nistats' parsing of contrast strings """
+    design_columns = list(design_columns)
+    if expression in design_columns:
+        contrast_vector = np.zeros(len(design_columns))
+        contrast_vector[design_columns.index(expression)] = 1.
+        return contrast_vector
+    return patsy.DesignInfo(design_columns).linear_constraint(expression).coefs[0]
+
+def get_contrast_matrix(contrasts, design_columns):
+    """ parses a list of (name, expression) contrasts into one contrast matrix
+
+    Returns:
+        names: names of the contrasts that could be parsed
+        contrast_matrix: (n_contrasts x n_columns) array
+        failed: names of contrasts whose expression could not be parsed, 
+            e.g. because they reference a regressor missing from the design
+    """
+    names, rows, failed = [], [], []
+    for name, expression in contrasts:
+        try:
+            rows.append(expression_to_contrast_vector(expression, design_columns))
+            names.append(name)
+        except patsy.PatsyError:
+            failed.append(name)
+    contrast_matrix = np.array(rows).reshape(len(rows), len(design_columns))
+    return names, contrast_matrix, failed
+
+def ar1_whiten(X, rho):
+    """ prewhitens the rows of X with an AR(1) coefficient, as nistats' ARModel """
+    X = np.asarray(X, dtype=np.float64)
+    wX = X.copy()
+    wX[1:] -= rho * X[:-1]
+    return wX
+
+def get_normalized_cov(design, rho):
+    """ returns pinv(wX) pinv(wX)' for the design whitened at rho """
+    pinv_wX = np.linalg.pinv(ar1_whiten(design, rho))
+    return pinv_wX.dot(pinv_wX.T)
+
+def mean_scaling(Y):
+    """ scales each column of Y to percent signal change, as nistats does
+    before fitting a first level model """
+    mean = Y.mean(axis=0)
+    if (mean == 0).any():
+        warnings.warn('Mean values of 0 observed.'
+                      'The data have probably been centered.'
+                      'Scaling might not work as expected')
+    mean = np.maximum(mean, 1)
+    return 100 * (Y / mean - 1), mean
+
+def estimate_ar1(X, Y, bins=100):
+    """ AR(1) coefficient of the OLS residuals of every column of Y, 
+    truncated to 1/bins as nistats does to group voxels """
+    resid = Y - X.dot(np.linalg.pinv(X).dot(Y))
+    ar1 = (resid[1:] * resid[:-1]).sum(axis=0) / (resid ** 2).sum(axis=0)
+    return (ar1 * bins).astype(int) * 1. / bins
+
+def t_to_z(t, dof):
+    """ converts t stats to z scores through their one-sided p values """
+    p = stats.t.sf(t, dof)
+    p = np.minimum(np.maximum(p, 1e-300), 1. - 1e-16)
+    return stats.norm.isf(p)
+
+def load_masked_data(func_file, mask_img, n_volumes=50, dtype=np.float32, out_file=None):
+    """ reads the in-mask voxels of a 4D image into a (n_frames x n_voxels) 
+    array, n_volumes at a time, so the full 4D image is never held in memory.
+    The file is opened once and its blocks are read in order, so a gzipped
+    image is decompressed in a single pass rather than from the start for 
+    every block. If out_file is set, the array is written to that .npy file 
+    in Fortran order, so each block of voxels is contiguous, and returned 
+    memory mapped """
+    mask = np.asanyarray(mask_img.dataobj).astype(bool)
+    with ImageOpener(func_file) as f:
+        img = nib.Nifti1Image.from_file_map({'image': nib.FileHolder(fileobj=f)})
+        if img.shape[:3] != mask.shape or not np.allclose(img.affine, mask_img.affine):
+            raise ValueError('%s and its mask are not on the same grid' % func_file)
+        n_frames = img.shape[3]
+        if out_file is None:
+            Y = np.empty((n_frames, mask.sum()), dtype=dtype)
+        else:
+            Y = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype,
+                                          shape=(n_frames, int(mask.sum())), 
+                                          fortran_order=True)
+        for start in range(0, n_frames, n_volumes):
+            stop = min(start + n_volumes, n_frames)
+            Y[start:stop] = np.asanyarray(img.dataobj[..., start:stop])[mask].T
+    if out_file is not None:
+        Y.flush()
+    return Y
+
+def fit_ar1_glm(Y, design, chunk_size=10000, bins=100):
+    """ fits an AR(1) GLM to blocks of voxels, as nistats' run_glm
+
+    For every block of chunk_size voxels, the data are mean scaled and fit 
+    with OLS. The AR(1) coefficient of the residuals is binned to 1/bins, 
+    and the data are refit after prewhitening at each binned coefficient. 
+    Only betas, residual variance and AR(1) coefficients are kept, so 
+    memory beyond Y is bounded by the block size.
+
+    Args:
+        Y: (n_frames x n_voxels) data. Can be a memory mapped array
+        design: (n_frames x n_regressors) design matrix
+        chunk_size: number of voxels fit at once
+
+    Returns:
+        betas: (n_regressors x n_voxels) float32 array
+        dispersion: (n_voxels,) residual variance
+        ar1: (n_voxels,) binned AR(1) coefficients
+    """
+    X = np.asarray(design, dtype=np.float64)
+    n_frames, n_regressors = X.shape
+    n_voxels = Y.shape[1]
+    # residual degrees of freedom, as FirstLevelResults.dof and nistats
+    dof = n_frames - np.linalg.matrix_rank(X)
+    pinv_X = np.linalg.pinv(X)
+    betas = np.empty((n_regressors, n_voxels), dtype=np.float32)
+    dispersion = np.empty(n_voxels, dtype=np.float32)
+    ar1 = np.empty(n_voxels, dtype=np.float32)
+    # pseudo-inverses of the whitened design, shared across blocks
+    whitened = {}
+    for start in range(0, n_voxels, chunk_size):
+        stop = min(start + chunk_size, n_voxels)
+        Y_chunk, _ = mean_scaling(np.asarray(Y[:, start:stop], dtype=np.float64))
+        resid = Y_chunk - X.dot(pinv_X.dot(Y_chunk))
+        rho = (resid[1:] * resid[:-1]).sum(axis=0) / (resid ** 2).sum(axis=0)
+        rho = (rho * bins).astype(int) * 1. / bins
+        for value in np.unique(rho):
+            if value not in whitened:
+                wX = ar1_whiten(X, value)
+                whitened[value] = (wX, np.linalg.pinv(wX))
+            wX, pinv_wX = whitened[value]
+            voxels = np.flatnonzero(rho == value)
+            wY = ar1_whiten(Y_chunk[:, voxels], value)
+            beta = pinv_wX.dot(wY)
+            wresid = wY - wX.dot(beta)
+            betas[:, start + voxels] = beta
+            dispersion[start + voxels] = (wresid ** 2).sum(axis=0) / dof
+        ar1[start:stop] = rho
+    return betas, dispersion, ar1
+
+def fit_ar1_glms(Y, designs, nuisance, chunk_size=10000, bins=100):
+    """ fits fit_ar1_glm for several designs that share nuisance regressors,
+    with one pass over Y
+
+    Each full design is [designs[i], nuisance]. By the Frisch-Waugh-Lovell
+    theorem, the nuisance is projected out of each block of data once (per
+    AR(1) bin after whitening), and each design only fits its own
+    regressors to the projected data. Voxels that fall in the same AR(1) bin
+    under several designs share their whitened data and its projection.
+
+    Args:
+        Y: (n_frames x n_voxels) data. Can be a memory mapped array
+        designs: list of (n_frames x n_regressors_i) design specific regressors
+        nuisance: (n_frames x n_nuisance) regressors shared by every design,
+            e.g. confounds and drifts
+        chunk_size: number of voxels fit at once
+
+    Returns:
+        list of (betas, dispersion, ar1) for each design, as fit_ar1_glm.
+        The rows of betas are the design's regressors followed by the nuisance
+    """
+    N = np.asarray(nuisance, dtype=np.float64)
+    designs = [np.asarray(X, dtype=np.float64) for X in designs]
+    n_frames, n_voxels = Y.shape
+    n_nuisance = N.shape[1]
+    dofs = [n_frames - np.linalg.matrix_rank(np.hstack([X, N])) for X in designs]
+
+    def project(N, pinv_N, X):
+        """ X with N projected out, and the coefficients of N on X """
+        coefs = pinv_N.dot(X)
+        return X - N.dot(coefs), coefs
+
+    pinv_N = np.linalg.pinv(N)
+    # per design: nuisance-projected regressors and their pseudo-inverse
+    projected = []
+    for X in designs:
+        Xp, _ = project(N, pinv_N, X)
+        projected.append((Xp, np.linalg.pinv(Xp)))
+    # per AR(1) bin: whitened nuisance, and per design whitened regressors
+    whitened_nuisance = {}
+    whitened = {}
+    outputs = [(np.empty((X.shape[1] + n_nuisance, n_voxels), dtype=np.float32),
+                np.empty(n_voxels, dtype=np.float32),
+                np.empty(n_voxels, dtype=np.float32)) for X in designs]
+    for start in range(0, n_voxels, chunk_size):
+        stop = min(start + chunk_size, n_voxels)
+        Y_chunk, _ = mean_scaling(np.asarray(Y[:, start:stop], dtype=np.float64))
+        Y_projected, _ = project(N, pinv_N, Y_chunk)
+        rhos = []
+        for Xp, pinv_Xp in projected:
+            resid = Y_projected - Xp.dot(pinv_Xp.dot(Y_projected))
+            rho = (resid[1:] * resid[:-1]).sum(axis=0) / (resid ** 2).sum(axis=0)
+            rhos.append((rho * bins).astype(int) * 1. / bins)
+        for value in np.unique(np.concatenate(rhos)):
+            if value not in whitened_nuisance:
+                wN = ar1_whiten(N, value)
+                whitened_nuisance[value] = (wN, np.linalg.pinv(wN))
+            wN, pinv_wN = whitened_nuisance[value]
+            # voxels in this bin under any design, whitened and projected once
+            in_bin = np.flatnonzero(np.any([rho == value for rho in rhos], axis=0))
+            wY_projected, wY_coefs = project(wN, pinv_wN,
+                                             ar1_whiten(Y_chunk[:, in_bin], value))
+            for i, rho in enumerate(rhos):
+                voxels = np.flatnonzero(rho[in_bin] == value)
+                if len(voxels) == 0:
+                    continue
+                if (i, value) not in whitened:
+                    wXp, wX_coefs = project(wN, pinv_wN, ar1_whiten(designs[i], value))
+                    whitened[(i, value)] = (wXp, np.linalg.pinv(wXp), wX_coefs)
+                wXp, pinv_wXp, wX_coefs = whitened[(i, value)]
+                beta = pinv_wXp.dot(wY_projected[:, voxels])
+                wresid = wY_projected[:, voxels] - wXp.dot(beta)
+                nuisance_beta = wY_coefs[:, voxels] - wX_coefs.dot(beta)
+                betas, dispersion, ar1 = outputs[i]
+                columns = start + in_bin[voxels]
+                betas[:, columns] = np.vstack([beta, nuisance_beta])
+                dispersion[columns] = (wresid ** 2).sum(axis=0) / dofs[i]
+        for (betas, dispersion, ar1), rho in zip(outputs, rhos):
+            ar1[start:stop] = rho
+    return outputs
+
+def fit_lss(Y, trials, nuisance, ar1=None):
+    """ least squares separate (LSS) estimates of single trial betas
+
+    Each trial is fit with its own model: the trial, the sum of all other
+    trials and the nuisance regressors. The models only differ in two
+    regressors, so the whitening and the projection of the nuisance
+    regressors (Frisch-Waugh-Lovell) are shared, and each trial reduces to 
+    a 2 x 2 least squares problem solved in closed form for all trials and
+    voxels at once.
+
+    Args:
+        Y: (n_frames x n_voxels) data
+        trials: (n_frames x n_trials) trial regressors
+        nuisance: (n_frames x n_nuisance) regressors shared by all models
+            (e.g. junk, confounds and drifts)
+        ar1: (n_voxels,) binned AR(1) coefficients used to prewhiten. If 
+            None, the models are fit with OLS
+
+    Returns:
+        (n_trials x n_voxels) array of betas. Trials whose model is 
+        singular (e.g. a trial outside of the scan) are NaN
+    """
+    trials = np.asarray(trials, dtype=np.float64)
+    nuisance = np.asarray(nuisance, dtype=np.float64)
+    if ar1 is None:
+        ar1 = np.zeros(Y.shape[1])
+    betas = np.full((trials.shape[1], Y.shape[1]), np.nan)
+    rhos, bin_index = np.unique(ar1, return_inverse=True)
+    for i, rho in enumerate(rhos):
+        voxels = bin_index == i
+        wY = ar1_whiten(Y[:, voxels], rho)
+        wN = ar1_whiten(nuisance, rho)
+        wX = ar1_whiten(trials, rho)
+        # trials with the nuisance regressors projected out. Projecting
+        # them out of the data as well is not needed, as rX'rY = rX'wY
+        rX = wX - wN.dot(np.linalg.pinv(wN).dot(wX))
+        rS = rX.sum(axis=1)
+        # gram matrix of [trial, other trials] for every trial
+        xx = (rX ** 2).sum(axis=0)
+        xs = rX.T.dot(rS)
+        xo = xs - xx
+        oo = rS.dot(rS) - 2 * xs + xx
+        xY = rX.T.dot(wY)
+        oY = rS.dot(wY) - xY
+        det = xx * oo - xo ** 2
+        valid = det > 1e-10 * np.maximum(xx * oo, np.finfo(float).tiny)
+        betas[np.ix_(valid, voxels)] = (oo[valid, None] * xY[valid] - 
+                                        xo[valid, None] * oY[valid]) / det[valid, None]
+    return betas
+
+# ********************************************************
+# helper classes
+# ********************************************************
+class FirstLevelResults():
+    """
+    compact, array backed store of a fitted AR(1) first level model
+
+    Holds only what is needed to compute contrasts: betas (n_regressors x
+    n_voxels), residual variance and AR(1) coefficient for every in-mask
+    voxel, the design matrix and the mask. Saved as .npy files that can be
+    memory mapped, plus a small json sidecar.
+    """
+    array_names = ['betas', 'dispersion', 'ar1', 'design']
+
+    def __init__(self, betas, dispersion, ar1, design, design_columns,
+                 mask_img, metadata=None):
+        self.betas = betas
+        self.dispersion = dispersion
+        self.ar1 = ar1
+        self.design = design
+        self.design_columns = list(design_columns)
+        self.mask_img = mask_img
+        self.metadata = metadata if metadata is not None else {}
+        self._mask = None
+        self._cov_cache = {}
+
+    @classmethod
+    def from_data(cls, data, mask_img, design, metadata=None, chunk_size=10000,
+                  tmp_dir=None):
+        """ fits an AR(1) GLM with fit_ar1_glm, without nistats. data is a 
+        bold file or its (n_frames x n_voxels) masked data, e.g. memory mapped.
+        A bold file is first written masked and uncompressed to a temporary
+        file in tmp_dir and fit from its memory map, so only chunk_size 
+        voxels are in memory at once.
+        design is a design matrix dataframe and mask_img a nifti image """
+        if isinstance(data, str):
+            with tempfile.TemporaryDirectory(dir=tmp_dir) as data_dir:
+                Y = load_masked_data(data, mask_img, 
+                                     out_file=path.join(data_dir, 'masked_bold.npy'))
+                return cls.from_data(Y, mask_img, design, metadata, chunk_size)
+        betas, dispersion, ar1 = fit_ar1_glm(data, design.values, chunk_size=chunk_size)
+        return cls(betas, dispersion, ar1, design.values, design.columns,
+                   mask_img, metadata)
+
+    @classmethod
+    def from_fit_model(cls, fit_model, metadata=None):
+        """ extracts the results of a fit nistats FirstLevelModel with one run """
+        labels = fit_model.labels_[0]
+        results = fit_model.results_[0]
+        design = fit_model.design_matrices_[0]
+        n_voxels = labels.shape[0]
+        betas = np.zeros((design.shape[1], n_voxels), dtype=np.float32)
+        dispersion = np.zeros(n_voxels, dtype=np.float32)
+        for label, result in results.items():
+            voxels = labels == label
+            betas[:, voxels] = result.theta
+            dispersion[voxels] = result.dispersion
+        return cls(betas, dispersion, labels.astype(np.float32),
+                   design.values, design.columns,
+                   fit_model.masker_.mask_img_, metadata)
+
+    @property
+    def dof(self):
+        return self.design.shape[0] - np.linalg.matrix_rank(self.design)
+
+    @property
+    def mask(self):
+        if self._mask is None:
+            self._mask = np.asanyarray(self.mask_img.dataobj).astype(bool)
+        return self._mask
+
+    def get_normalized_cov(self, rho):
+        """ covariance of the betas (up to dispersion) for voxels with AR(1)
+        coefficient rho. Cached, as many voxels share the same binned rho """
+        rho = float(rho)
+        if rho not in self._cov_cache:
+            self._cov_cache[rho] = get_normalized_cov(self.design, rho)
+        return self._cov_cache[rho]
+
+    def unmask(self, values):
+        """ projects in-mask values (..., n_voxels) back into a nifti image """
+        values = np.asarray(values)
+        data = np.zeros(self.mask.shape + values.shape[:-1], dtype=np.float32)
+        data[self.mask] = values.T
+        return nib.Nifti1Image(data, self.mask_img.affine)
+
+    def compute_contrasts(self, contrast_matrix):
+        """ computes every contrast in contrast_matrix in one pass over the betas
+
+        Args:
+            contrast_matrix: (n_contrasts x n_columns) array, e.g. from
+                get_contrast_matrix
+
+        Returns:
+            dict of (n_contrasts x n_voxels) arrays: 'effect_size', 
+            'effect_variance', 'stat' and 'z_score'
+        """
+        C = np.atleast_2d(np.asarray(contrast_matrix, dtype=np.float64))
+        effect = C.dot(self.betas)
+        # contrast variance (up to dispersion) for each AR(1) bin, then 
+        # broadcast to the voxels of that bin
+        rhos, bin_index = np.unique(self.ar1, return_inverse=True)
+        bin_variance = np.array([np.einsum('ij,jk,ik->i', C, self.get_normalized_cov(rho), C)
+                                 for rho in rhos])
+        variance = bin_variance[bin_index].T * self.dispersion
+        stat = effect / np.sqrt(np.maximum(variance, np.finfo(float).tiny))
+        return {'effect_size': effect,
+                'effect_variance': variance,
+                'stat': stat,
+                'z_score': t_to_z(stat, self.dof)}
+
+    def compute_contrast(self, contrast, output_type='z_score'):
+        """ computes a contrast map from a contrast expression or vector
+
+        Args:
+            contrast: contrast expression over the design columns
+                (e.g. 'incongruent-congruent') or contrast vector
+            output_type: one of 'z_score', 'stat', 'p_value',
+                'effect_size' or 'effect_variance'
+        """
+        if isinstance(contrast, str):
+            contrast = expression_to_contrast_vector(contrast, self.design_columns)
+        out = self.compute_contrasts(contrast)
+        if output_type == 'p_value':
+            return self.unmask(stats.t.sf(out['stat'][0], self.dof))
+        return self.unmask(out[output_type][0])
+
+    def save(self, directory):
+        """ saves arrays as .npy files, the mask and a json sidecar """
+        makedirs(directory, exist_ok=True)
+        for name in self.array_names:
+            np.save(path.join(directory, '%s.npy' % name), getattr(self, name))
+        self.mask_img.to_filename(path.join(directory, 'mask.nii.gz'))
+        sidecar = dict(self.metadata)
+        sidecar.update({'design_columns': self.design_columns,
+                        'n_voxels': int(self.betas.shape[1]),
+                        'noise_model': 'ar1'})
+        with open(path.join(directory, 'results.json'), 'w') as f:
+            json.dump(sidecar, f, indent=4)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """ loads saved results. Arrays are memory mapped by default """
+        arrays = {name: np.load(path.join(directory, '%s.npy' % name),
+                                mmap_mode=mmap_mode)
+                  for name in cls.array_names}
+        with open(path.join(directory, 'results.json')) as f:
+            metadata = json.load(f)
+        design_columns = metadata.pop('design_columns')
+        mask_img = nib.load(path.join(directory, 'mask.nii.gz'))
+        return cls(arrays['betas'], arrays['dispersion'], arrays['ar1'],
+                   arrays['design'], design_columns, mask_img, metadata)
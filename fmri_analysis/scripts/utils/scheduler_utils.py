@@ -0,0 +1,81 @@
+"""
+utilities for scheduling analysis jobs on a pool of worker processes
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import nibabel as nib
+import numpy as np
+
+# ********************************************************
+# Memory helpers
+# ********************************************************
+def get_memory_limit():
+    """ returns the memory (in bytes) available to jobs on this node
+
+    Uses the SLURM allocation if one is set, otherwise 90% of physical memory
+    """
+    slurm_mem = os.environ.get('SLURM_MEM_PER_NODE')
+    if slurm_mem is not None:
+        return int(slurm_mem) * 1024**2
+    physical_mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return int(physical_mem * .9)
+
+def estimate_bold_memory(func_file, overhead=3):
+    """ estimates the peak memory (in bytes) needed to fit a GLM to a bold file
+
+    Only the header is read. The estimate is the size of the 4D image as
+    float64, scaled by overhead to account for the masked data, residuals
+    and model copies held during the fit.
+    """
+    shape = nib.load(func_file).shape
+    return int(np.prod(shape) * 8 * overhead)
+
+# ********************************************************
+# Scheduler
+# ********************************************************
+def run_jobs(func, jobs, n_procs=1, mem_limit=None):
+    """ runs func over jobs on a pool of n_procs workers
+
+    Results are yielded as jobs complete, which is not necessarily the order
+    of jobs. jobs is consumed lazily: a job is only drawn from it when a
+    worker is free to take it, so a generator of jobs is never held in
+    memory at once and the first job starts right away. A job is only
+    submitted while the summed expected memory of the running jobs stays
+    within mem_limit, though one job is always allowed to run, however large.
+
+    Args:
+        func: module level function to run
+        jobs: iterable of (args, kwargs, mem) tuples, where mem is the
+            expected peak memory of the job in bytes
+        n_procs: maximum number of jobs to run at once. If 1, jobs are run
+            serially in this process
+        mem_limit: memory budget in bytes. Defaults to get_memory_limit()
+    """
+    jobs = iter(jobs)
+    if n_procs <= 1:
+        for args, kwargs, mem in jobs:
+            yield func(*args, **kwargs)
+        return
+    if mem_limit is None:
+        mem_limit = get_memory_limit()
+    running = {}
+    pending = None
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        while True:
+            # submit jobs until the pool or the memory budget is full
+            while len(running) < n_procs:
+                if pending is None:
+                    pending = next(jobs, None)
+                    if pending is None:
+                        break
+                args, kwargs, mem = pending
+                if running and sum(running.values()) + mem > mem_limit:
+                    break
+                running[executor.submit(func, *args, **kwargs)] = mem
+                pending = None
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                yield future.result()
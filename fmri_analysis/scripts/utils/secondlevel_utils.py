@@ -1,22 +1,109 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from glob import glob
-from nilearn import image
-from nipype.caching import Memory
-from nipype.interfaces import fsl
+import json
+import nibabel as nib
+from nilearn import image, masking
+import numpy as np
 import os 
-from os import path, remove
+import pandas as pd
+from os import makedirs, path, remove
+from scipy import ndimage
 import shutil
+from utils.firstlevel_utils import get_first_level_maps
+from utils.glm_utils import get_contrast_matrix, t_to_z
+from utils.stack_utils import ContrastStack
+from utils.tfce_utils import get_adjacency, tfce
 from utils.utils import get_flags
 
-def create_group_mask(fmriprep_dir, threshold=.8, verbose=True):
+def get_brainmasks(fmriprep_dir, catalog=None):
+    """ returns the MNI brain masks of every run in fmriprep_dir """
+    if catalog is not None:
+        return catalog.query(root=fmriprep_dir, space='MNI152NLin2009cAsym',
+                             desc='brain', suffix='mask', extension='.nii.gz')
+    # runs with and without a session folder, as the catalog finds them
+    mask_name = '*MNI152NLin2009cAsym*brain_mask.nii.gz'
+    return sorted(glob(path.join(fmriprep_dir, 'sub-*', 'func', mask_name)) +
+                  glob(path.join(fmriprep_dir, 'sub-*', 'ses-*', 'func', mask_name)))
+
+def create_group_mask(fmriprep_dir, threshold=.8, verbose=True, catalog=None):
     if verbose:
         print('Creating Group mask...')
-    brainmasks = glob(path.join(fmriprep_dir,'sub-*',
-                               'func','*MNI152NLin2009cAsym*brain_mask.nii.gz'))     
+    brainmasks = get_brainmasks(fmriprep_dir, catalog=catalog)
     mean_mask = image.mean_img(brainmasks)
     group_mask = image.math_img("a>=%s" % str(threshold), a=mean_mask)
-    return group_mask
     if verbose:
         print('Finished creating group mask')
+    return group_mask
+
+def update_mask_counts(brainmasks, counts_file, verbose=True):
+    """
+    returns the image of the number of brain masks that include each voxel,
+    and the number of masks. The counts are accumulated one mask at a time
+    in a uint16 buffer and saved to counts_file, with the list of included
+    masks in a json sidecar. Masks already counted in counts_file are not 
+    read again. If a counted mask is no longer in brainmasks, the counts 
+    are rebuilt. Masks are resampled (nearest) to the grid of the first one
+    """
+    brainmasks = sorted(path.abspath(f) for f in brainmasks)
+    sidecar_file = counts_file.replace('.nii.gz', '.json')
+    counts_img, included = None, []
+    if path.exists(counts_file) and path.exists(sidecar_file):
+        with open(sidecar_file) as f:
+            included = json.load(f)['brainmasks']
+        if set(included) <= set(brainmasks):
+            counts_img = nib.load(counts_file)
+        else:
+            included = []
+    new_masks = [f for f in brainmasks if f not in set(included)]
+    if verbose:
+        print('Counting %s new brain masks (%s already counted)' % (len(new_masks), len(included)))
+    if counts_img is None:
+        if len(new_masks) == 0:
+            raise ValueError('No brain masks to create a group mask from')
+        reference = nib.load(new_masks[0])
+        counts = np.zeros(reference.shape[:3], dtype=np.uint16)
+        affine = reference.affine
+    else:
+        counts = np.asanyarray(counts_img.dataobj).astype(np.uint16)
+        affine = counts_img.affine
+    for mask_file in new_masks:
+        mask_img = nib.load(mask_file)
+        if mask_img.shape[:3] != counts.shape or not np.allclose(mask_img.affine, affine):
+            mask_img = image.resample_img(mask_img, target_affine=affine, 
+                                          target_shape=counts.shape, 
+                                          interpolation='nearest')
+        counts += np.asanyarray(mask_img.dataobj).reshape(counts.shape) > 0
+    counts_img = nib.Nifti1Image(counts, affine)
+    if new_masks:
+        makedirs(path.dirname(counts_file), exist_ok=True)
+        # written under temporary names first so a partial update is never read
+        tmp_counts_file = counts_file.replace('.nii.gz', '.%s.tmp.nii.gz' % os.getpid())
+        counts_img.to_filename(tmp_counts_file)
+        with open(sidecar_file + '.tmp', 'w') as f:
+            json.dump({'brainmasks': brainmasks}, f)
+        os.replace(tmp_counts_file, counts_file)
+        os.replace(sidecar_file + '.tmp', sidecar_file)
+    return counts_img, len(brainmasks)
+
+def create_group_masks(fmriprep_dir, counts_file, thresholds=(.8, .95), verbose=True, 
+                       catalog=None):
+    """
+    streaming version of create_group_mask, returning {threshold: group mask}
+    for several thresholds from one set of voxel counts (see 
+    update_mask_counts). Only masks added since counts_file was saved are read
+    """
+    if verbose:
+        print('Creating Group masks...')
+    counts_img, n_masks = update_mask_counts(get_brainmasks(fmriprep_dir, catalog=catalog),
+                                             counts_file, verbose=verbose)
+    fraction = np.asanyarray(counts_img.dataobj) / float(n_masks)
+    group_masks = {threshold: nib.Nifti1Image((fraction >= threshold).astype(np.int8), 
+                                              counts_img.affine)
+                   for threshold in thresholds}
+    if verbose:
+        print('Finished creating group masks')
+    return group_masks
 
 def load_contrast_maps(second_level_dir, task, regress_rt=False, beta=False):
     rt_flag, beta_flag = get_flags(regress_rt, beta)
@@ -33,17 +120,21 @@ def load_contrast_maps(second_level_dir, task, regress_rt=False, beta=False):
         maps[name] = image.load_img(f)
     return maps
 
-def randomise(maps, output_loc, mask_loc, n_perms=500, fwhm=6):
+def randomise(maps, output_loc, mask_loc, n_perms=500, fwhm=6, working_dir=None):
+    from nipype.caching import Memory
+    from nipype.interfaces import fsl
     contrast_name = maps[0][maps[0].index('contrast')+9:].rstrip('.nii.gz')
-    # create 4d image
-    concat_images = image.concat_imgs(maps)
-    # smooth_concat_images
-    concat_images = image.smooth_img(concat_images, fwhm)
+    # temporary files go to working_dir, so that several contrasts can run at once
+    if working_dir is None:
+        working_dir = output_loc
+    makedirs(working_dir, exist_ok=True)
+    # create 4d image of the smoothed maps
+    concat_images = image.concat_imgs(smooth_map_files(maps, fwhm))
     # save concat images temporarily
-    concat_loc = path.join(output_loc, 'tmp_concat.nii.gz')
+    concat_loc = path.join(working_dir, 'tmp_concat.nii.gz')
     concat_images.to_filename(concat_loc)
     # run randomise
-    mem = Memory(base_dir=output_loc)
+    mem = Memory(base_dir=working_dir)
     randomise = mem.cache(fsl.Randomise)
     randomise_results = randomise(
         in_file=concat_loc,
@@ -62,4 +153,511 @@ def randomise(maps, output_loc, mask_loc, n_perms=500, fwhm=6):
     shutil.move(corrected_tfile, tfile_corrected_loc)
     # remove temporary files
     remove(concat_loc)
-    shutil.rmtree(path.join(output_loc, 'nipype_mem'))
+    shutil.rmtree(path.join(working_dir, 'nipype_mem'))
+
+# ********************************************************
+# Smoothing
+# ********************************************************
+def smooth_array(data, affine, fwhm, n_jobs=1):
+    """
+    smooths the 3D volumes of a 3D or 4D array with a separable Gaussian, as
+    nilearn's smooth_img does: non-finite values are set to 0 and each 
+    spatial axis is filtered with gaussian_filter1d in place. The volumes of
+    a 4D array are filtered in n_jobs blocks on a thread pool (scipy releases 
+    the GIL while filtering). Returns the smoothed copy of data
+    """
+    data = np.array(data, dtype=np.float32 if data.dtype.kind in 'iub' else data.dtype)
+    data[~np.isfinite(data)] = 0
+    vox_size = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    sigma = fwhm / (np.sqrt(8 * np.log(2)) * vox_size)
+    def smooth_block(block):
+        for axis, s in enumerate(sigma):
+            if s > 0:
+                ndimage.gaussian_filter1d(block, s, output=block, axis=axis)
+    if data.ndim == 3 or n_jobs <= 1:
+        smooth_block(data)
+        return data
+    blocks = [data[..., start:start + int(np.ceil(data.shape[3] / n_jobs))]
+              for start in range(0, data.shape[3], int(np.ceil(data.shape[3] / n_jobs)))]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(smooth_block, blocks))
+    return data
+
+def get_smoothed_map_file(map_file, fwhm):
+    """ returns the cached smoothed copy of a map, kept next to it """
+    return path.join(path.dirname(map_file), 'smoothed_fwhm-%s' % str(fwhm), 
+                     path.basename(map_file))
+
+def _is_smoothed(map_file, fwhm):
+    smoothed_file = get_smoothed_map_file(map_file, fwhm)
+    return (path.exists(smoothed_file) and 
+            path.getmtime(smoothed_file) >= path.getmtime(map_file))
+
+def smooth_map_files(map_files, fwhm=6, n_jobs=1, batch_size=100, overwrite=False):
+    """
+    returns the smoothed copies of map_files (see get_smoothed_map_file), 
+    smoothing those that are missing or older than their map. Maps on the 
+    same grid are stacked into 4D arrays of up to batch_size maps and 
+    smoothed together (see smooth_array), then saved as float32
+    """
+    map_files = list(map_files)
+    todo = [f for f in map_files if overwrite or not _is_smoothed(f, fwhm)]
+    # group maps by grid so each stack has one affine
+    grids = defaultdict(list)
+    for map_file in todo:
+        img = nib.load(map_file)
+        grids[(img.shape, tuple(img.affine.ravel()))].append(map_file)
+    for (shape, affine), files in grids.items():
+        affine = np.array(affine).reshape(4, 4)
+        for start in range(0, len(files), batch_size):
+            batch = files[start:start + batch_size]
+            data = np.stack([np.asanyarray(nib.load(f).dataobj, dtype=np.float32) 
+                             for f in batch], axis=-1)
+            data = smooth_array(data, affine, fwhm, n_jobs=n_jobs)
+            for i, map_file in enumerate(batch):
+                smoothed_file = get_smoothed_map_file(map_file, fwhm)
+                makedirs(path.dirname(smoothed_file), exist_ok=True)
+                save_img(nib.Nifti1Image(data[..., i], affine), smoothed_file)
+    return [get_smoothed_map_file(f, fwhm) for f in map_files]
+
+# ********************************************************
+# Group engine
+# ********************************************************
+def get_group_map_files(task, first_level_dir, contrast_names, regress_rt=False, beta=False):
+    """ returns {subject: {contrast name: map file}} for every subject with 
+    at least one of the task's contrast maps """
+    map_files = defaultdict(dict)
+    for name in contrast_names:
+        for map_file in get_first_level_maps('*', task, first_level_dir, name, 
+                                             regress_rt, beta):
+            subject_id = path.relpath(map_file, first_level_dir).split(path.sep)[0]
+            map_files[subject_id][name] = map_file
+    return {subject_id: map_files[subject_id] for subject_id in sorted(map_files)}
+
+def load_group_data(map_files, contrast_names, mask_img, fwhm=6, n_jobs=1):
+    """
+    loads the contrast maps of every subject into a (subjects x contrasts x
+    voxels) float32 array, with NaN for missing maps.
+
+    As in nistats' SecondLevelModel, maps are smoothed, resampled to the 
+    mask if needed and masked. Smoothed maps are read from the cache of 
+    smooth_map_files, so they are shared with FSL randomise and reruns.
+    Unlike nistats, maps on another grid than the mask are smoothed before
+    they are resampled
+    """
+    mask_img = image.load_img(mask_img)
+    n_voxels = int(np.asanyarray(mask_img.dataobj).astype(bool).sum())
+    data = np.full((len(map_files), len(contrast_names), n_voxels), np.nan, 
+                   dtype=np.float32)
+    if fwhm is not None:
+        smoothed_files = iter(smooth_map_files(
+            [subject_maps[name] for subject_maps in map_files.values()
+             for name in contrast_names if name in subject_maps], fwhm, n_jobs=n_jobs))
+        map_files = {subject_id: {name: next(smoothed_files) 
+                                  for name in contrast_names if name in subject_maps}
+                     for subject_id, subject_maps in map_files.items()}
+    for i, subject_maps in enumerate(map_files.values()):
+        names = [name for name in contrast_names if name in subject_maps]
+        maps = image.concat_imgs([subject_maps[name] for name in names])
+        if maps.shape[:3] != mask_img.shape or not np.allclose(maps.affine, mask_img.affine):
+            maps = image.resample_to_img(maps, mask_img)
+        rows = [contrast_names.index(name) for name in names]
+        data[i, rows] = masking.apply_mask(maps, mask_img)
+    return data
+
+def one_sample_ttest(data, chunk_size=10000):
+    """
+    one sample t test over the first axis of data (e.g. subjects x contrasts
+    x voxels), ignoring NaNs. Returns t and z maps and the number of 
+    observations n, each of the shape of data without its first axis. z is
+    computed from t with n-1 degrees of freedom, as nistats does. The last 
+    axis is tested chunk_size voxels at a time, so the float64 temporaries
+    are bounded by the chunk
+    """
+    n = np.zeros(data.shape[1:], dtype=int)
+    t = np.empty(data.shape[1:])
+    for start in range(0, data.shape[-1], chunk_size):
+        stop = min(start + chunk_size, data.shape[-1])
+        chunk = data[..., start:stop]
+        n[..., start:stop] = np.sum(~np.isnan(chunk), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.nanmean(chunk, axis=0, dtype=np.float64)
+            std = np.nanstd(chunk, axis=0, ddof=1, dtype=np.float64)
+            t[..., start:stop] = mean / (std / np.sqrt(n[..., start:stop]))
+    t[n < 2] = np.nan
+    z = np.full(t.shape, np.nan)
+    valid = np.isfinite(t)
+    z[valid] = t_to_z(t[valid], (n - 1)[valid])
+    return t, z, n
+
+def get_group_design(subject_ids, covariates=None):
+    """
+    returns the group design matrix of subject_ids: an intercept and the
+    (mean centered) columns of the covariates dataframe, indexed by subject.
+    Subjects missing from covariates, or with missing values, get NaN rows 
+    and are left out of the fit (see fit_group_glm). Covariates are centered
+    over the subjects with complete rows, so the intercept is the group 
+    mean at the average covariates
+    """
+    design = pd.DataFrame({'intercept': 1.}, index=pd.Index(subject_ids, name='subject_id'))
+    if covariates is not None:
+        covariates = covariates.reindex(subject_ids).astype(float)
+        complete = covariates.notnull().all(axis=1)
+        covariates = covariates - covariates[complete].mean()
+        design = design.join(covariates)
+        design.loc[~complete, 'intercept'] = np.nan
+    return design
+
+def fit_group_glm(data, design, group_contrasts, chunk_size=10000):
+    """
+    OLS fit of a group design to every first level contrast and voxel
+
+    Subjects are left out of a first level contrast if its map is missing 
+    (NaN at every voxel) or their design row is incomplete. First level 
+    contrasts with the same subjects are fit together, with one 
+    pseudo-inverse of their design for all their voxels, so a pseudo-inverse
+    is computed per pattern of missing subjects rather than per contrast.
+    Voxels are fit chunk_size at a time, so the float64 copies of the data
+    are bounded by the chunk.
+
+    Args:
+        data: (subjects x contrasts x voxels) array, as from load_group_data
+        design: (subjects x regressors) dataframe, as from get_group_design
+        group_contrasts: list of (name, expression) contrasts of the design
+            columns, e.g. [('mean', 'intercept'), ('age', 'age')]
+
+    Returns:
+        names: names of the group contrasts
+        t, z: (group contrasts x contrasts x voxels) arrays, NaN where a 
+            contrast has no residual degrees of freedom
+        dof: (contrasts,) residual degrees of freedom
+    """
+    names, contrast_matrix, failed = get_contrast_matrix(group_contrasts, list(design.columns))
+    if failed:
+        raise ValueError('Group contrasts %s could not be parsed' % failed)
+    X = design.values
+    n_contrasts, n_voxels = data.shape[1:]
+    t = np.full((len(names), n_contrasts, n_voxels), np.nan)
+    z = np.full(t.shape, np.nan)
+    dof = np.zeros(n_contrasts, dtype=int)
+    has_map = np.array([~np.isnan(data[:, i]).all(axis=1) for i in range(n_contrasts)]).T
+    subjects = has_map & ~np.isnan(X).any(axis=1)[:, None]
+    patterns, pattern_index = np.unique(subjects.T, axis=0, return_inverse=True)
+    for k, pattern in enumerate(patterns):
+        columns = np.flatnonzero(pattern_index.ravel() == k)
+        pinv_X = np.linalg.pinv(X[pattern])
+        df = pattern.sum() - np.linalg.matrix_rank(X[pattern])
+        dof[columns] = df
+        if df <= 0:
+            continue
+        variances = np.einsum('ij,jk,ik->i', contrast_matrix, pinv_X.dot(pinv_X.T), 
+                              contrast_matrix)
+        rows = np.flatnonzero(pattern)
+        for start in range(0, n_voxels, chunk_size):
+            stop = min(start + chunk_size, n_voxels)
+            Y = data[:, :, start:stop][np.ix_(rows, columns)]
+            Y = Y.reshape(len(rows), -1).astype(np.float64)
+            betas = pinv_X.dot(Y)
+            sigma2 = ((Y - X[pattern].dot(betas)) ** 2).sum(axis=0) / df
+            effects = contrast_matrix.dot(betas)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chunk_t = effects / np.sqrt(variances[:, None] * sigma2)
+            chunk_t = chunk_t.reshape(len(names), len(columns), stop - start)
+            valid = np.isfinite(chunk_t)
+            chunk_z = np.full(chunk_t.shape, np.nan)
+            chunk_z[valid] = t_to_z(chunk_t[valid], df)
+            t[:, columns, start:stop] = chunk_t
+            z[:, columns, start:stop] = chunk_z
+    return names, t, z, dof
+
+# ********************************************************
+# Permutation engine
+# ********************************************************
+def get_sign_flips(n_subjects, n_perms, random_state=0):
+    """ returns a (n_perms x n_subjects) matrix of random sign flips. The 
+    first row is the unpermuted data (all ones) """
+    rng = np.random.RandomState(random_state)
+    flips = rng.choice([-1., 1.], size=(n_perms, n_subjects))
+    flips[0] = 1
+    return flips
+
+def _smooth_masked(values, mask, sigma, weights=None):
+    """ gaussian smoothing (sigma in voxels) of masked values, normalized by
+    the smoothed mask (weights) so voxels near the edge aren't shrunk """
+    volume = np.zeros(mask.shape)
+    volume[mask] = values
+    smoothed = ndimage.gaussian_filter(volume, sigma)
+    if weights is None:
+        weights = ndimage.gaussian_filter(mask.astype(float), sigma)[mask]
+    return smoothed[mask] / weights
+
+def sign_flip_tstats(data, flips, mask=None, var_sigma=None):
+    """ one sample t statistics of data (subjects x voxels) under each row
+    of flips. With var_sigma (in voxels), the variance is smoothed within 
+    mask before computing t, as FSL randomise's -v option """
+    n = data.shape[0]
+    means = flips.dot(data) / n
+    # the sum of squares doesn't change with the signs
+    sum_squares = (data ** 2).sum(axis=0)
+    variances = np.maximum(sum_squares - n * means ** 2, 0) / (n - 1)
+    if var_sigma is not None:
+        weights = ndimage.gaussian_filter(mask.astype(float), var_sigma)[mask]
+        variances = np.array([_smooth_masked(v, mask, var_sigma, weights) 
+                              for v in variances])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstats = means / np.sqrt(variances / n)
+    return np.nan_to_num(tstats, nan=0, posinf=0, neginf=0)
+
+def _max_stats(data, flips, mask, var_sigma, adjacency, tfce_kwargs, batch_size=100):
+    """ maximum statistic over voxels under each row of flips, and the 
+    statistics of the first row. Flips are applied batch_size at a time to
+    bound memory. If adjacency is passed, t statistics are TFCE enhanced """
+    max_stats = np.empty(len(flips))
+    first = None
+    for start in range(0, len(flips), batch_size):
+        stats = sign_flip_tstats(data, flips[start:start+batch_size], mask, var_sigma)
+        if adjacency is not None:
+            stats = tfce(stats, adjacency, **tfce_kwargs)
+        max_stats[start:start+len(stats)] = stats.max(axis=1)
+        if first is None:
+            first = stats[0]
+    return max_stats, first
+
+def permutation_test(data, mask_img, flips, var_smooth=10, use_tfce=True, n_jobs=1,
+                     connectivity=6, tfce_kwargs=None):
+    """
+    one sample sign-flipping permutation test with max-statistic FWE 
+    correction, as FSL randomise -1 [-T] [-v var_smooth]
+
+    Args:
+        data: (subjects x voxels) masked maps
+        mask_img: mask of the voxels
+        flips: (n_perms x subjects) sign flips (see get_sign_flips). The 
+            first row must be the unpermuted data
+        var_smooth: sigma (mm) of variance smoothing, or None
+        use_tfce: correct TFCE enhanced t statistics, rather than t
+        connectivity: voxel connectivity of TFCE clusters (6, 18 or 26)
+        tfce_kwargs: H, E and n_steps passed to tfce_utils.tfce
+        n_jobs: number of processes the permutations are split across, 
+            including this one, which runs the first block
+
+    Returns:
+        tstats: (voxels,) t statistics
+        corrected: (voxels,) 1 - FWE corrected p values, as FSL writes them
+    """
+    mask_img = image.load_img(mask_img)
+    mask = np.asanyarray(mask_img.dataobj).astype(bool)
+    data = np.asarray(data, dtype=np.float64)
+    var_sigma = None
+    if var_smooth:
+        voxel_size = np.sqrt((mask_img.affine[:3, :3] ** 2).sum(axis=0))
+        var_sigma = var_smooth / voxel_size
+    tfce_kwargs = tfce_kwargs or {}
+    adjacency = get_adjacency(mask, connectivity) if use_tfce else None
+    blocks = np.array_split(np.arange(len(flips)), max(1, min(n_jobs, len(flips))))
+    args = [(data, flips[block], mask, var_sigma, adjacency, tfce_kwargs) for block in blocks]
+    if len(args) > 1:
+        with ProcessPoolExecutor(max_workers=len(args) - 1) as executor:
+            futures = [executor.submit(_max_stats, *a) for a in args[1:]]
+            results = [_max_stats(*args[0])] + [future.result() for future in futures]
+    else:
+        results = [_max_stats(*a) for a in args]
+    max_stats = np.concatenate([r[0] for r in results])
+    observed = results[0][1]
+    tstats = sign_flip_tstats(data, flips[:1], mask, var_sigma)[0]
+    p_values = (max_stats[None, :] >= observed[:, None] - 1e-10).mean(axis=1)
+    return tstats, 1 - p_values
+
+def randomise_native(group_data, contrast_names, output_loc, mask_loc, n_perms=500,
+                     var_smooth=10, use_tfce=True, n_jobs=1, random_state=0):
+    """
+    runs permutation_test on every contrast of a task, in place of FSL 
+    randomise. group_data is the (subjects x contrasts x voxels) array of 
+    smoothed maps from load_group_data, with NaN for missing maps. One sign
+    flip matrix is shared by all contrasts: each contrast uses the columns 
+    of the subjects with its map. Writes the raw and corrected t files of 
+    each contrast as randomise does
+    """
+    flips = get_sign_flips(group_data.shape[0], n_perms, random_state)
+    for i, contrast_name in enumerate(contrast_names):
+        subjects = ~np.isnan(group_data[:, i]).all(axis=1)
+        if subjects.sum() <= 1:
+            continue
+        tstats, corrected = permutation_test(group_data[subjects, i], mask_loc, 
+                                             flips[:, subjects], var_smooth=var_smooth,
+                                             use_tfce=use_tfce, n_jobs=n_jobs)
+        tfile_loc = path.join(output_loc, "contrast-%s_raw_tfile.nii.gz" % contrast_name)
+        tfile_corrected_loc = path.join(output_loc, "contrast-%s_corrected_tfile.nii.gz" % contrast_name)
+        save_img(masking.unmask(tstats.astype(np.float32), mask_loc), tfile_loc)
+        save_img(masking.unmask(corrected.astype(np.float32), mask_loc), tfile_corrected_loc)
+
+# ********************************************************
+# Jobs
+# ********************************************************
+def save_img(img, filename):
+    """ saves img under a temporary name first, so filename is never partial """
+    tmp_file = filename.replace('.nii.gz', '.%s.tmp.nii.gz' % os.getpid())
+    img.to_filename(tmp_file)
+    os.replace(tmp_file, filename)
+
+def get_job_dir(maps_dir, job_name):
+    """ returns the directory a job of maps_dir keeps its metadata and
+    temporary files in """
+    return path.join(maps_dir, 'jobs', job_name)
+
+def write_job_metadata(job_dir, lines):
+    """ (over)writes the metadata of one job """
+    makedirs(job_dir, exist_ok=True)
+    metadata_file = path.join(job_dir, 'metadata.txt')
+    tmp_file = '%s.%s.tmp' % (metadata_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.writelines(line + '\n' for line in lines)
+    os.replace(tmp_file, metadata_file)
+
+def collect_job_metadata(maps_dir, job_names):
+    """ writes the metadata of the jobs of maps_dir to maps_dir/metadata.txt,
+    in the order of job_names, whatever order they finished in """
+    lines = []
+    for job_name in job_names:
+        metadata_file = path.join(get_job_dir(maps_dir, job_name), 'metadata.txt')
+        if path.exists(metadata_file):
+            with open(metadata_file) as f:
+                lines += f.read().splitlines()
+    write_job_metadata(maps_dir, lines)
+
+def load_stacked_group_data(map_files, contrast_names, mask_img, stack_dir, fwhm=6, 
+                            n_jobs=1):
+    """
+    load_group_data through the ContrastStack in stack_dir: only the maps 
+    that are new or changed since the last call are smoothed and added
+    """
+    if fwhm is not None:
+        # smoothed copies are only rewritten (and so restacked) when their map changes
+        smoothed_files = iter(smooth_map_files(
+            [map_file for subject_maps in map_files.values() 
+             for map_file in subject_maps.values()], fwhm, n_jobs=n_jobs))
+        map_files = {subject_id: {name: next(smoothed_files) for name in subject_maps}
+                     for subject_id, subject_maps in map_files.items()}
+    stack = ContrastStack(stack_dir, mask_img)
+    stack.update(map_files)
+    return stack.load(contrast_names, subject_ids=list(map_files))
+
+def estimate_task_job_memory(task, task_contrasts, first_level_dir, mask_loc, 
+                             regress_rt=False, beta=False, n_perms=0, n_jobs=1,
+                             n_group_contrasts=0, chunk_size=10000):
+    """
+    expected peak memory (bytes) of run_task_job, the larger of its stages:
+    - loading: a batch of up to 100 maps being smoothed (float32, copied 
+      once), or the maps of one contrast being added to the stack
+    - statistics: the float32 (subjects x contrasts x voxels) group data, 
+      the float64 maps of the fast engine and of n_group_contrasts covariate
+      contrasts, and a few float64 copies of one chunk of the group data
+    - native randomise, if n_perms > 0: the group data, the float64 maps of
+      one contrast, and in each of the n_jobs permutation processes another
+      copy of them and a batch of 100 permutations. TFCE of a batch peaks at
+      about 17 float64 values per map and voxel (its voxel and edge arrays)
+    """
+    contrast_names = [name for name, contrast in task_contrasts]
+    n_contrasts = len(contrast_names)
+    n_subjects = len(get_group_map_files(task, first_level_dir, contrast_names, 
+                                         regress_rt, beta))
+    mask_img = image.load_img(mask_loc)
+    n_grid = int(np.prod(mask_img.shape[:3]))
+    n_voxels = int(np.asanyarray(mask_img.dataobj).astype(bool).sum())
+    data = n_subjects * n_contrasts * n_voxels * 4
+    loading = max(2 * min(100, n_subjects * n_contrasts), n_subjects) * n_grid * 4
+    statistics = (data + (3 + 2 * n_group_contrasts) * n_contrasts * n_voxels * 8 +
+                  4 * n_subjects * n_contrasts * min(chunk_size, n_voxels) * 8)
+    mem = max(loading, statistics)
+    if n_perms > 0:
+        permutations = (n_subjects + 17 * 100) * n_voxels * 8
+        mem = max(mem, data + n_subjects * n_voxels * 8 + n_jobs * permutations)
+    return mem
+
+def estimate_contrast_job_memory(task, name, first_level_dir, mask_loc, regress_rt=False, 
+                                 beta=False):
+    """
+    expected peak memory (bytes) of run_contrast_job: the contrast's maps 
+    smoothed in batches of up to 100, then concatenated into one float32 
+    image for nistats or FSL randomise, and masked as float64 by nistats
+    """
+    n_maps = len(get_first_level_maps('*', task, first_level_dir, name, regress_rt, beta))
+    mask_img = image.load_img(mask_loc)
+    n_grid = int(np.prod(mask_img.shape[:3]))
+    n_voxels = int(np.asanyarray(mask_img.dataobj).astype(bool).sum())
+    return max(2 * min(100, n_maps) * n_grid * 4, n_maps * (n_grid * 4 + n_voxels * 8))
+
+def run_task_job(task, task_contrasts, first_level_dir, maps_dir, mask_loc, 
+                 regress_rt=False, beta=False, group_engine='fast', n_perms=0, 
+                 n_jobs=1, stack_dir=None, covariates=None, group_contrasts=None):
+    """
+    the jobs of a task that use all of its contrasts at once: the contrast
+    maps of the fast group engine (see one_sample_ttest), the native 
+    randomise (see randomise_native), if n_perms > 0, and the group
+    contrasts of a covariate design (see fit_group_glm), if covariates are
+    given. Subject maps are read from the task's ContrastStack if stack_dir 
+    is set
+    """
+    contrast_names = [name for name, contrast in task_contrasts]
+    map_files = get_group_map_files(task, first_level_dir, contrast_names, 
+                                    regress_rt, beta)
+    if stack_dir is not None:
+        group_data = load_stacked_group_data(map_files, contrast_names, mask_loc, stack_dir,
+                                             fwhm=6, n_jobs=n_jobs)
+    else:
+        group_data = load_group_data(map_files, contrast_names, mask_loc, fwhm=6, 
+                                     n_jobs=n_jobs)
+    if group_engine == 'fast':
+        _, group_z, n = one_sample_ttest(group_data)
+        for i, name in enumerate(contrast_names):
+            if n[i].max() <= 1:
+                continue
+            contrast_map = masking.unmask(group_z[i].astype(np.float32), mask_loc)
+            save_img(contrast_map, path.join(maps_dir, 'contrast-%s.nii.gz' % name))
+    if covariates is not None:
+        design = get_group_design(list(map_files), covariates)
+        if group_contrasts is None:
+            group_contrasts = [(column, column) for column in design.columns]
+        group_names, _, group_z, dof = fit_group_glm(group_data, design, group_contrasts)
+        for i, name in enumerate(contrast_names):
+            if dof[i] <= 0:
+                continue
+            for j, group_name in enumerate(group_names):
+                contrast_map = masking.unmask(group_z[j, i].astype(np.float32), mask_loc)
+                save_img(contrast_map, path.join(maps_dir, 'contrast-%s_group-%s.nii.gz' 
+                                                 % (name, group_name)))
+    if n_perms > 0:
+        randomise_native(group_data, contrast_names, maps_dir, mask_loc, 
+                         n_perms=n_perms, n_jobs=n_jobs)
+    return task
+
+def run_contrast_job(task, name, contrast, first_level_dir, maps_dir, mask_loc, 
+                     regress_rt=False, beta=False, group_engine='nistats', 
+                     randomise_engine='fsl', n_perms=0):
+    """
+    the jobs of one contrast of a task: the nistats second level map and FSL
+    randomise, depending on the engines. Metadata and temporary files are 
+    kept in the contrast's job directory and outputs are replaced atomically
+    in maps_dir, so contrasts can finish in any order
+    """
+    job_dir = get_job_dir(maps_dir, 'contrast-%s' % name)
+    maps = get_first_level_maps('*', task, first_level_dir, name, regress_rt, beta)
+    N = str(len(maps)).zfill(2)
+    if len(maps) <= 1:
+        write_job_metadata(job_dir, [])
+        return task, name, len(maps)
+    if group_engine == 'nistats':
+        from nistats.second_level_model import SecondLevelModel
+        # smoothed maps are cached, so the model doesn't smooth them again
+        second_level_model = SecondLevelModel(mask=mask_loc, smoothing_fwhm=None)
+        design_matrix = pd.DataFrame([1] * len(maps), columns=['intercept'])
+        second_level_model.fit(smooth_map_files(maps, 6), design_matrix=design_matrix)
+        contrast_map = second_level_model.compute_contrast()
+        save_img(contrast_map, path.join(maps_dir, 'contrast-%s.nii.gz' % name))
+    lines = ['Contrast-%s: %s maps' % (contrast, N)]
+    if n_perms > 0:
+        if randomise_engine == 'fsl':
+            randomise(maps, maps_dir, mask_loc, n_perms=n_perms, working_dir=job_dir)
+        lines.append('Contrast-%s: Randomise run with %s permutations' % (contrast, str(n_perms)))
+    write_job_metadata(job_dir, lines)
+    return task, name, len(maps)
@@ -0,0 +1,167 @@
+"""
+appendable, per task store of masked subject contrast maps
+"""
+import os
+from os import makedirs, path
+import nibabel as nib
+from nilearn import image, masking
+import numpy as np
+import pandas as pd
+
+INDEX_COLUMNS = ['subject_id', 'contrast', 'row', 'map_file', 'mtime_ns']
+
+# ********************************************************
+# helper functions
+# ********************************************************
+def get_contrast_stack_dir(second_level_dir, task, flags, fwhm=6):
+    """ returns the directory of a task's contrast stack """
+    return path.join(second_level_dir, task, 'contrast_stack_%s_fwhm-%s' % (flags, str(fwhm)))
+
+def _same_mask(mask_img, other_img):
+    return (mask_img.shape == other_img.shape and
+            np.allclose(mask_img.affine, other_img.affine) and
+            np.array_equal(np.asanyarray(mask_img.dataobj).astype(bool),
+                           np.asanyarray(other_img.dataobj).astype(bool)))
+
+# ********************************************************
+# helper classes
+# ********************************************************
+class ContrastStack():
+    """
+    the in-mask voxels of every subject's contrast maps for one task
+
+    Each contrast is a raw float32 file of (rows x voxels), one row per
+    subject map, so a contrast's maps are read as one contiguous memory
+    mapped slab. subjects.tsv indexes the rows by subject and records the
+    map each row was read from and its mtime. New subjects are appended
+    and changed maps rewrite their row in place; nothing else is read again.
+    The mask is saved with the store, which is emptied if the mask changes
+    """
+    def __init__(self, store_dir, mask_img):
+        self.store_dir = store_dir
+        self.mask_img = image.load_img(mask_img)
+        self.n_voxels = int(np.asanyarray(self.mask_img.dataobj).astype(bool).sum())
+        self.index_file = path.join(store_dir, 'subjects.tsv')
+        self.mask_file = path.join(store_dir, 'mask.nii.gz')
+        makedirs(store_dir, exist_ok=True)
+        if path.exists(self.mask_file) and not _same_mask(self.mask_img, nib.load(self.mask_file)):
+            self.clear()
+        if path.exists(self.index_file):
+            # subject ids and contrasts are strings, even if they look like numbers
+            self.index = pd.read_csv(self.index_file, sep='\t',
+                                     dtype={'subject_id': str, 'contrast': str})
+        else:
+            self.index = pd.DataFrame(columns=INDEX_COLUMNS)
+        if not path.exists(self.mask_file):
+            self.mask_img.to_filename(self.mask_file)
+
+    def get_data_file(self, contrast):
+        return path.join(self.store_dir, 'contrast-%s.f32' % contrast)
+
+    def clear(self):
+        """ removes the stored maps """
+        for f in os.listdir(self.store_dir):
+            if f.endswith('.f32') or f in ('subjects.tsv', 'mask.nii.gz'):
+                os.remove(path.join(self.store_dir, f))
+
+    def _save_index(self):
+        tmp_file = '%s.%s.tmp' % (self.index_file, os.getpid())
+        self.index.to_csv(tmp_file, sep='\t', index=False)
+        os.replace(tmp_file, self.index_file)
+
+    def _mask_maps(self, map_files):
+        maps = image.concat_imgs(map_files)
+        if maps.shape[:3] != self.mask_img.shape or not np.allclose(maps.affine, self.mask_img.affine):
+            maps = image.resample_to_img(maps, self.mask_img)
+        return masking.apply_mask(maps, self.mask_img).astype(np.float32)
+
+    def update(self, map_files):
+        """
+        adds the maps of map_files ({subject: {contrast: map file}}) that are
+        not stored, or whose file or mtime changed. Returns the number of
+        maps read
+        """
+        rows = {(s, c): (r, f, m) for s, c, r, f, m in
+                self.index[INDEX_COLUMNS].itertuples(index=False)}
+        n_rows = self.index.groupby('contrast')['row'].max().add(1).to_dict()
+        new = {}
+        for subject_id, subject_maps in map_files.items():
+            for contrast, map_file in subject_maps.items():
+                mtime = os.stat(map_file).st_mtime_ns
+                stored = rows.get((subject_id, contrast))
+                if stored is not None and stored[1:] == (map_file, mtime):
+                    continue
+                if stored is not None:
+                    row = stored[0]
+                else:
+                    row = n_rows.get(contrast, 0)
+                    n_rows[contrast] = row + 1
+                new.setdefault(contrast, []).append((subject_id, row, map_file, mtime))
+        for contrast, entries in new.items():
+            data = self._mask_maps([map_file for _, _, map_file, _ in entries])
+            data_file = self.get_data_file(contrast)
+            with open(data_file, 'r+b' if path.exists(data_file) else 'wb') as f:
+                for (_, row, _, _), values in zip(entries, data):
+                    f.seek(row * self.n_voxels * 4)
+                    f.write(values.tobytes())
+            for subject_id, row, map_file, mtime in entries:
+                rows[(subject_id, contrast)] = (row, map_file, mtime)
+        if new:
+            # data are written before the index, so indexed rows are always complete
+            self.index = pd.DataFrame([(s, c) + v for (s, c), v in rows.items()],
+                                      columns=INDEX_COLUMNS)
+            self._save_index()
+        return sum(len(entries) for entries in new.values())
+
+    def subjects(self):
+        return sorted(self.index.subject_id.unique())
+
+    def get_contrast(self, contrast):
+        """ returns the memory mapped (rows x voxels) maps of a contrast and
+        the subject of each row. Rows are numbered from 0 as maps are added """
+        contrast_index = self.index.query('contrast == @contrast').sort_values('row')
+        data = np.memmap(self.get_data_file(contrast), dtype=np.float32, mode='r',
+                         shape=(int(contrast_index.row.max()) + 1, self.n_voxels))
+        return data, list(contrast_index.subject_id)
+
+    def load(self, contrast_names, subject_ids=None):
+        """
+        returns the (subjects x contrasts x voxels) float32 array of the
+        stored maps, with NaN for missing maps, as load_group_data does.
+        Subjects default to every stored subject, sorted
+        """
+        if subject_ids is None:
+            subject_ids = self.subjects()
+        subject_rows = {subject_id: i for i, subject_id in enumerate(subject_ids)}
+        data = np.full((len(subject_ids), len(contrast_names), self.n_voxels), np.nan,
+                       dtype=np.float32)
+        for j, contrast in enumerate(contrast_names):
+            if not (self.index.contrast == contrast).any():
+                continue
+            contrast_data, contrast_subjects = self.get_contrast(contrast)
+            for row, subject_id in enumerate(contrast_subjects):
+                if subject_id in subject_rows:
+                    data[subject_rows[subject_id], j] = contrast_data[row]
+        return data
+
+if __name__ == '__main__':
+    # rerun check: updating with the same maps reads nothing and doesn't grow the store
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    affine = np.eye(4)
+    mask_file = path.join(tmp_dir, 'mask.nii.gz')
+    nib.Nifti1Image(np.ones((4, 4, 4), dtype=np.int8), affine).to_filename(mask_file)
+    map_files = {}
+    for subject_id in ['3010', '3011']:
+        map_file = path.join(tmp_dir, '%s_contrast-c.nii.gz' % subject_id)
+        nib.Nifti1Image(np.random.randn(4, 4, 4).astype(np.float32), affine).to_filename(map_file)
+        map_files[subject_id] = {'c': map_file}
+    store_dir = path.join(tmp_dir, 'stack')
+    n_read = [ContrastStack(store_dir, mask_file).update(map_files) for run in range(3)]
+    stack = ContrastStack(store_dir, mask_file)
+    size = path.getsize(stack.get_data_file('c'))
+    assert n_read == [2, 0, 0], n_read
+    assert size == 2 * stack.n_voxels * 4, size
+    assert np.allclose(stack.load(['c'])[:, 0], 
+                       [masking.apply_mask(map_files[s]['c'], mask_file) for s in stack.subjects()])
+    print('maps read per run: %s, contrast file: %s bytes' % (n_read, size))
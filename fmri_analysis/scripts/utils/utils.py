@@ -3,7 +3,10 @@ some util functions
 """
 from collections import defaultdict
 from glob import glob
+import hashlib
+import json
 import numpy as np
+import os
 from os.path import join, sep
 import pandas as pd
 
@@ -16,6 +19,52 @@ def get_flags(regress_rt=False, beta=False):
     beta_flag = "beta-True" if beta else "beta-False"
     return rt_flag, beta_flag
 
+def get_model_flags(regress_rt=False, beta=False, a_comp_cor=True):
+    """ returns the flags naming a model's outputs, e.g. 'RT-True_beta-False'.
+    Models without aCompCor confounds are marked with '_aCompCor-False' """
+    flags = '%s_%s' % get_flags(regress_rt, beta)
+    if not a_comp_cor:
+        flags += '_aCompCor-False'
+    return flags
+
+def parse_model_flags(flags):
+    """ inverse of get_model_flags: returns (regress_rt, beta, a_comp_cor) """
+    settings = dict(flag.split('-') for flag in flags.split('_'))
+    unknown = set(settings) - {'RT', 'beta', 'aCompCor'}
+    if unknown or 'RT' not in settings or 'beta' not in settings:
+        raise ValueError('Model flags must look like RT-True_beta-False[_aCompCor-False]: %s' % flags)
+    return (settings['RT'] == 'True', settings['beta'] == 'True',
+            settings.get('aCompCor', 'True') == 'True')
+
+def get_file_hash(filename, chunk_size=2**20):
+    """ returns the sha1 hex digest of a file's contents """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def get_file_fingerprint(filename, max_size=2**24, chunk_size=2**20):
+    """ returns a fingerprint of a file that changes when its contents do
+
+    Files up to max_size bytes are hashed in full. Larger files (e.g. bold
+    images) are fingerprinted by their size, mtime and a hash of their first
+    and last chunk_size bytes, so they aren't read in full
+    """
+    stat = os.stat(filename)
+    if stat.st_size <= max_size:
+        return get_file_hash(filename, chunk_size)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        sha1.update(f.read(chunk_size))
+        f.seek(-chunk_size, os.SEEK_END)
+        sha1.update(f.read(chunk_size))
+    return '%s_%s_%s' % (stat.st_size, stat.st_mtime, sha1.hexdigest())
+
+def get_hash(obj):
+    """ returns the sha1 hex digest of a json serializable object """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
 def get_contrasts(task, regress_rt=True):
     """ 
     Gets a list of contrasts given a task